@@ -78,28 +78,37 @@ from gi.repository import PangoCairo
 import logging
 import os
 import math
+import time
 import cairo
-import StringIO
-import array
+from gettext import gettext as _
 
 from Desenho import Desenho
+from canvas import CanvasModel
+from canvas import DEFAULT_TOOL
+from regions import RegionIndex
+import tiles
+import filters
+import tilestore
+import loading
+import layers
+from layers import LayerStack
+from mipmap import MipmapPyramid
+from history import UndoHistory
+from latency import LatencyMonitor
+from latency import timed
+from latency import OVERLAY_RECT
+import memory
+from memory import MemoryBudget
+from recording import EventRecorder
+from commands import Command
 from urlparse import urlparse
 from sugar3.graphics import style
 from sugar3.activity import activity
-
-FALLBACK_FILL = True
-try:
-    from fill import fill
-    FALLBACK_FILL = False
-    logging.error('Found fill binaries.')
-except:
-    logging.error('No valid fill binaries. Using slower python code')
-    pass
+from sugar3.activity.activity import get_activity_root
 
 # Tools and events manipulation are handle with this class.
 
 TARGET_URI = 0
-MAX_UNDO_STEPS = 12
 RESIZE_ARROW_SIZE = style.GRID_CELL_SIZE / 2
 
 SOUNDS = {'arrow': ['oneclick.ogg', False, True, True],
@@ -136,19 +145,33 @@ def _get_screen_dpi():
 
 bundle_path = activity.get_bundle_path()
 
+# tiles of a project decoded in every iteration of the main loop
+PROJECT_TILES_PER_IDLE = 2
+
+# limits of the scale of the view
+MIN_ZOOM = 0.1
+MAX_ZOOM = 8.0
+
 
-class Area(Gtk.DrawingArea):
+class Area(Gtk.DrawingArea, CanvasModel):
 
     __gsignals__ = {
         'undo': (GObject.SignalFlags.ACTION, None, ([])),
         'redo': (GObject.SignalFlags.ACTION, None, ([])),
         'action-saved': (GObject.SignalFlags.ACTION, None, ([])),
         'select': (GObject.SignalFlags.ACTION, None, ([])),
+        # fraction done of the effect applied in the background
+        'filter-progress': (GObject.SignalFlags.RUN_FIRST, None,
+                            ([float])),
+        # a layer was added, removed or its properties changed
+        'layers-changed': (GObject.SignalFlags.RUN_FIRST, None, ([])),
     }
 
     PENCIL_LIKE_TOOLS = ['pencil', 'eraser', 'brush', 'kalidoscope', 'rainbow',
                          'stamp', 'load-stamp']
 
+    resize_arrow_size = RESIZE_ARROW_SIZE
+
     def __init__(self, activity):
         """ Initialize the object from class Area which is derived
             from Gtk.DrawingArea.
@@ -160,7 +183,6 @@ class Area(Gtk.DrawingArea):
         GObject.GObject.__init__(self)
 
         self.set_events(Gdk.EventMask.POINTER_MOTION_MASK |
-                        Gdk.EventMask.POINTER_MOTION_HINT_MASK |
                         Gdk.EventMask.BUTTON_PRESS_MASK |
                         Gdk.EventMask.BUTTON_RELEASE_MASK |
                         Gdk.EventMask.BUTTON_MOTION_MASK |
@@ -173,6 +195,7 @@ class Area(Gtk.DrawingArea):
         self.connect('event', self.__event_cb)
 
         self.connect("draw", self.draw)
+        self.connect("realize", self.__realize_cb)
         self.connect("motion_notify_event", self.mousemove)
         self.connect("key_press_event", self.key_press)
         self.connect("leave_notify_event", self.mouseleave)
@@ -188,28 +211,9 @@ class Area(Gtk.DrawingArea):
         # TODO gtk3
         # self.set_extension_events(Gdk.EXTENSION_EVENTS_CURSOR)
 
-        # Define which tool is been used.
-        # It is now described as a dictionnary,
-        # with the following keys:
-        # - 'name'          : a string
-        # - 'line size'     : a integer
-        # - 'stamp size'    : a integer
-        # - 'line shape'    : a string - 'circle' or 'square', for now
-        # - 'fill'          : a Boolean value
-        # - 'vertices'      : a integer
-        # All values migth be None, execept in 'name' key.
-        self.tool = {
-            'name': 'brush',
-            'line size': 4,
-            'stamp size': self._get_stamp_size(),
-            'line shape': 'circle',
-            'fill': True,
-            'cairo_stroke_color': (0.0, 0.0, 0.0, 1.0),
-            'cairo_fill_color': (0.0, 0.0, 0.0, 1.0),
-            'bucket_color': (0, 0, 0),
-            'alpha': 1.0,
-            'vertices': 6.0,
-            'font_description': 'Sans 12'}
+        # Define which tool is been used, see canvas.DEFAULT_TOOL
+        self.tool = dict(DEFAULT_TOOL)
+        self.tool['stamp size'] = self._get_stamp_size()
 
         self.desenha = False
         self._selmove = False
@@ -217,8 +221,16 @@ class Area(Gtk.DrawingArea):
         self.oldx = 0
         self.oldy = 0
         self.drawing_canvas = None
+        self.temp_canvas = None
         # This surface is used when need load data from a file or a process
         self.drawing_canvas_data = None
+        # layers.LayerStack, drawing_canvas is the surface of the active
+        # layer
+        self.layers = None
+        # scale of the view, and the reduced copies of the drawing shown
+        # when is less than 1
+        self._zoom = 1.0
+        self._pyramid = None
         self.textos = []
         self.text_in_progress = False
         self.activity = activity
@@ -237,11 +249,38 @@ class Area(Gtk.DrawingArea):
         # selection properties
         self.clear_selection()
         self.pending_clean_selection_background = False
-
-        # List of pixbuf for the Undo function:
-        self._undo_list = []
+        # the image used by the stamp tool, and the one at the stamp size
+        self.pixbuf_stamp = None
+        self.resized_stamp = None
+
+        # List of tiles.Snapshot for the Undo function, the old steps
+        # are moved to a temporary file in the instance directory:
+        self._undo_list = UndoHistory(
+            os.path.join(get_activity_root(), 'instance'))
         self._undo_index = None
         self._keep_undo = False
+        # commands.Command repeating the change to keep, if any
+        self._undo_command = None
+        # the Command recorded while drawing with stamps
+        self._stroke_command = None
+
+        # Connected areas of the canvas, used by the bucket
+        self._regions = RegionIndex()
+
+        # the effect shown while its parameters are changed, and the one
+        # applied in a background thread
+        self._filter_preview = None
+        self._filter_job = None
+
+        # tilestore.TileStore updated with the changes of the canvas
+        self._tile_store = None
+        self._autosave_timer = None
+
+        # project.Project being loaded, with the indexes of the tiles
+        # not painted yet in the canvas
+        self._project = None
+        self._project_tiles = None
+        self._project_idle = None
 
         # variables to show the tool shape
         self.drawing = False
@@ -254,8 +293,31 @@ class Area(Gtk.DrawingArea):
         # used to identify emulated mouse
         self._on_touch = False
 
-        self._update_timer = None
+        # positions of the pointer received since the last frame
+        self._motion_points = []
+        self._motion_button1_pressed = False
+        self._motion_shift_pressed = False
+        self._motion_time = None
+        self._motion_tick = None
         self._resize_hq_timer = None
+        # writes the input received, see recording
+        self._recorder = None
+        # times of the operations, see latency
+        self.latency = LatencyMonitor()
+        self._latency_overlay = False
+        self._overlay_timer = None
+        self._filter_start = None
+        if os.environ.get('PAINT_LATENCY_OVERLAY'):
+            self.set_latency_overlay(True)
+
+        # bytes of the surfaces, some freed when over the budget
+        budget = memory.BUDGET
+        if os.environ.get('PAINT_MEMORY_BUDGET'):
+            budget = int(os.environ['PAINT_MEMORY_BUDGET']) * 1024 * 1024
+        self.memory = MemoryBudget(budget)
+        self._add_memory_sources()
+        if os.environ.get('PAINT_RECORD_EVENTS'):
+            self.start_recording(os.environ['PAINT_RECORD_EVENTS'])
 
         self._player = None
         self._sounds_enabled = False
@@ -292,28 +354,206 @@ class Area(Gtk.DrawingArea):
         """Set the stamp initial size, based on the display DPI."""
         return style.zoom(44)
 
-    def load_from_file(self, file_path):
-        # load using a pixbuf to be able to read different formats
-        loaded_pxb = GdkPixbuf.Pixbuf.new_from_file(file_path)
-        self.drawing_canvas_data = cairo.ImageSurface(
-            cairo.FORMAT_ARGB32, loaded_pxb.get_width(),
-            loaded_pxb.get_height())
-        ctx = cairo.Context(self.drawing_canvas_data)
-        Gdk.cairo_set_source_pixbuf(ctx, loaded_pxb, 0, 0)
+    def load_from_file(self, file_path, full_size=False):
+        """Read the image to draw over from a file of any format known by
+        gdk-pixbuf, reduced to fit in the screen if full_size is False."""
+        max_width, max_height = None, None
+        if not full_size:
+            max_width, max_height = loading.get_screen_size()
+        self.drawing_canvas_data = loading.load_surface(file_path, max_width,
+                                                        max_height)
+
+    def load_project(self, project):
+        """Show the layers of a project.Project in the canvas, call
+        setup() after with the size of the project.
+
+        The tiles are decoded when they are shown, the others in the
+        background. The canvas is not modified before all the tiles are
+        painted, see finish_loading().
+        """
+        self._project = project
+        self._project_tiles = set(range(len(project.tile_rects)))
+        self.drawing_canvas_data = None
+
+    def finish_loading(self):
+        """Paint all the tiles of the project being loaded, if any. Must
+        be called before any change or read of the whole canvas."""
+        if self._project is not None and self.drawing_canvas is not None:
+            self._paint_project_tiles(list(self._project_tiles))
+
+    def _paint_project_tiles(self, indexes):
+        contexts = [cairo.Context(layer.surface) for layer in self.layers]
+        for index in indexes:
+            self._project_tiles.discard(index)
+            x, y, width, height = rect = self._project.tile_rects[index]
+            # every layer of the project in its layer, with the pixels
+            # as they are in the file
+            for number, project_layer in enumerate(self._project.layers):
+                tile = self._project.get_tile(project_layer, index)
+                if tile is None:
+                    continue
+                contexts[number].set_source_surface(tile, x, y)
+                contexts[number].paint()
+                self.layers.layer_changed(number, rect)
+            self.canvas_changed(rect)
+        if not self._project_tiles:
+            logging.debug('Area: project loaded')
+            self._project.close()
+            self._project = None
+            self._project_tiles = None
+            self.enable_undo()
+            self.queue_draw()
+
+    def __project_idle_cb(self):
+        if self._project is not None:
+            self._paint_project_tiles(
+                sorted(self._project_tiles)[:PROJECT_TILES_PER_IDLE])
+        if self._project is None:
+            self._project_idle = None
+            return False
+        return True
+
+    def _create_layers(self):
+        """Create the layers of a new drawing, or the ones of the project
+        being loaded, with the bottom one white."""
+        self.layers = LayerStack(self._width, self._height)
+        project_layers = []
+        if self._project is not None:
+            project_layers = self._project.layers
+        for number in range(max(1, len(project_layers))):
+            self.layers.add(_('Layer %d') % number, number)
+        background = self.layers[0]
+        background.name = _('Background')
+        ctx = cairo.Context(background.surface)
+        ctx.set_source_rgb(1.0, 1.0, 1.0)
         ctx.paint()
+        for layer, project_layer in zip(self.layers, project_layers):
+            layer.name = project_layer.name
+            layer.opacity = project_layer.opacity
+            layer.visible = project_layer.visible
+            if project_layer.composite_op in layers.BLEND_MODES:
+                layer.blend_mode = project_layer.composite_op
+        self.layers.set_active(len(self.layers) - 1)
+        # the current Undo/Redo list is used by the active layer
+        self.layers.get_active().undo_list = self._undo_list
+        self.layers.get_active().undo_index = self._undo_index
+
+    def _activate_layer(self):
+        """Draw in the active layer, with its Undo/Redo list."""
+        layer = self.layers.get_active()
+        self.drawing_canvas = layer.surface
+        self.drawing_ctx = cairo.Context(self.drawing_canvas)
+        if layer.undo_list is None:
+            layer.undo_list = UndoHistory(
+                os.path.join(get_activity_root(), 'instance'))
+        self._undo_list = layer.undo_list
+        self._undo_index = layer.undo_index
+        if self._undo_index is None and self._project is None:
+            # the first step of the layer
+            self.enable_undo()
+        self._regions.invalidate()
+
+    def _layers_changed(self):
+        if self._tile_store is not None:
+            # the store has only the active layer
+            self._tile_store.mark_dirty()
+        self._init_temp_canvas()
+        if self._pyramid is not None:
+            self._pyramid.invalidate()
+        self.queue_draw()
+        self.emit('layers-changed')
+
+    def _prepare_layer_change(self):
+        # apply the pending changes to the active layer
+        self.finish_loading()
+        if self.is_selected():
+            self.getout()
+        if self.text_in_progress:
+            self.d.text(self, 0, 0)
+        if self._keep_undo:
+            self.keep_undo()
+        layer = self.layers.get_active()
+        layer.undo_index = self._undo_index
+
+    def is_background_layer(self):
+        return self.layers is None or self.layers.active == 0
+
+    def set_active_layer(self, index):
+        """Paint with the tools in the layer at index."""
+        if index == self.layers.active:
+            return
+        self._prepare_layer_change()
+        self.layers.set_active(index)
+        self._activate_layer()
+        self._layers_changed()
+
+    def add_layer(self):
+        """Add a transparent layer above the active one and activate it.
+        """
+        self._prepare_layer_change()
+        layer = self.layers.add(_('Layer %d') % len(self.layers))
+        self.layers.set_active(self.layers.index(layer))
+        self._activate_layer()
+        self._layers_changed()
+        self.memory.enforce()
+
+    def remove_layer(self, index=None):
+        """Remove the layer at index, the active one if None, with its
+        Undo/Redo list. The last layer is not removed."""
+        if len(self.layers) == 1:
+            return
+        if index is None:
+            index = self.layers.active
+        self._prepare_layer_change()
+        was_active = index == self.layers.active
+        layer = self.layers.remove(index)
+        if layer.undo_list is not None:
+            layer.undo_list.truncate(0)
+        if was_active:
+            self._activate_layer()
+        self._layers_changed()
+
+    def move_layer(self, index, new_index):
+        """Move the layer at index to new_index, 0 is the bottom."""
+        self.finish_loading()
+        self.layers.move(index, new_index)
+        self._layers_changed()
+
+    def set_layer_opacity(self, index, opacity):
+        self.layers.set_opacity(index, opacity)
+        self._layers_changed()
+
+    def set_layer_visible(self, index, visible):
+        self.layers.set_visible(index, visible)
+        self._layers_changed()
+
+    def set_layer_blend_mode(self, index, blend_mode):
+        self.layers.set_blend_mode(index, blend_mode)
+        self._layers_changed()
+
+    def get_flattened(self):
+        """Return a new cairo.ImageSurface with all the layers."""
+        self.finish_loading()
+        return self.layers.flatten()
 
     def setup(self, width, height):
         """Configure the Area object."""
 
         logging.debug('Area.setup: w=%s h=%s', width, height)
 
-        self.set_size_request(width, height)
+        self.set_size_request(int(width * self._zoom),
+                              int(height * self._zoom))
 
         self.drawing_canvas = None
+        self._pyramid = None
         self._width = width
         self._height = height
+        if self._recorder is not None:
+            self._recorder.record_canvas(width, height)
 
-        self.enable_undo()
+        if self._project is None:
+            # else the first step is kept when the project is painted
+            self.enable_undo()
 
         # Setting a initial tool
         self.set_tool(self.tool)
@@ -321,19 +561,80 @@ class Area(Gtk.DrawingArea):
         return True
 
     def get_size(self):
+        """Return the size of the canvas, not scaled by the zoom."""
+        if self._zoom != 1.0:
+            return self._width, self._height
         rect = self.get_allocation()
         return rect.width, rect.height
 
+    def get_zoom(self):
+        return self._zoom
+
+    def set_zoom(self, zoom):
+        """Show the canvas scaled by zoom, from MIN_ZOOM to MAX_ZOOM."""
+        zoom = max(MIN_ZOOM, min(MAX_ZOOM, zoom))
+        if zoom == self._zoom:
+            return
+        logging.debug('Area.set_zoom %s', zoom)
+        self._zoom = zoom
+        self.set_size_request(int(self._width * zoom),
+                              int(self._height * zoom))
+        self.queue_draw()
+
+    def to_canvas(self, x, y):
+        """Return the position in the canvas of the point x, y of the
+        widget."""
+        return x / self._zoom, y / self._zoom
+
+    def queue_draw_area(self, x, y, width, height):
+        """Paint again the rectangle of the canvas, in the coordinates of
+        the canvas."""
+        if self._pyramid is not None:
+            # the tools paint in the canvas what they show
+            self._pyramid.invalidate((x, y, width, height))
+        if self._zoom != 1.0:
+            x1 = int(math.floor(x * self._zoom))
+            y1 = int(math.floor(y * self._zoom))
+            x2 = int(math.ceil((x + width) * self._zoom))
+            y2 = int(math.ceil((y + height) * self._zoom))
+            x, y, width, height = x1, y1, x2 - x1, y2 - y1
+        Gtk.DrawingArea.queue_draw_area(self, x, y, width, height)
+
+    def _paint_zoomed_out(self, context):
+        """Paint the layers from the reduced copy nearest to the zoom,
+        return False if the zoom needs the full size layers."""
+        if self._pyramid is None:
+            self._pyramid = MipmapPyramid(self._width, self._height,
+                                          self.layers.paint)
+        level = self._pyramid.get_level(self._zoom)
+        if level is None:
+            return False
+        surface, scale = level
+        context.save()
+        context.scale(1.0 / scale, 1.0 / scale)
+        context.set_source_surface(surface)
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        context.paint()
+        context.restore()
+        return True
+
     def _init_temp_canvas(self, area=None):
-        # logging.error('init_temp_canvas. area %s', area)
-        # self.drawing_canvas.flush()
+        """Copy the drawing canvas over the temp canvas.
+
+            @param  area -- the Gdk.Rectangle to copy, or None to copy
+                            all the canvas
+        """
+        self.temp_ctx.save()
+        self.temp_ctx.new_path()
         if area is None:
             width, height = self.get_size()
             self.temp_ctx.rectangle(0, 0, width, height)
         else:
             self.temp_ctx.rectangle(area.x, area.y, area.width, area.height)
         self.temp_ctx.set_source_surface(self.drawing_canvas)
-        self.temp_ctx.paint()
+        self.temp_ctx.set_operator(cairo.OPERATOR_SOURCE)
+        self.temp_ctx.fill()
+        self.temp_ctx.restore()
 
     def display_selection_border(self, ctx):
         if not self.is_selected():
@@ -376,15 +677,6 @@ class Area(Gtk.DrawingArea):
 
         ctx.restore()
 
-    def configure_line(self, size):
-        """Configure the new line's size.
-
-            @param  self -- the Area object (GtkDrawingArea)
-            @param  size -- the size of the new line
-
-        """
-        self.drawing_ctx.set_line_width(size)
-
     def draw(self, widget, context):
         """ This function define which canvas will be showed to the user.
             Show up the Area object (GtkDrawingArea).
@@ -395,18 +687,20 @@ class Area(Gtk.DrawingArea):
 
         """
 
+        start = time.time()
+        widget_matrix = context.get_matrix()
+
         # It is the main canvas, who is display most of the time
         # if is not None was read from a file
         if self.drawing_canvas is None:
-            self.drawing_canvas = context.get_target().create_similar(
-                cairo.CONTENT_COLOR_ALPHA, self._width, self._height)
-            self.drawing_ctx = cairo.Context(self.drawing_canvas)
-            # paint background white
-            self.drawing_ctx.rectangle(0, 0, self._width, self._height)
-            if self.drawing_canvas_data is None:
-                self.drawing_ctx.set_source_rgb(1.0, 1.0, 1.0)
-                self.drawing_ctx.fill()
-            else:
+            # the layers are image surfaces, to be able to modify the
+            # pixels in place, kept if the size was not changed
+            if self.layers is None or \
+                    (self.layers.width, self.layers.height) != \
+                    (self._width, self._height):
+                self._create_layers()
+            self._activate_layer()
+            if self.drawing_canvas_data is not None:
                 self.drawing_ctx.set_source_surface(self.drawing_canvas_data)
                 self.drawing_ctx.paint()
                 self.drawing_canvas_data = None
@@ -417,22 +711,52 @@ class Area(Gtk.DrawingArea):
             self.temp_ctx = cairo.Context(self.temp_canvas)
             self._init_temp_canvas()
 
-        if self.desenha:
-            # logging.error('Expose use temp canvas area')
-            # Paint the canvas in the widget:
-            context.set_source_surface(self.temp_canvas)
-            context.paint()
-        else:
-            # logging.error('Expose use drawing canvas area')
-            context.set_source_surface(self.drawing_canvas)
-            context.paint()
-            self.show_tool_shape(context)
-        # TODO: gtk3 how get the area to avoid redrawing all ?
-        self._init_temp_canvas()  # area)
-        self.display_selection_border(context)
+        # all the painting is done in the coordinates of the canvas
+        context.scale(self._zoom, self._zoom)
+        # the pixels are shown as squares when zoomed in
+        pattern_filter = cairo.FILTER_NEAREST if self._zoom > 1 else None
+
+        # the area queued to draw, the painting is clipped to it and
+        # only that part of the temp canvas was modified by the tools
+        exposed, area = Gdk.cairo_get_clip_rectangle(context)
+        if exposed and self._project is not None:
+            # decode first the tiles shown
+            self._paint_project_tiles(self._project_tiles.intersection(
+                tiles.get_tiles_in_area(
+                    self._width, self._height,
+                    (area.x, area.y, area.width, area.height),
+                    self._project.tile_size)))
+            if self._project is not None and self._project_idle is None:
+                self._project_idle = GObject.idle_add(
+                    self.__project_idle_cb)
+        if exposed:
+            if self._filter_preview is not None:
+                context.push_group()
+                context.set_source_surface(self.drawing_canvas)
+                context.paint()
+                self._filter_preview.paint(context)
+                self.layers.paint(context, context.pop_group())
+            elif self.desenha:
+                # Paint the canvas in the widget:
+                self.layers.paint(context, self.temp_canvas, pattern_filter)
+            else:
+                if self._zoom >= 1.0 or not self._paint_zoomed_out(context):
+                    self.layers.paint(context, None, pattern_filter)
+                self.show_tool_shape(context)
+            self._init_temp_canvas(area)
+            self.display_selection_border(context)
         if self._keep_undo:
             self.keep_undo()
 
+        seconds = time.time() - start
+        self.latency.add('draw', self.tool['name'], seconds)
+        self.latency.add_frame(seconds)
+        if self._latency_overlay:
+            context.set_matrix(widget_matrix)
+            sizes = self.get_undo_memory_sizes()
+            self.latency.paint_overlay(context,
+                                       sizes['raw'] + sizes['compressed'])
+
     def show_tool_shape(self, context):
         """
         Show the shape of the tool selected for pencil, brush,
@@ -466,13 +790,125 @@ class Area(Gtk.DrawingArea):
                 self.last_x_cursor = self.x_cursor
                 self.last_y_cursor = self.y_cursor
 
+    def _add_memory_sources(self):
+        surface_bytes = memory.get_surface_bytes
+        self.memory.add_source(memory.CANVAS, self._get_canvas_bytes)
+        self.memory.add_source(
+            memory.TEMP, lambda: self._width * self._height * 4
+            if self.temp_canvas is not None else 0)
+        self.memory.add_source(memory.TEMP, self.d.get_stroke_bytes)
+        self.memory.add_source(
+            memory.TRANSIENT, lambda: surface_bytes(self.drawing_canvas_data))
+        self.memory.add_source(
+            memory.SELECTION, lambda: surface_bytes(self.selection_surface) +
+            surface_bytes(self.selection_resized_surface))
+        self.memory.add_source(
+            memory.STAMP, lambda: surface_bytes(self.pixbuf_stamp) +
+            surface_bytes(self.resized_stamp))
+        self.memory.add_source(memory.UNDO, self._get_undo_bytes,
+                               self._release_undo_memory)
+        self.memory.add_source(
+            memory.CACHE, lambda: self.layers.get_cache_bytes()
+            if self.layers is not None else 0,
+            lambda size: self.layers.release_caches())
+        self.memory.add_source(
+            memory.CACHE, lambda: self._pyramid.get_bytes()
+            if self._pyramid is not None else 0,
+            lambda size: self._pyramid.release())
+        self.memory.add_source(memory.CACHE, self._regions.get_bytes,
+                               lambda size: self._regions.invalidate())
+        self.memory.add_source(
+            memory.PREVIEW, lambda: self._filter_preview.get_bytes()
+            if self._filter_preview is not None else 0,
+            lambda size: self._filter_preview.release())
+
+    def _get_canvas_bytes(self):
+        if self.layers is None:
+            return memory.get_surface_bytes(self.drawing_canvas)
+        return sum(memory.get_surface_bytes(layer.surface)
+                   for layer in self.layers)
+
+    def _get_undo_lists(self):
+        """Return the Undo/Redo lists of all the layers."""
+        undo_lists = [self._undo_list]
+        if self.layers is not None:
+            undo_lists.extend(layer.undo_list for layer in self.layers
+                              if layer.undo_list is not None and
+                              layer.undo_list is not self._undo_list)
+        return undo_lists
+
+    def _get_undo_bytes(self):
+        total = 0
+        for undo_list in self._get_undo_lists():
+            sizes = undo_list.get_sizes()
+            total += sizes['raw'] + sizes['compressed']
+        return total
+
+    def _release_undo_memory(self, size):
+        for undo_list in self._get_undo_lists():
+            size -= undo_list.release_memory(size)
+            if size <= 0:
+                break
+
+    def get_memory_usage(self):
+        """Return the bytes used by every category of surfaces, see
+        memory.CATEGORIES."""
+        return self.memory.get_usage()
+
+    def get_latency_stats(self):
+        """Return the times of the operations by tool and the rates of
+        frames and events, see latency.LatencyMonitor.get_stats()."""
+        return self.latency.get_stats()
+
+    def log_latency_stats(self):
+        for line in self.latency.format_stats():
+            logging.debug('Area latency: %s', line)
+
+    def reset_latency_stats(self):
+        self.latency.reset()
+
+    def set_latency_overlay(self, enabled):
+        """Show or hide the frame time, the rates of events and the
+        memory of the undo list over the canvas."""
+        self._latency_overlay = enabled
+        if enabled and self._overlay_timer is None:
+            self._overlay_timer = GObject.timeout_add(
+                500, self.__overlay_timer_cb)
+        elif not enabled and self._overlay_timer is not None:
+            GObject.source_remove(self._overlay_timer)
+            self._overlay_timer = None
+        Gtk.DrawingArea.queue_draw_area(self, *OVERLAY_RECT)
+
+    def __overlay_timer_cb(self):
+        # the overlay is in pixels of the widget, not of the canvas
+        Gtk.DrawingArea.queue_draw_area(self, *OVERLAY_RECT)
+        return True
+
+    def start_recording(self, file_path):
+        """Write the input received from now to file_path, to replay it
+        with recording.SessionReplayer."""
+        self.stop_recording()
+        self._recorder = EventRecorder(file_path)
+        if self.drawing_canvas is not None:
+            self._recorder.record_canvas(*self.get_size())
+        self._recorder.record_tool(self.tool)
+        logging.debug('Area: recording the input in %s', file_path)
+
+    def stop_recording(self):
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+
     def __event_cb(self, widget, event):
+        if self._filter_job is not None:
+            # the canvas is replaced when the effect is done
+            return
         if event.type in (Gdk.EventType.TOUCH_BEGIN,
                           Gdk.EventType.TOUCH_CANCEL, Gdk.EventType.TOUCH_END,
                           Gdk.EventType.BUTTON_PRESS,
                           Gdk.EventType.BUTTON_RELEASE):
-            x = int(event.get_coords()[1])
-            y = int(event.get_coords()[2])
+            x = event.get_coords()[1]
+            y = event.get_coords()[2]
             # seq = str(event.touch.sequence)
 
             # logging.error('event x %d y %d type %s', x, y, event.type)
@@ -486,12 +922,18 @@ class Area(Gtk.DrawingArea):
                 else:
                     self._on_touch = True
                     button1_pressed = True
-                self.tool_start(x, y, button1_pressed)
+                # the pending movements happened before the press
+                self.flush_motion()
+                x, y = self.to_canvas(x, y)
+                if self._recorder is not None:
+                    self._recorder.record_press(x, y, button1_pressed,
+                                                self.tool)
+                self.tool_start(int(x), int(y), button1_pressed)
             elif event.type in (Gdk.EventType.TOUCH_END,
                                 Gdk.EventType.BUTTON_RELEASE):
-                # set _update_timer = None to avoid executing
-                # toolmove code after mouse release or touch end
-                self._update_timer = None
+                # move the tool over the pending positions now, to
+                # not execute toolmove code after mouse release or touch end
+                self.flush_motion()
 
                 if not self._tool_sound['full_play']:
                     self.stop_sound()
@@ -502,10 +944,15 @@ class Area(Gtk.DrawingArea):
                 else:
                     self._on_touch = False
                     shift_pressed = False
-                GObject.timeout_add(10, self.tool_end, x, y, shift_pressed)
+                x, y = self.to_canvas(x, y)
+                if self._recorder is not None:
+                    self._recorder.record_release(x, y, shift_pressed)
+                GObject.timeout_add(10, self.tool_end, int(x), int(y),
+                                    shift_pressed)
 
+    @timed('tool_start')
     def tool_start(self, coord_x, coord_y, button1_pressed):
-        width, height = self.get_size()
+        self.finish_loading()
         # text
         design_mode = True
         if self.tool['name'] == 'text':
@@ -529,11 +976,6 @@ class Area(Gtk.DrawingArea):
             self.text_in_progress = False
             self.activity.textview.hide()
 
-        coords = (coord_x, coord_y)
-        if not self._selresize:
-            # if resizing don't update to remember previous resize
-            self.oldx, self.oldy = coords
-
         if self.tool['name'] == 'picker':
             self.pick_color(coord_x, coord_y)
 
@@ -543,101 +985,17 @@ class Area(Gtk.DrawingArea):
                     'play_after_release'] and not self.tool[
                     'name'] in IGNORE_AUTO_PLAY:
                 self.play_tool_sound()
-            if self.tool['name'] == 'eraser':
-                self.last = []
-                self.d.eraser(self, coords, self.last)
-                self.last = coords
-                self.drawing = True
-            elif self.tool['name'] == 'brush':
-                self.last = []
-                self.d.brush(self, coords, self.last)
-                self.last = coords
-                self.drawing = True
-            elif self.tool['name'] == 'kalidoscope':
-                self.last = []
-                self.d.kalidoscope(self, coords, self.last)
-                self.last = coords
-                self.drawing = True
-            elif self.tool['name'] in ('stamp', 'load-stamp'):
-                self.last = []
-                self.d.stamp(self, coords, self.last)
-                self.last = coords
-                self.drawing = True
-            elif self.tool['name'] == 'rainbow':
-                self.last = []
-                self.d.rainbow(self, coords, self.last)
-                self.last = coords
-                self.drawing = True
-            elif self.tool['name'] == 'freeform':
-                self.configure_line(self.tool['line size'])
-                self.d.freeform(self, coords, True,
-                                self.tool['fill'], "motion")
-            if self.tool['name'] == 'marquee-rectangular':
-                if self.is_selected():
-                    # verify is out of the selected area
-                    sel_x, sel_y, sel_width, sel_height = \
-                        self.get_selection_bounds()
-                    if self.check_point_in_area(coords[0], coords[1],
-                                                sel_x, sel_y, sel_width,
-                                                sel_height):
-                        # be sure to have the last coords
-                        # because can be older if was resized before
-                        self.oldx, self.oldy = coords
-                        # inside the selected area
-                        self.d.move_selection(self, coords)
-                        self._selmove = True
-                        self._selresize = False
-                    elif self.check_point_in_area(coords[0], coords[1],
-                                                  sel_x + sel_width,
-                                                  sel_y + sel_height,
-                                                  RESIZE_ARROW_SIZE,
-                                                  RESIZE_ARROW_SIZE):
-                        # in de resize area
-                        self._selmove = False
-                        self._selresize = True
-                    else:
-                        self.end_selection()
-                        design_mode = False
-                else:
-                    self._selmove = False
-
-            if design_mode:
-                self.desenha = True
-
-    def end_selection(self):
-        if self.is_selected():
-            self.getout()
-            self._selmove = False
-            self._selresize = False
-            self.queue_draw()
 
-    def calculate_damaged_area(self, points):
-        min_x = points[0][0]
-        min_y = points[0][1]
-        max_x = 0
-        max_y = 0
-        for point in points:
-            if point[0] < min_x:
-                min_x = point[0]
-            if point[0] > max_x:
-                max_x = point[0]
-            if point[1] < min_y:
-                min_y = point[1]
-            if point[1] > max_y:
-                max_y = point[1]
-        # add the tool size
-        if self.tool['name'] in ('stamp', 'load-stamp'):
-            wr, hr = self.stamp_dimentions
-        elif self.tool['name'] == 'freeform':
-            wr = hr = 20
-        else:
-            wr = hr = self.tool['line size'] * 2
-        min_x = min_x - wr
-        min_y = min_y - wr
-        max_x = max_x + hr
-        max_y = max_y + hr
+        CanvasModel.tool_start(self, coord_x, coord_y, button1_pressed)
+        if not design_mode:
+            self.desenha = False
 
-        return (min_x, min_y, max_x - min_x, max_y - min_y)
+    def __realize_cb(self, widget):
+        # receive all the motion events, the tool_move calls are grouped
+        # by frame in flush_motion
+        window = self.get_window()
+        if hasattr(window, 'set_event_compression'):
+            window.set_event_compression(False)
 
     def mousemove(self, widget, event):
         """Make the Area object (GtkDrawingArea)
@@ -650,334 +1008,148 @@ class Area(Gtk.DrawingArea):
         if event.get_source_device().get_name().find('touchscreen') >= 0 and \
                 not self._on_touch:
             return
-        x = event.x
-        y = event.y
-        shift_pressed = event.get_state() & Gdk.ModifierType.SHIFT_MASK
-        button1_pressed = event.get_state() & Gdk.ModifierType.BUTTON1_MASK
-        if self._update_timer is None:
-            self._update_timer = GObject.timeout_add(5, self.tool_move, x, y,
-                                                     button1_pressed,
-                                                     shift_pressed)
-
-    def tool_move(self, x, y, button1_pressed, shift_pressed):
-
-        if self._update_timer is None:
-            return False
-        self._update_timer = None
-
-        self.x_cursor, self.y_cursor = int(x), int(y)
-
-        # the touch driver trigger many events sensing movements up and down
-        # by only a pixel. This code caches the last position and ignores
-        # the movement if is not bigger than one pixel to avoid redraws
-        if abs(x - self._last_x_touch) > 1 or \
-                abs(y > self._last_y_touch) > 1:
-            self._last_x_touch = x
-            self._last_y_touch = y
-        else:
+        if self._filter_job is not None:
             return
-
-        coords = int(x), int(y)
-        if self.tool['name'] in ['rectangle', 'ellipse', 'line']:
-            if shift_pressed or self.keep_shape_ratio:
-                if self.tool['name'] in ['rectangle', 'ellipse']:
-                    coords = self._keep_selection_ratio(coords)
-                elif self.tool['name'] == 'line':
-                    coords = self._keep_line_ratio(coords)
-
-        if button1_pressed:
-            if self.tool['name'] == 'eraser':
-                self.d.eraser(self, coords, self.last)
-                self.last = coords
-
-            elif self.tool['name'] == 'brush':
-                self.d.brush(self, coords, self.last)
-                self.last = coords
-
-            elif self.tool['name'] == 'kalidoscope':
-                self.d.kalidoscope(self, coords, self.last)
-                self.last = coords
-
-            elif self.tool['name'] in ('stamp', 'load-stamp'):
-                self.d.stamp(self, coords, self.last,
-                             self.tool['stamp size'])
-                self.last = coords
-
-            elif self.tool['name'] == 'rainbow':
-                self.d.rainbow(self, coords, self.last)
-                self.last = coords
-
-            if self.desenha:
-                if self.tool['name'] == 'line':
-                    self.d.line(self, coords, True)
-
-                elif self.tool['name'] == 'ellipse':
-                    self.d.circle(self, coords, True, self.tool['fill'])
-
-                elif self.tool['name'] == 'rectangle':
-                    self.d.square(self, coords, True,
-                                  self.tool['fill'])
-
-                elif self.tool['name'] == 'marquee-rectangular':
-                    if self._selmove:
-                        # is inside a selected area, move it
-                        self.d.move_selection(self, coords)
-                    elif self._selresize:
-                        self.d.resize_selection(self, coords)
-                    else:
-                        # create a selected area
-                        if shift_pressed or self.keep_aspect_ratio:
-                            coords = self._keep_selection_ratio(coords)
-                        self.d.selection(self, coords)
-
-                elif self.tool['name'] == 'freeform':
-                    self.configure_line(self.tool['line size'])
-                    self.d.freeform(self, coords, True,
-                                    self.tool['fill'], "motion")
-
-                elif self.tool['name'] == 'triangle':
-                    self.d.triangle(self, coords, True, self.tool['fill'])
-
-                elif self.tool['name'] == 'trapezoid':
-                    self.d.trapezoid(self, coords, True, self.tool['fill'])
-
-                elif self.tool['name'] == 'arrow':
-                    self.d.arrow(self, coords, True, self.tool['fill'])
-
-                elif self.tool['name'] == 'parallelogram':
-                    self.d.parallelogram(self, coords, True,
-                                         self.tool['fill'])
-
-                elif self.tool['name'] == 'star':
-                    self.d.star(self, coords, self.tool['vertices'],
-                                True, self.tool['fill'])
-
-                elif self.tool['name'] == 'polygon_regular':
-                    self.d.polygon_regular(self, coords,
-                                           self.tool['vertices'], True,
-                                           self.tool['fill'])
-
-                elif self.tool['name'] == 'heart':
-                    self.d.heart(self, coords, True, self.tool['fill'])
-        else:
-            if self.tool['name'] in ['brush', 'eraser', 'rainbow', 'pencil',
-                                     'stamp', 'load-stamp']:
-                # define area to update (only to show the brush shape)
-                last_coords = (self.last_x_cursor, self.last_y_cursor)
-                area = self.calculate_damaged_area([last_coords, coords])
-                self.queue_draw_area(*area)
-            if self.tool['name'] == 'marquee-rectangular':
-                sel_x, sel_y, sel_width, sel_height = \
-                    self.get_selection_bounds()
-                # show appropiate cursor
-                if self.check_point_in_area(coords[0], coords[1], sel_x, sel_y,
-                                            sel_width, sel_height):
-                    # inside the selected area
-                    cursor = Gdk.Cursor.new(Gdk.CursorType.FLEUR)
-                elif self.check_point_in_area(coords[0], coords[1],
-                                              sel_x + sel_width,
-                                              sel_y + sel_height,
-                                              RESIZE_ARROW_SIZE,
-                                              RESIZE_ARROW_SIZE):
-                    # in de resize area
-                    cursor = Gdk.Cursor.new(Gdk.CursorType.BOTTOM_RIGHT_CORNER)
-                else:
-                    cursor = Gdk.Cursor.new(Gdk.CursorType.CROSS)
-                self.get_window().set_cursor(cursor)
-
-            elif self.tool['name'] == 'freeform':
-                self.desenha = True
-                self.configure_line(self.tool['line size'])
-                self.d.freeform(self, coords, True, self.tool['fill'],
-                                "moving")
-
-        self.get_window().process_all_updates()
+        points = self._get_motion_history(event)
+        points.append((event.x, event.y))
+        self._motion_points.extend(points)
+        self.latency.add_events(len(points))
+        if self._recorder is not None:
+            self._recorder.record_motion(
+                [self.to_canvas(x, y) for x, y in points])
+        state = event.get_state()
+        self._motion_shift_pressed = state & Gdk.ModifierType.SHIFT_MASK
+        self._motion_button1_pressed = state & Gdk.ModifierType.BUTTON1_MASK
+        if self._motion_tick is None:
+            self._motion_tick = self.add_tick_callback(
+                self.__motion_tick_cb, None)
+
+    def _get_motion_history(self, event):
+        """Return the positions reported by the device between the previous
+        motion event and event, and not delivered as events."""
+        previous_time = self._motion_time
+        self._motion_time = event.time
+        if previous_time is None or event.time - previous_time < 2:
+            return []
+        device = event.get_device()
+        try:
+            result = device.get_history(event.window, previous_time + 1,
+                                        event.time - 1)
+        except (AttributeError, TypeError):
+            return []
+        if not result[0]:
+            return []
+        points = []
+        for coord in result[1]:
+            # the axes are in the order of the device, not always x, y
+            try:
+                has_x, x = device.get_axis(coord.axes, Gdk.AxisUse.X)
+                has_y, y = device.get_axis(coord.axes, Gdk.AxisUse.Y)
+            except (AttributeError, TypeError):
+                return []
+            if has_x and has_y:
+                points.append((x, y))
+        return points
+
+    def __motion_tick_cb(self, widget, frame_clock, data):
+        self._motion_tick = None
+        self.flush_motion()
         return False
 
-    def check_point_in_area(self, x_point, y_point, x_min, y_min,
-                            width, height):
-        return not ((x_point < x_min) or (x_point > x_min + width) or
-                    (y_point < y_min) or (y_point > y_min + height))
-
-    def tool_end(self, coord_x, coord_y, shift_pressed):
-        coords = (coord_x, coord_y)
-        if self.tool['name'] in ['rectangle', 'ellipse', 'line']:
-            if shift_pressed or self.keep_shape_ratio:
-                if self.tool['name'] in ['rectangle', 'ellipse']:
-                    coords = self._keep_selection_ratio(coords)
-                if self.tool['name'] == 'line':
-                    coords = self._keep_line_ratio(coords)
-
-        width, height = self.get_size()
-
-        private_undo = False
-        if self.desenha:
-            if self.tool['name'] == 'line':
-                self.d.line(self, coords, False)
-
-            elif self.tool['name'] == 'ellipse':
-                self.d.circle(self, coords, False, self.tool['fill'])
-
-            elif self.tool['name'] == 'rectangle':
-                self.d.square(self, coords, False, self.tool['fill'])
-
-            elif self.tool['name'] == 'marquee-rectangular':
-                private_undo = True
-                if self.is_selected() and not self._selmove and \
-                        not self._selresize:
-                    self.create_selection_surface()
-                    self.emit('select')
-                else:
-                    self.apply_temp_selection()
-
-            elif self.tool['name'] == 'freeform':
-                self.d.freeform(self, coords, False,
-                                self.tool['fill'], 'release')
-                private_undo = True
-
-            elif self.tool['name'] == 'bucket':
-                self.get_window().set_cursor(Gdk.Cursor.new(
-                    Gdk.CursorType.WATCH))
-                GObject.idle_add(self.flood_fill, coords[0], coords[1])
-
-            elif self.tool['name'] == 'triangle':
-                self.d.triangle(self, coords, False, self.tool['fill'])
-
-            elif self.tool['name'] == 'trapezoid':
-                self.d.trapezoid(self, coords, False, self.tool['fill'])
-
-            elif self.tool['name'] == 'arrow':
-                self.d.arrow(self, coords, False, self.tool['fill'])
-
-            elif self.tool['name'] == 'parallelogram':
-                self.d.parallelogram(self, coords, False, self.tool['fill'])
-
-            elif self.tool['name'] == 'star':
-                self.d.star(self, coords, self.tool['vertices'], False,
-                            self.tool['fill'])
-
-            elif self.tool['name'] == 'polygon_regular':
-                self.d.polygon_regular(self, coords, self.tool['vertices'],
-                                       False, self.tool['fill'])
-
-            elif self.tool['name'] == 'heart':
-                self.d.heart(self, coords, False, self.tool['fill'])
+    def flush_motion(self):
+        """Move the tool over the positions received since the last
+        frame."""
+        if self._motion_tick is not None:
+            self.remove_tick_callback(self._motion_tick)
+            self._motion_tick = None
+        points = [self.to_canvas(x, y) for x, y in self._motion_points]
+        if points:
+            self._motion_points = []
+            if self._recorder is not None:
+                self._recorder.record_flush(self._motion_button1_pressed,
+                                            self._motion_shift_pressed)
+            self.tool_move(points, self._motion_button1_pressed,
+                           self._motion_shift_pressed)
+
+    @timed('tool_move')
+    def tool_move(self, points, button1_pressed, shift_pressed):
+        """Move the tool.
+
+            @param  points -- list of positions (x, y) of the pointer,
+                              oldest first
+        """
+        moved = CanvasModel.tool_move(self, points, button1_pressed,
+                                      shift_pressed)
+        if len(moved) < len(points):
+            self.latency.add_events(0, len(points) - len(moved))
+        if not moved:
+            return
 
-            if self._sounds_enabled and self._tool_sound[
-                    'play_after_release'] and not self.tool[
-                    'name'] in IGNORE_AUTO_PLAY:
-                self.play_tool_sound()
-        else:
-            if self.tool['name'] == 'marquee-rectangular':
-                if self.is_selected():
-                    self.getout()
+        self.x_cursor, self.y_cursor = moved[-1]
+        if button1_pressed:
+            return
 
+        coords = self.keep_shape_ratio_of(moved[-1], shift_pressed)
         if self.tool['name'] in ['brush', 'eraser', 'rainbow', 'pencil',
                                  'stamp', 'load-stamp']:
-            self.last = []
-            self.d.finish_trace(self)
-            self.drawing = False
-        if not private_undo and \
-                self.tool['name'] not in ['bucket', 'marquee-rectangular']:
-            # We have to avoid saving an undo state if the bucket tool
-            # is selected because this undo state is called before the
-            # GObject.idle_add (with the fill_flood function) finishes
-            # and an unconsistent undo state is saved
-            self.enable_undo()
-        if self.tool['name'] not in ('marquee-rectangular', 'freeform'):
-            self.desenha = False
-
-        self.queue_draw()
-        self.d.clear_control_points()
-
-    def flood_fill(self, x, y):
-        bucket_color = self.tool['bucket_color']
-        r, g, b = bucket_color[0], bucket_color[1], bucket_color[2]
-
-        # pack the color in a int as 0xAARRGGBB
-        fill_color = 0xff000000 + (int(r / 255 * 65536) +
-                                   int(g / 255 * 256) +
-                                   int(b / 255))
-        logging.error('fill_color %d', fill_color)
-
-        # load a array with the surface data
-        for array_type in ['H', 'I', 'L']:
-            pixels = array.array(array_type)
-            if pixels.itemsize == 4:
-                _array_type_used = array_type
-                break
-        else:
-            raise AssertionError()
-        # need copy self.drawing_canvas in a ImageSurface
-        # because 'cairo.XlibSurface do not have get_data
-        image_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self._width,
-                                           self._height)
-        ctx = cairo.Context(image_surface)
-        ctx.set_source_surface(self.drawing_canvas)
-        ctx.paint()
-
-        pixels.fromstring(image_surface)
-
-        # process the pixels in the array
-        width = self.drawing_canvas.get_width()
-        height = self.drawing_canvas.get_height()
-
-        old_color = pixels[x + y * width]
-        if old_color == fill_color:
-            logging.debug('Already filled')
-            # reset the cursor
-            display = Gdk.Display.get_default()
-            cursor = Gdk.Cursor.new_from_name(display, 'paint-bucket')
+            # define area to update (only to show the brush shape)
+            last_coords = (self.last_x_cursor, self.last_y_cursor)
+            area = self.calculate_damaged_area([last_coords, coords])
+            self.queue_draw_area(*area)
+        if self.tool['name'] == 'marquee-rectangular':
+            sel_x, sel_y, sel_width, sel_height = \
+                self.get_selection_bounds()
+            # show appropiate cursor
+            if self.check_point_in_area(coords[0], coords[1], sel_x, sel_y,
+                                        sel_width, sel_height):
+                # inside the selected area
+                cursor = Gdk.Cursor.new(Gdk.CursorType.FLEUR)
+            elif self.check_point_in_area(coords[0], coords[1],
+                                          sel_x + sel_width,
+                                          sel_y + sel_height,
+                                          RESIZE_ARROW_SIZE,
+                                          RESIZE_ARROW_SIZE):
+                # in de resize area
+                cursor = Gdk.Cursor.new(Gdk.CursorType.BOTTOM_RIGHT_CORNER)
+            else:
+                cursor = Gdk.Cursor.new(Gdk.CursorType.CROSS)
             self.get_window().set_cursor(cursor)
-            return
-
-        if FALLBACK_FILL:
-            logging.debug('using python flood_fill')
 
-            def within(x, y):
-                if x < 0 or x >= width:
-                    return False
-                if y < 0 or y >= height:
-                    return False
-                return True
-
-            if not within(x, y):
-                return
-            edge = [(x, y)]
+    @timed('tool_end')
+    def tool_end(self, coord_x, coord_y, shift_pressed):
+        play_sound = self.desenha and self._sounds_enabled and \
+            self._tool_sound['play_after_release'] and \
+            not self.tool['name'] in IGNORE_AUTO_PLAY
+        CanvasModel.tool_end(self, coord_x, coord_y, shift_pressed)
+        if play_sound:
+            self.play_tool_sound()
 
-            pixels[x + y * width] = fill_color
+    def _selection_created(self):
+        self.emit('select')
 
-            while len(edge) > 0:
-                newedge = []
-                for (x, y) in edge:
-                    for (s, t) in ((x + 1, y), (x - 1, y), (x, y + 1),
-                                   (x, y - 1)):
-                        if within(s, t) and \
-                                pixels[s + t * width] == old_color:
-                            pixels[s + t * width] = fill_color
-                            newedge.append((s, t))
-                edge = newedge
+    def _end_freeform(self, coords):
+        freeform_command = Command(self, 'freeform', coords, False,
+                                   self.tool['fill'], 'release')
+        keep_undo = self._keep_undo
+        CanvasModel._end_freeform(self, coords)
+        if self._keep_undo and not keep_undo:
+            # the polygon was closed and painted
+            self._undo_command = freeform_command
 
-        else:
-            logging.debug('using c flood_fill')
-            pixels2 = fill(pixels, x, y, width, height, fill_color)
-            # the c implementation returns a list instead of array.array
-            pixels = array.array(_array_type_used, pixels2)
-            del(pixels2)
-
-        # create a updated drawing_canvas
-        self.drawing_canvas_data = cairo.ImageSurface.create_for_data(
-            pixels, cairo.FORMAT_ARGB32, width, height)
-        del(pixels)
-        self.setup(width, height)
+    def _queue_flood_fill(self, x, y):
+        self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
+        GObject.idle_add(self.flood_fill, x, y)
 
-        self.queue_draw()
-        self.enable_undo()
+    @timed('flood_fill')
+    def flood_fill(self, x, y):
+        CanvasModel.flood_fill(self, x, y)
 
+    def _end_flood_fill(self, filled):
+        if filled and self._sounds_enabled:
+            self.play_tool_sound()
+        # reset the cursor
         display = Gdk.Display.get_default()
         cursor = Gdk.Cursor.new_from_name(display, 'paint-bucket')
-        if self._sounds_enabled:
-            self.play_tool_sound()
         self.get_window().set_cursor(cursor)
 
     def pick_color(self, x, y):
@@ -1032,11 +1204,8 @@ class Area(Gtk.DrawingArea):
             if stamp:
                 self.pixbuf_stamp = GdkPixbuf.Pixbuf.new_from_file(stamp)
             elif self.is_selected() and not stamp:
-                pixbuf_data = StringIO.StringIO()
-                self.get_selection().write_to_png(pixbuf_data)
-                pxb_loader = GdkPixbuf.PixbufLoader.new_with_type('png')
-                pxb_loader.write(pixbuf_data.getvalue())
-                self.pixbuf_stamp = pxb_loader.get_pixbuf()
+                self.pixbuf_stamp = self._surface_to_pixbuf(
+                    self.get_selection())
             else:
                 return
 
@@ -1078,6 +1247,7 @@ class Area(Gtk.DrawingArea):
 
             @param  self -- the Area object (GtkDrawingArea)
         """
+        self.finish_loading()
         logging.debug('Area.undo(self)')
 
         if self.is_selected():
@@ -1091,9 +1261,7 @@ class Area(Gtk.DrawingArea):
         if self._undo_index > 0:
             self._undo_index -= 1
 
-        undo_surface = self._undo_list[self._undo_index]
-        self.drawing_ctx.set_source_surface(undo_surface, 0, 0)
-        self.drawing_ctx.paint()
+        self._restore_undo_step(self._undo_index)
         self.queue_draw()
 
         self.emit('undo')
@@ -1103,6 +1271,7 @@ class Area(Gtk.DrawingArea):
 
             @param  self -- the Area object (GtkDrawingArea)
         """
+        self.finish_loading()
         logging.debug('Area.redo(self)')
 
         if self.is_selected():
@@ -1110,52 +1279,137 @@ class Area(Gtk.DrawingArea):
 
         if self._undo_index < len(self._undo_list) - 1:
             self._undo_index += 1
-
-        undo_surface = self._undo_list[self._undo_index]
-        self.drawing_ctx.set_source_surface(undo_surface, 0, 0)
-        self.drawing_ctx.paint()
+            # the canvas has the previous step
+            self._restore_undo_step(self._undo_index, self._undo_index - 1)
+        else:
+            self._restore_undo_step(self._undo_index)
         self.queue_draw()
 
         self.emit('redo')
 
-    def enable_undo(self):
+    def get_undo_memory_sizes(self):
+        """Return the bytes used by the Undo/Redo list, as a dictionary
+        with the keys 'raw', 'compressed' and 'spilled' (on disk)."""
+        return self._undo_list.get_sizes()
+
+    def _restore_undo_step(self, index, current=None):
+        """Paint the canvas as it was after the step at index, restoring
+        the checkpoint before it and repeating the commands after.
+
+            @param  current -- index of the step shown in the canvas, if
+                               the commands can be repeated over it
+        """
+        checkpoint = self._undo_list.get_checkpoint(index)
+        if current is not None and checkpoint <= current < index:
+            first = current + 1
+        else:
+            undo_snapshot = self._undo_list[checkpoint]
+            if not undo_snapshot.restore(self.drawing_canvas):
+                # the canvas was rotated, paint the old content over it
+                self.drawing_ctx.set_source_surface(
+                    undo_snapshot.to_surface(), 0, 0)
+                self.drawing_ctx.paint()
+            first = checkpoint + 1
+        for step in range(first, index + 1):
+            self._undo_list[step].replay(self)
+        self.canvas_changed()
+
+    def enable_undo(self, command=None):
         """Save a flag to keep the last change in a list for Undo/Redo.
+
+            @param  command -- a commands.Command repeating the change,
+                               to keep it instead of the pixels
         """
+        self._set_undo_command(command)
+        self.canvas_changed()
+
+    def _set_undo_command(self, command):
+        if self._keep_undo:
+            # more than one change in the same step, keep the pixels
+            command = None
+        self._undo_command = command
         self._keep_undo = True
 
+    def canvas_changed(self, area=None):
+        """Notify the caches built from the drawing canvas that it was
+        modified.
+
+            @param  area -- the modified rectangle (x, y, width, height),
+                            or None if can be all the canvas
+        """
+        # any change can split or join the areas of the index
+        self._regions.invalidate()
+        if self._pyramid is not None:
+            self._pyramid.invalidate(area)
+        if self._tile_store is not None:
+            self._tile_store.mark_dirty(area)
+            if self._autosave_timer is None:
+                self._autosave_timer = GObject.timeout_add_seconds(
+                    tilestore.UPDATE_INTERVAL, self.__autosave_cb)
+
+    def set_tile_store(self, tile_store):
+        """Keep a copy of the canvas in a tilestore.TileStore, updated
+        with the modified tiles every tilestore.UPDATE_INTERVAL seconds.
+        """
+        self._tile_store = tile_store
+        if tile_store is None and self._autosave_timer is not None:
+            GObject.source_remove(self._autosave_timer)
+            self._autosave_timer = None
+
+    def autosave(self):
+        """Write the changes of the canvas to the tile store now.
+
+            @return  the version of the store, or None if there is not
+                     a store
+        """
+        if self._tile_store is None:
+            return None
+        # the store can not keep the layers, the drawing is recovered
+        # from the journal
+        if self.drawing_canvas is not None and self._project is None and \
+                len(self.layers) == 1:
+            try:
+                self._tile_store.update(self.drawing_canvas)
+            except (IOError, OSError), error:
+                logging.error('Area.autosave: %s', error)
+        return self._tile_store.version
+
+    def __autosave_cb(self):
+        self._autosave_timer = None
+        self.autosave()
+        return False
+
+    @timed('keep_undo')
     def keep_undo(self):
         """Keep the last change in a list for Undo/Redo commands.
         """
         self._keep_undo = False
+        command = self._undo_command
+        self._undo_command = None
         if len(self._undo_list) == 0:
             # first undo pix, start index:
             self._undo_index = 0
-        elif len(self._undo_list) == MAX_UNDO_STEPS:
-            # drop the oldest undo pix:
-            self._undo_list.pop(0)
-
-            # it could be at the middle of the list (clicked many
-            # times undo) and after that draw anything, so we should
-            # discart the next redos because they are obsolete now.
-            self._undo_list = self._undo_list[:self._undo_index]
         else:
             self._undo_index += 1
             # Forget the redos after this one:
-            self._undo_list = self._undo_list[:self._undo_index]
+            self._undo_list.truncate(self._undo_index)
 
         if self.is_selected():
             self.getout(clear_selection=False)
+            # the selection is painted in the canvas too
+            command = None
 
-        # copy the drawing surface in a new surface
-        width = self.drawing_canvas.get_width()
-        height = self.drawing_canvas.get_height()
-        undo_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-        undo_ctx = cairo.Context(undo_surface)
-        undo_ctx.set_source_surface(self.drawing_canvas, 0, 0)
-        undo_ctx.paint()
-        undo_surface.flush()
+        if command is not None and not self._undo_list.needs_checkpoint():
+            undo_step = command
+        else:
+            # keep a copy of the drawing surface, sharing the tiles
+            # not modified since the previous checkpoint
+            undo_step = tiles.Snapshot(self.drawing_canvas,
+                                       self._undo_list.get_last())
 
-        self._undo_list.append(undo_surface)
+        # the oldest steps are dropped when the history is too big
+        self._undo_index -= self._undo_list.append(undo_step)
+        self.memory.enforce()
 
         self.emit('action-saved')
 
@@ -1166,6 +1420,7 @@ class Area(Gtk.DrawingArea):
 
             @param  self -- the Area object (GtkDrawingArea)
         """
+        self.finish_loading()
         clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
 
         selection_surface = self.get_selection()
@@ -1188,6 +1443,7 @@ class Area(Gtk.DrawingArea):
 
             @param  self -- the Area object (GtkDrawingArea)
         """
+        self.finish_loading()
         width, height = self.get_size()
 
         clipBoard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
@@ -1288,45 +1544,139 @@ class Area(Gtk.DrawingArea):
             @param  self -- the Area object (GtkDrawingArea)
 
         """
+        self.finish_loading()
+        old_cursor = self.get_window().get_cursor()
+        self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
+        GObject.idle_add(self._invert_internal, old_cursor)
+
+    @timed('invert_colors')
+    def _invert_internal(self, old_cursor):
+        if self.is_selected():
+            x, y, width, height = self.get_selection_bounds()
+            surface = self.get_selection()
+            self._invert_surface(surface)
+            self.drawing_ctx.save()
+            self.drawing_ctx.translate(x, y)
+            self.drawing_ctx.set_source_surface(surface)
+            self.drawing_ctx.paint()
+            self.drawing_ctx.restore()
+            self.canvas_changed((x, y, width, height))
+            self.create_selection_surface()
+        else:
+            self._invert_surface(self.drawing_canvas)
 
-        def internal_invert(self, old_cursor):
-            # load a array with the surface data
-            for array_type in ['H', 'I', 'L']:
-                pixels = array.array(array_type)
-                if pixels.itemsize == 4:
-                    break
+        self.queue_draw()
+        if not self.is_selected():
+            self.enable_undo()
+        self.get_window().set_cursor(old_cursor)
+        return False
+
+    def start_filter_preview(self, chain):
+        """Show a chain of image effects applied over a reduced copy of
+        the selection if there is one or of all the canvas, until
+        apply_filters() or cancel_filter_preview() is called.
+
+            @param  self -- the Area object (GtkDrawingArea)
+            @param  chain -- a filters.FilterChain
+
+        """
+        self.finish_loading()
+        if self._filter_preview is None:
+            if self.is_selected():
+                x, y, _width, _height = self.get_selection_bounds()
+                surface = self.get_selection()
             else:
-                raise AssertionError()
-            # need copy self.drawing_canvas in a ImageSurface
-            # because 'cairo.XlibSurface do not have get_data
-            image_surface = cairo.ImageSurface(
-                cairo.FORMAT_ARGB32, self._width, self._height)
-            ctx = cairo.Context(image_surface)
-            ctx.set_source_surface(self.drawing_canvas)
-            ctx.paint()
+                x, y = 0, 0
+                surface = self.drawing_canvas
+            self._filter_preview = filters.FilterPreview(surface, x, y)
+        self.update_filter_preview(chain)
+        self.memory.enforce()
+
+    def update_filter_preview(self, chain):
+        """Show the preview again, with the new parameters in chain."""
+        if self._filter_preview is None:
+            return
+        self._filter_preview.render(chain)
+        self.queue_draw()
 
-            pixels.fromstring(image_surface)
+    def cancel_filter_preview(self):
+        if self._filter_preview is None or self._filter_job is not None:
+            # shown until the effect is applied
+            return
+        self._filter_preview = None
+        self.queue_draw()
 
-            # process the pixels in the array
-            new_array = array.array(pixels.typecode, len(pixels) * [0])
-            for i in range(len(pixels)):
-                new_array[i] = 0xffffffff - pixels[i] | 0xff000000
+    def apply_filters(self, widget, chain):
+        """Apply a chain of image effects, to the selection if there is
+        one or to all the canvas. The full size image is processed in a
+        background thread, emitting 'filter-progress', and the preview,
+        if any, is shown until it is done.
 
-            # create a updated drawing_canvas
-            width = self.drawing_canvas.get_width()
-            height = self.drawing_canvas.get_height()
-            self.drawing_canvas_data = cairo.ImageSurface.create_for_data(
-                new_array, cairo.FORMAT_ARGB32, width, height)
+            @param  self -- the Area object (GtkDrawingArea)
+            @param  widget -- the Area object (GtkDrawingArea)
+            @param  chain -- a filters.FilterChain
 
-            self.setup(width, height)
-            self.queue_draw()
+        """
+        self.finish_loading()
+        if self._filter_job is not None:
+            return
+        if self.is_selected():
+            surface = self.get_selection()
+        else:
+            surface = self.drawing_canvas
+        self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
+        self._filter_start = time.time()
+        self._filter_job = filters.FilterJob(
+            chain, surface, self.__filter_progress_cb, self.__filter_done_cb)
+        self._filter_job.start()
+
+    def __filter_progress_cb(self, fraction):
+        # called from the thread of the job
+        GObject.idle_add(self.emit, 'filter-progress', fraction)
+
+    def __filter_done_cb(self, job):
+        # called from the thread of the job
+        GObject.idle_add(self._finish_filters, job)
+
+    def _finish_filters(self, job):
+        if job is not self._filter_job:
+            return False
+        self._filter_job = None
+        self._filter_preview = None
+        surface = job.result
+        self.latency.add('filters', self.tool['name'],
+                         time.time() - self._filter_start)
+
+        if self.is_selected():
+            x, y, width, height = self.get_selection_bounds()
+            self.drawing_ctx.save()
+            self.drawing_ctx.translate(x, y)
+            self.drawing_ctx.set_source_surface(surface)
+            self.drawing_ctx.paint()
+            self.drawing_ctx.restore()
+            self.canvas_changed((x, y, width, height))
+            self.create_selection_surface()
+        else:
+            self.drawing_ctx.save()
+            self.drawing_ctx.set_operator(cairo.OPERATOR_SOURCE)
+            self.drawing_ctx.set_source_surface(surface)
+            self.drawing_ctx.paint()
+            self.drawing_ctx.restore()
+        # painted, the job is kept by the idle callback until it returns
+        job.result = None
+
+        self.queue_draw()
+        if not self.is_selected():
             self.enable_undo()
-            self.get_toplevel().get_window().set_cursor(old_cursor)
+        self.set_tool_cursor()
+        self.emit('filter-progress', 1.0)
+        return False
 
-        old_cursor = self.get_window().get_cursor()
-        self.get_toplevel().get_window().set_cursor(
-            Gdk.Cursor.new(Gdk.CursorType.WATCH))
-        GObject.idle_add(internal_invert, self, old_cursor)
+    def _invert_surface(self, surface):
+        # every channel of the premultiplied colors becomes alpha - value,
+        # the exact inverse of the colors of the translucent pixels too,
+        # done by tiles in parallel with the filters of the blobs
+        filters.Filter(filters.INVERT).apply(surface)
 
     def mirror(self, widget, horizontal=True):
         """Apply mirror horizontal/vertical effect.
@@ -1336,10 +1686,12 @@ class Area(Gtk.DrawingArea):
             @param  horizontal -- If true sets flip as horizontal else vertical
 
         """
+        self.finish_loading()
         old_cursor = self.get_window().get_cursor()
         self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
         GObject.idle_add(self._mirror_internal, widget, horizontal, old_cursor)
 
+    @timed('mirror')
     def _mirror_internal(self, widget, horizontal, old_cursor):
         """Mirror the image.
 
@@ -1398,26 +1750,27 @@ class Area(Gtk.DrawingArea):
         self.get_window().set_cursor(old_cursor)
 
     def _do_process(self, widget, apply_process):
+        self.finish_loading()
         self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
         GObject.idle_add(self._do_process_internal, widget, apply_process)
 
     def _surface_to_pixbuf(self, surface):
-        # copy from the surface to the pixbuf
-        pixbuf_data = StringIO.StringIO()
-        surface.write_to_png(pixbuf_data)
-        pxb_loader = GdkPixbuf.PixbufLoader.new_with_type('png')
-        pxb_loader.write(pixbuf_data.getvalue())
-        pxb_loader.close()
-        return pxb_loader.get_pixbuf()
+        # copy from the surface to the pixbuf, gdk converts the
+        # premultiplied BGRA pixels to RGBA in a single pass
+        return Gdk.pixbuf_get_from_surface(surface, 0, 0,
+                                           surface.get_width(),
+                                           surface.get_height())
 
     def _pixbuf_to_context(self, pixbuf, context, x=0, y=0):
-        # copy from the pixbuf to the drawing context
+        # copy from the pixbuf to the drawing context, gdk converts the
+        # RGBA pixels to premultiplied BGRA in a single pass
         context.save()
         context.translate(x, y)
         Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
         context.paint()
         context.restore()
 
+    @timed('process')
     def _do_process_internal(self, widget, apply_process):
 
         if self.is_selected():
@@ -1433,6 +1786,8 @@ class Area(Gtk.DrawingArea):
         temp_pix = apply_process(temp_pix)
 
         self._pixbuf_to_context(temp_pix, self.drawing_ctx, x, y)
+        self.canvas_changed((x, y, temp_pix.get_width(),
+                             temp_pix.get_height()))
         self.create_selection_surface()
 
         del temp_pix
@@ -1460,40 +1815,35 @@ class Area(Gtk.DrawingArea):
         self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
         GObject.idle_add(self._rotate, widget, 90)
 
+    @timed('rotate')
     def _rotate(self, widget, angle):
         """Rotate the image.
 
             @param  self -- the Area object (GtkDrawingArea)
             @param  widget -- the Area object (GtkDrawingArea)
         """
+        self.finish_loading()
         self.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
 
         if self.is_selected():
             x, y, width, height = self.get_selection_bounds()
             surface = self.get_selection()
-        else:
-            x, y = 0, 0
-            width, height = self.get_size()
-            surface = self.drawing_canvas
-
-        # create a surface and paste the image rotated
-        logging.error('create rotate surface')
-        rotate_surface = surface.create_similar(cairo.CONTENT_COLOR_ALPHA,
-                                                height, width)
-        rotate_ctx = cairo.Context(rotate_surface)
-        radians_angle = math.pi * float(angle) / 180.0
-        rotate_ctx.rotate(radians_angle)
-        if radians_angle > math.pi:
-            rotate_ctx.translate(-width, 0)
-        else:
-            rotate_ctx.translate(0, -height)
 
-        rotate_ctx.set_source_surface(surface)
-        rotate_ctx.paint()
+            # create a surface and paste the image rotated
+            logging.error('create rotate surface')
+            rotate_surface = surface.create_similar(
+                cairo.CONTENT_COLOR_ALPHA, height, width)
+            rotate_ctx = cairo.Context(rotate_surface)
+            radians_angle = math.pi * float(angle) / 180.0
+            rotate_ctx.rotate(radians_angle)
+            if radians_angle > math.pi:
+                rotate_ctx.translate(-width, 0)
+            else:
+                rotate_ctx.translate(0, -height)
 
-        # copy from the pixbuf to the drawing context
+            rotate_ctx.set_source_surface(surface)
+            rotate_ctx.paint()
 
-        if self.is_selected():
             # clear the background before rotate the selection
             self.clear_selection_background()
             self.clear_selection_background(temp_canvas=True)
@@ -1509,14 +1859,10 @@ class Area(Gtk.DrawingArea):
             self.selection_surface = rotate_surface
 
         else:
-            # create a new canvas with permuted dimensions
-            self.drawing_canvas_data = surface.create_similar(
-                cairo.CONTENT_COLOR_ALPHA, height, width)
-            ctx = cairo.Context(self.drawing_canvas_data)
-            ctx.save()
-            ctx.set_source_surface(rotate_surface)
-            ctx.paint()
-            ctx.restore()
+            # all the layers, with permuted dimensions
+            width, height = self.layers.width, self.layers.height
+            self.layers.rotate(angle)
+            self.layers.get_active().undo_index = self._undo_index
             self.setup(height, width)
 
         self.queue_draw()
@@ -1538,93 +1884,9 @@ class Area(Gtk.DrawingArea):
         """
         return self._undo_index < len(self._undo_list) - 1
 
-    def is_selected(self):
-        """
-        Return True if there is some thing selected
-        """
-        return self.get_selection_bounds() != (0, 0, 0, 0)
-
-    def clear_selection(self):
-        self.set_selection_bounds(0, 0, 0, 0)
-        self._selection_horizontal_scale = 1.0
-        self._selection_vertical_scale = 1.0
-        self.selection_resized_surface = None
-        self._selection_finished = False
-
-    def set_selection_bounds(self, x, y, width, height):
-        """
-            Set selection bounds
-            @param x, y, width, height - the rectangle to define the area
-        """
-        self._selection_bounds = (x, y, width, height)
-
-    def set_selection_start(self, x, y):
-        self._selection_bounds = (x, y, self._selection_bounds[2],
-                                  self._selection_bounds[3])
-
-    def get_selection_bounds(self):
-        """
-            @return x1, y1, width, height - the rectangle to define the area
-        """
-        x, y = self._selection_bounds[0], self._selection_bounds[1]
-        width, height = self._selection_bounds[2], self._selection_bounds[3]
-        width = width * self._selection_horizontal_scale
-        height = height * self._selection_vertical_scale
-        return (x, y, int(width), int(height))
-
-    def create_selection_surface(self, clear_background=True,
-                                 temp_canvas=False):
-        x, y, width, height = self.get_selection_bounds()
-        logging.error('create_selection_surface %s', (x, y, width, height))
-        self.selection_surface = cairo.ImageSurface(
-            cairo.FORMAT_ARGB32, width, height)
-        selection_ctx = cairo.Context(self.selection_surface)
-        selection_ctx.translate(-x, -y)
-        if not temp_canvas:
-            selection_ctx.set_source_surface(self.drawing_canvas)
-        else:
-            selection_ctx.set_source_surface(self.temp_canvas)
-        selection_ctx.paint()
-        self.selection_resized_surface = None
-        self._selection_finished = True
-        if clear_background:
-            self.pending_clean_selection_background = True
-
-    def clear_selection_background(self, temp_canvas=False):
-        # clear the selection background
-        x, y, width, height = self.get_selection_bounds()
-        if not temp_canvas:
-            ctx = self.drawing_ctx
-        else:
-            ctx = self.temp_ctx
-        ctx.save()
-        ctx.new_path()
-        ctx.rectangle(x, y, width, height)
-        ctx.set_source_rgb(1.0, 1.0, 1.0)
-        ctx.fill()
-        ctx.restore()
-
     def resize_selection_surface(self, horizontal_scale, vertical_scale,
                                  fast=True):
-        x, y = self._selection_bounds[0], self._selection_bounds[1]
-        new_width = int(self .selection_surface.get_width() * horizontal_scale)
-        new_height = int(self.selection_surface.get_height() * vertical_scale)
-
-        # create a surface with the selection scaled to the new size
-        self.selection_resized_surface = cairo.ImageSurface(
-            cairo.FORMAT_ARGB32, new_width, new_height)
-        temp_ctx = cairo.Context(self.selection_resized_surface)
-        temp_ctx.scale(horizontal_scale, vertical_scale)
-        temp_ctx.set_source_surface(self.selection_surface)
-        temp_ctx.paint()
-
-        # draw over temp canvas
-        self.temp_ctx.save()
-        self.temp_ctx.translate(x, y)
-        self.temp_ctx.set_source_surface(self.selection_resized_surface)
-        self.temp_ctx.rectangle(0, 0, new_width, new_height)
         if fast:
-            self.temp_ctx.get_source().set_filter(cairo.FILTER_NEAREST)
             # Add a timer for resize with high quality:
             if self._resize_hq_timer is not None:
                 GObject.source_remove(self._resize_hq_timer)
@@ -1633,49 +1895,43 @@ class Area(Gtk.DrawingArea):
                 vertical_scale, False)
         else:
             self._resize_hq_timer = None
-
-        self.temp_ctx.paint()
-        self.temp_ctx.restore()
-
-        self._selection_horizontal_scale = horizontal_scale
-        self._selection_vertical_scale = vertical_scale
-
-        self.desenha = True
-        self.queue_draw()
-
+        CanvasModel.resize_selection_surface(self, horizontal_scale,
+                                             vertical_scale, fast)
         return False
 
-    def get_selection(self):
-        if self.selection_resized_surface is not None:
-            return self.selection_resized_surface
-        if self.selection_surface is not None:
-            return self.selection_surface
-        else:
-            return None
-
-    def load_image(self, name, widget=None):
+    def load_image(self, name, widget=None, full_size=False):
         """Load an image.
 
             @param  self -- Area instance
             @param  name -- string (image file path)
             @param  widget -- GtkDrawingArea
+            @param  full_size -- if False the image is reduced to fit in
+                                 the canvas while decoded
 
         """
+        self.finish_loading()
         logging.debug('Area.load_image Loading file %s', name)
 
-        pixbuf = GdkPixbuf.Pixbuf.new_from_file(name)
-        self.load_pixbuf(pixbuf)
+        max_width, max_height = None, None
+        if not full_size:
+            max_width, max_height = self.get_size()
+        self._load_selection_surface(
+            loading.load_surface(name, max_width, max_height))
 
     def load_pixbuf(self, pixbuf):
         width, height = (int)(pixbuf.get_width()), (int)(pixbuf.get_height())
 
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self._pixbuf_to_context(pixbuf, cairo.Context(surface))
+        self._load_selection_surface(surface)
+
+    def _load_selection_surface(self, surface):
+        width, height = surface.get_width(), surface.get_height()
+
         logging.debug('image size %d x %d', width, height)
 
         # load in the selection surface
-        self.selection_surface = cairo.ImageSurface(
-            cairo.FORMAT_ARGB32, width, height)
-        selection_ctx = cairo.Context(self.selection_surface)
-        self._pixbuf_to_context(pixbuf, selection_ctx)
+        self.selection_surface = surface
 
         # show in the temp context too
         self.temp_ctx.save()
@@ -1698,6 +1954,7 @@ class Area(Gtk.DrawingArea):
         """ Clear Canvas
             @param self -- Area instance
         """
+        self.finish_loading()
         logging.debug('Area.clear')
         self.d.clear(self)
 
@@ -1714,6 +1971,8 @@ class Area(Gtk.DrawingArea):
         '''
         # logging.debug('Area.set_tool %s', tool)
         self.tool = tool
+        if self._recorder is not None:
+            self._recorder.record_tool(tool)
         try:
             if self.tool['line size'] is not None:
                 self.configure_line(self.tool['line size'])
@@ -1777,52 +2036,9 @@ class Area(Gtk.DrawingArea):
         if self.get_window() is not None:
             self.get_window().set_cursor(cursor)
 
-    def getout(self, undo=False, clear_selection=True):
-        """
-        Apply the selected area in the canvas.
-
-        @param - undo: enable undo
-        """
-
-        try:
-            # apply selection over canvas
-            if self.is_selected():
-                x, y, width, height = self.get_selection_bounds()
-                selection_surface = self.get_selection()
-                self.drawing_ctx.save()
-                self.drawing_ctx.translate(x, y)
-                self.drawing_ctx.set_source_surface(selection_surface)
-                self.drawing_ctx.rectangle(0, 0, width, height)
-                self.drawing_ctx.paint()
-                self.drawing_ctx.restore()
-                self.desenha = False
-
-                if clear_selection:
-                    self.clear_selection()
-                if undo:
-                    self.enable_undo()
-
-        except NameError, message:
-            logging.debug(message)
-        except Exception, message:
-            logging.debug('Unexpected error: %s', message)
-
-    def apply_temp_selection(self):
-        """
-        Apply the selected area in the temp canvas.
-        """
-        # apply selection over canvas
-        if self.is_selected():
-            x, y, width, height = self.get_selection_bounds()
-            selection_surface = self.get_selection()
-            self.temp_ctx.save()
-            self.temp_ctx.translate(x, y)
-            self.temp_ctx.set_source_surface(selection_surface)
-            self.temp_ctx.rectangle(0, 0, width, height)
-            self.temp_ctx.paint()
-            self.temp_ctx.restore()
-
     def key_press(self, widget, event):
+        if self._recorder is not None:
+            self._recorder.record_key(event.keyval, event.state)
         if event.keyval == Gdk.KEY_BackSpace:
             if self.is_selected():
                 # Remove selection
@@ -1872,34 +2088,6 @@ class Area(Gtk.DrawingArea):
             # TODO: clip
             self.queue_draw()
 
-    def _keep_selection_ratio(self, coords):
-
-        def sign(x):
-            return x and x / abs(x) or 0
-
-        dx = int(coords[0]) - self.oldx
-        dy = int(coords[1]) - self.oldy
-        size = max(abs(dx), abs(dy))
-
-        return (self.oldx + sign(dx) * size,
-                self.oldy + sign(dy) * size)
-
-    def _keep_line_ratio(self, coords):
-
-        def sign(x):
-            return x and x / abs(x) or 0
-
-        dx = int(coords[0]) - self.oldx
-        dy = int(coords[1]) - self.oldy
-        size = max(abs(dx), abs(dy))
-
-        if abs(dx) > 0.5 * size and abs(dy) > 0.5 * size:
-            return (self.oldx + sign(dx) * size, self.oldy + sign(dy) * size)
-        elif abs(dx) < 0.5 * size and abs(dy) > 0.5 * size:
-            return (self.oldx, self.oldy + sign(dy) * size)
-        elif abs(dx) > 0.5 * size and abs(dy) < 0.5 * size:
-            return (self.oldx + sign(dx) * size, self.oldy)
-
     def play_tool_sound(self):
         if not self._player:
             return
@@ -106,6 +106,14 @@ class Desenho:
         self._last_points_used = []
         self._last_point_drawn_index = 0
 
+        # the brush and eraser traces are painted segment by segment in
+        # this surface, with opaque color, and composited with the color
+        # alpha over the drawing canvas
+        self._stroke_surface = None
+        self._stroke_ctx = None
+        # x1, y1, x2, y2 painted in the stroke surface
+        self._stroke_bounds = None
+
     def clear_control_points(self):
         self._last_points_used = []
 
@@ -217,8 +225,12 @@ class Desenho:
         widget.drawing_ctx.save()
         widget.drawing_ctx.translate(dx, dy)
         widget.drawing_ctx.rectangle(dx, dy, width, height)
-        Gdk.cairo_set_source_pixbuf(widget.drawing_ctx, widget.resized_stamp,
-                                    0, 0)
+        if isinstance(widget.resized_stamp, cairo.Surface):
+            # the stamps of a canvas without Gtk, see canvas.Canvas
+            widget.drawing_ctx.set_source_surface(widget.resized_stamp, 0, 0)
+        else:
+            Gdk.cairo_set_source_pixbuf(widget.drawing_ctx,
+                                        widget.resized_stamp, 0, 0)
         widget.drawing_ctx.paint()
         widget.drawing_ctx.restore()
 
@@ -311,49 +323,144 @@ class Desenho:
 
     def finish_trace(self, widget):
         widget.desenha = False
-        shape = widget.tool['line shape']
-        rounded = (shape == 'circle')
-        self._draw_polygon(widget, False, False, self.points, False, rounded)
-        if not rounded and len(self.points) == 1:
-            # draw a square if the mouse was not moved
-            size = widget.tool['line size']
-            coords = self.points[0]
-            widget.drawing_ctx.save()
-            if widget.tool['name'] == 'eraser':
-                color = (1.0, 1.0, 1.0, 1.0)
-            else:
-                color = widget.tool['cairo_stroke_color']
-            widget.drawing_ctx.set_source_rgba(*color)
-            widget.drawing_ctx.move_to(coords[0] - size / 2,
-                                       coords[1] - size / 2)
-            widget.drawing_ctx.rectangle(coords[0] - size / 2,
-                                         coords[1] - size / 2, size, size)
-            widget.drawing_ctx.fill()
-            widget.drawing_ctx.restore()
+        if self.points:
+            if widget.replaying:
+                # repeated by a command, the segments were not painted
+                self._start_stroke(widget, self.points[0])
+                for last, coords in zip(self.points, self.points[1:]):
+                    self._stroke_segment(widget, coords, last)
+            if len(self.points) == 1:
+                # the mouse was not moved, paint a dot of the shape
+                self._stroke_dot(widget, self.points[0])
+            # the pixels painted by the preview are used, not stroked
+            # again
+            x1, y1, x2, y2 = self._stroke_bounds
+            area = (x1, y1, x2 - x1, y2 - y1)
+            self._composite_stroke(widget, widget.drawing_ctx, area)
+            widget.queue_draw_area(*area)
 
         self.points = []
         self._last_point_drawn_index = 0
 
     def _trace(self, widget, coords, last):
         widget.desenha = True
+
+        self.points.append((coords[0], coords[1]))
+        if not last:
+            self._start_stroke(widget, coords)
+            return
+
+        area = self._stroke_segment(widget, coords, last)
+
+        # compose the area in the temp canvas
+        temp_ctx = widget.temp_ctx
+        temp_ctx.save()
+        temp_ctx.new_path()
+        temp_ctx.rectangle(*area)
+        temp_ctx.clip()
+        temp_ctx.set_source_surface(widget.drawing_canvas)
+        temp_ctx.set_operator(cairo.OPERATOR_SOURCE)
+        temp_ctx.paint()
+        temp_ctx.restore()
+        self._composite_stroke(widget, temp_ctx, area)
+
+        widget.queue_draw_area(*area)
+
+    def _start_stroke(self, widget, coords):
+        width = widget.drawing_canvas.get_width()
+        height = widget.drawing_canvas.get_height()
+        if self._stroke_surface is None or \
+                self._stroke_surface.get_width() != width or \
+                self._stroke_surface.get_height() != height:
+            self._stroke_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                                      width, height)
+            self._stroke_ctx = cairo.Context(self._stroke_surface)
+        elif self._stroke_bounds is not None:
+            # clear the previous stroke
+            x1, y1, x2, y2 = self._stroke_bounds
+            self._stroke_ctx.save()
+            self._stroke_ctx.rectangle(x1, y1, x2 - x1, y2 - y1)
+            self._stroke_ctx.set_operator(cairo.OPERATOR_CLEAR)
+            self._stroke_ctx.fill()
+            self._stroke_ctx.restore()
+        x, y = coords
+        self._stroke_bounds = (x, y, x, y)
+
+        ctx = self._stroke_ctx
+        if widget.tool['line shape'] == 'circle':
+            ctx.set_line_cap(cairo.LINE_CAP_ROUND)
+        else:
+            ctx.set_line_cap(cairo.LINE_CAP_SQUARE)
+        ctx.set_line_width(widget.tool['line size'])
+        if widget.tool['name'] == 'eraser':
+            ctx.set_source_rgb(1.0, 1.0, 1.0)
+        else:
+            ctx.set_source_rgb(*widget.tool['cairo_stroke_color'][:3])
+
+    def _stroke_segment(self, widget, coords, last):
+        """Paint the segment from last to coords in the stroke surface,
+        return the area modified."""
         size = widget.tool['line size']
-        shape = widget.tool['line shape']
+        # paint only the new segment, the caps make the joins
+        ctx = self._stroke_ctx
+        ctx.new_path()
+        ctx.move_to(*last)
+        ctx.line_to(*coords)
+        ctx.stroke()
 
-        rounded = (shape == 'circle')
+        x = min(coords[0], last[0])
+        width = max(coords[0], last[0]) - x
+        y = min(coords[1], last[1])
+        height = max(coords[1], last[1]) - y
+        # We add size to avoid drawing dotted lines
+        area = (x - size, y - size, width + size * 2, height + size * 2)
+        self._add_stroke_area(area)
+        return area
 
-        self.points.append((coords[0], coords[1]))
-        if last:
-            self._draw_polygon(widget, True, False, self.points, False,
-                               rounded)
-        self.clear_control_points()
-        if last:
-            x = min(coords[0], last[0])
-            width = max(coords[0], last[0]) - x
-            y = min(coords[1], last[1])
-            height = max(coords[1], last[1]) - y
-            # We add size to avoid drawing dotted lines
-            widget.queue_draw_area(x - size, y - size,
-                                   width + size * 2, height + size * 2)
+    def _stroke_dot(self, widget, coords):
+        size = widget.tool['line size']
+        ctx = self._stroke_ctx
+        ctx.new_path()
+        if widget.tool['line shape'] == 'circle':
+            ctx.arc(coords[0], coords[1], size / 2.0, 0, 2 * math.pi)
+        else:
+            ctx.rectangle(coords[0] - size / 2, coords[1] - size / 2, size,
+                          size)
+        ctx.fill()
+        self._add_stroke_area((coords[0] - size, coords[1] - size,
+                               size * 2, size * 2))
+
+    def get_stroke_bytes(self):
+        """Return the bytes of the surface kept for the brush traces."""
+        if self._stroke_surface is None:
+            return 0
+        return self._stroke_surface.get_stride() * \
+            self._stroke_surface.get_height()
+
+    def _add_stroke_area(self, area):
+        x1, y1, x2, y2 = self._stroke_bounds
+        self._stroke_bounds = (min(x1, area[0]), min(y1, area[1]),
+                               max(x2, area[0] + area[2]),
+                               max(y2, area[1] + area[3]))
+
+    def _composite_stroke(self, widget, ctx, area):
+        """Compose area of the stroke surface over ctx, with the alpha of
+        the color."""
+        ctx.save()
+        ctx.new_path()
+        ctx.rectangle(*area)
+        ctx.clip()
+        ctx.set_source_surface(self._stroke_surface)
+        if widget.tool['name'] == 'eraser':
+            alpha = 1.0
+            if not widget.is_background_layer():
+                # the background is erased to white, the other layers to
+                # transparent, to show the layers below
+                ctx.set_operator(cairo.OPERATOR_DEST_OUT)
+        else:
+            alpha = widget.tool['cairo_stroke_color'][3]
+        ctx.paint_with_alpha(alpha)
+        ctx.restore()
 
     def square(self, widget, coords, temp, fill):
         """Draw a square.
@@ -400,10 +507,7 @@ class Desenho:
             ctx.stroke_preserve()
             ctx.restore()
 
-        if widget.tool['name'] == 'eraser':
-            ctx.set_source_rgba(1.0, 1.0, 1.0, 1.0)
-        else:
-            ctx.set_source_rgba(*widget.tool['cairo_stroke_color'])
+        ctx.set_source_rgba(*widget.tool['cairo_stroke_color'])
         ctx.stroke()
         ctx.restore()
         if fill or closed:
@@ -649,12 +753,14 @@ class Desenho:
             _x, _y, width, height = widget.get_selection_bounds()
             ctx = cairo.Context(selection_surface)
             ctx.rectangle(0, 0, width, height)
-            ctx.set_source_rgb(1.0, 1.0, 1.0)
+            widget.set_clear_source(ctx)
             ctx.fill()
         else:
+            widget.drawing_ctx.save()
             widget.drawing_ctx.rectangle(x, y, width, height)
-            widget.drawing_ctx.set_source_rgb(1.0, 1.0, 1.0)
+            widget.set_clear_source(widget.drawing_ctx)
             widget.drawing_ctx.fill()
+            widget.drawing_ctx.restore()
 
         widget.queue_draw()
 
@@ -686,8 +792,13 @@ class Desenho:
         window = textview.get_window(Gtk.TextWindowType.TEXT)
         ctx = widget.drawing_ctx
         tv_alloc = textview.get_allocation()
+        # the textview is shown over the canvas scaled by the zoom
+        zoom = widget.get_zoom()
+        ctx.save()
+        ctx.scale(1.0 / zoom, 1.0 / zoom)
         Gdk.cairo_set_source_window(ctx, window, tv_alloc.x, tv_alloc.y)
         ctx.paint()
+        ctx.restore()
 
         widget.activity.textview.hide()
         widget.drawing_canvas.flush()
@@ -66,6 +66,8 @@ from gi.repository import Gdk
 from gi.repository import GObject
 import logging
 import json
+import os
+import time
 
 from sugar3.activity import activity
 from sugar3.graphics import style
@@ -73,10 +75,17 @@ from sugar3.graphics import style
 from Area import Area
 from toolbox import DrawToolbarBox
 import dialogs
+import saving
+import project
+from project import Project, ProjectLayer
+from tilestore import TileStore
 
 
 class OficinaActivity(activity.Activity):
 
+    # zlib level of the PNG files saved in the journal
+    SAVE_COMPRESSION = saving.COMPRESSION_LEVEL
+
     def __init__(self, handle):
         """Initialize the OficinaActivity object.
 
@@ -90,6 +99,13 @@ class OficinaActivity(activity.Activity):
         logging.debug('Starting Paint activity (Oficina)')
 
         self._journal_images = []
+        # the file written in the background, and the one already
+        # written to give to the journal in write_file()
+        self._save_writer = None
+        self._save_again = False
+        self._saved_file = None
+        # the journal entry must be complete when the activity closes
+        self._save_in_background = True
         self.fixed = Gtk.Fixed()
         self._width = Gdk.Screen.width()
         self._height = Gdk.Screen.height()
@@ -115,6 +131,15 @@ class OficinaActivity(activity.Activity):
         # These attributes are used in other classes, so they should be public
         self.area = Area(self)
         self.area.show()
+
+        # copy of the canvas to recover it after a crash, or resume
+        # without decoding the PNG
+        instance_path = os.path.join(activity.get_activity_root(),
+                                     'instance')
+        TileStore.remove_old(instance_path)
+        self._tile_store = TileStore.for_activity(instance_path,
+                                                  self.get_id())
+        self.area.set_tile_store(self._tile_store)
         self.fixed.put(self.area, 0, 0)
 
         self._sw = Gtk.ScrolledWindow()
@@ -175,13 +200,31 @@ class OficinaActivity(activity.Activity):
                       file_path, self.metadata['mime_type'],
                       self.metadata['title'])
 
-        self.area.load_from_file(file_path)
+        surface = None
+        if self.metadata['mime_type'] == project.MIME_TYPE:
+            # the tiles are decoded by the area when shown
+            loaded = Project(file_path)
+            self.area.load_project(loaded)
+            width, height = loaded.width, loaded.height
+        else:
+            if self._can_use_tile_store():
+                surface = self._tile_store.load()
+            if surface is not None:
+                logging.debug('read file from the tile store, version %d',
+                              self._tile_store.version)
+                self.area.drawing_canvas_data = surface
+            else:
+                # the PNG entries are saved again in place, keep their
+                # size, the other images are reduced to fit the screen
+                self.area.load_from_file(
+                    file_path,
+                    full_size=self.metadata['mime_type'] == 'image/png')
+            width = self.area.drawing_canvas_data.get_width()
+            height = self.area.drawing_canvas_data.get_height()
 
         def size_allocate_cb(widget, allocation):
             logging.error('read file size allocate')
             self.fixed.disconnect(self._setup_handle)
-            width = self.area.drawing_canvas_data.get_width()
-            height = self.area.drawing_canvas_data.get_height()
             if self.area.drawing_canvas is None:
                 self.area.setup(width, height)
             # The scrolled window is confused with a image of the same size
@@ -207,7 +250,8 @@ class OficinaActivity(activity.Activity):
                                                 size_allocate_cb)
 
         # disassociate with journal entry to avoid overwrite (SL #1771)
-        if self.metadata['mime_type'] != "image/png":
+        if self.metadata['mime_type'] not in ("image/png",
+                                              project.MIME_TYPE):
             self._jobject.object_id = None
             last_point_posi = self.metadata['title'].rfind('.')
             if last_point_posi > -1:
@@ -218,18 +262,136 @@ class OficinaActivity(activity.Activity):
         if 'images' in self.metadata:
             self._journal_images = json.loads(self.metadata['images'])
 
+    def _can_use_tile_store(self):
+        # the store can be newer than the journal entry, when the
+        # activity was not closed properly
+        if self.metadata.get('mime_type') != 'image/png' or \
+                not self._tile_store.has_image():
+            return False
+        try:
+            saved = int(self.metadata.get('tile_store_version', 0))
+        except ValueError:
+            return False
+        return self._tile_store.version >= saved
+
+    def close(self, skip_save=False):
+        if skip_save:
+            # the changes are discarded, do not recover them
+            self.area.set_tile_store(None)
+            self._tile_store.remove()
+        self._save_in_background = False
+        activity.Activity.close(self, skip_save)
+        self._save_in_background = True
+
+    def copy(self):
+        # Activity.copy() clears the object_id after save(), the copy
+        # must be written before
+        self._save_in_background = False
+        try:
+            activity.Activity.copy(self)
+        finally:
+            self._save_in_background = True
+
+    def _is_project(self):
+        # the drawings with layers are saved as projects
+        return self.metadata.get('mime_type') == project.MIME_TYPE or \
+            (self.area.layers is not None and len(self.area.layers) > 1)
+
+    def _get_project_layers(self):
+        return [(ProjectLayer(layer.name, layer.opacity, layer.visible,
+                              layer.blend_mode), layer.surface)
+                for layer in self.area.layers]
+
+    def save(self):
+        '''Save in the Sugar Journal. The PNG or project file is written in
+        a thread and the journal entry is updated when done.'''
+        if not self._save_in_background or \
+                self.area.drawing_canvas is None:
+            self._cancel_background_save()
+            activity.Activity.save(self)
+            return
+        if self._save_writer is not None:
+            # save again with the changes done while writing
+            self._save_again = True
+            return
+
+        self._finish_drawing()
+        extension = 'ora' if self._is_project() else 'png'
+        file_path = os.path.join(activity.get_activity_root(), 'instance',
+                                 'save-%i.%s' % (time.time(), extension))
+        logging.debug('saving %s in background', file_path)
+        if self._is_project():
+            self._save_writer = saving.ProjectWriter(
+                self._get_project_layers(), file_path,
+                self.__file_written_cb, self.SAVE_COMPRESSION)
+        else:
+            self._save_writer = saving.PngWriter(
+                self.area.drawing_canvas, file_path, self.__file_written_cb,
+                self.SAVE_COMPRESSION)
+        self._save_writer.start()
+
+    def __file_written_cb(self, writer):
+        # called from the thread of the writer
+        GObject.idle_add(self._finish_background_save, writer)
+
+    def _finish_background_save(self, writer):
+        if writer is not self._save_writer:
+            # cancelled
+            if os.path.exists(writer.file_path):
+                os.remove(writer.file_path)
+            return False
+        self._save_writer = None
+        if writer.error is None:
+            self._saved_file = writer.file_path
+        try:
+            activity.Activity.save(self)
+        finally:
+            # not moved by write_file() if the journal entry was still
+            # being updated, or on errors
+            if self._saved_file is not None and \
+                    os.path.exists(self._saved_file):
+                os.remove(self._saved_file)
+            self._saved_file = None
+        if self._save_again:
+            self._save_again = False
+            self.save()
+        return False
+
+    def _cancel_background_save(self):
+        if self._save_writer is not None:
+            self._save_writer = None
+            self._save_again = False
+
+    def _finish_drawing(self):
+        self.area.finish_loading()
+        if self.area.text_in_progress:
+            self.area.d.text(self.area, 0, 0)
+        self.area.getout()
+
     def write_file(self, file_path):
         '''Save file on Sugar Journal. '''
 
         width, height = self.area.get_size_request()
 
         logging.debug('writting %s w=%s h=%s' % (file_path, width, height))
-        if self.area.text_in_progress:
-            self.area.d.text(self.area, 0, 0)
-
-        self.area.getout()
-        self.area.drawing_canvas.write_to_png(file_path)
-        self.metadata['mime_type'] = 'image/png'
+        if self._saved_file is not None:
+            # already written by save()
+            os.rename(self._saved_file, file_path)
+        elif self._is_project():
+            self._finish_drawing()
+            project.write_project(file_path, self._get_project_layers(),
+                                  self.SAVE_COMPRESSION)
+        else:
+            self._finish_drawing()
+            saving.write_png(self.area.drawing_canvas, file_path,
+                             self.SAVE_COMPRESSION)
+        if self._is_project():
+            self.metadata['mime_type'] = project.MIME_TYPE
+        else:
+            self.metadata['mime_type'] = 'image/png'
+        version = self.area.autosave()
+        if version is not None:
+            self.metadata['tile_store_version'] = str(version)
         self.metadata['state'] = json.dumps(self.area.tool)
         self.metadata['images'] = json.dumps(dialogs.get_journal_images())
         logging.debug('Wrote metadata[\'state\']: %s', self.metadata['state'])
@@ -254,7 +416,34 @@ class OficinaActivity(activity.Activity):
 
     def move_textview(self, dx, dy):
         x, y = self._get_area_displacement()
-        self.fixed.move(self.textview, x + dx, y + dy)
+        zoom = self.area.get_zoom()
+        self.fixed.move(self.textview, x + int(dx * zoom), y + int(dy * zoom))
+
+    def set_zoom(self, zoom):
+        '''Scale the view of the canvas, keeping the same point in the
+        center of the visible part.'''
+        hadjustment = self.canvas.get_hadjustment()
+        vadjustment = self.canvas.get_vadjustment()
+        old_zoom = self.area.get_zoom()
+        center_x = (hadjustment.get_value() +
+                    hadjustment.get_page_size() / 2) / old_zoom
+        center_y = (vadjustment.get_value() +
+                    vadjustment.get_page_size() / 2) / old_zoom
+        self.area.set_zoom(zoom)
+        self.canvas.set_policy(Gtk.PolicyType.AUTOMATIC,
+                               Gtk.PolicyType.AUTOMATIC)
+
+        def scroll_cb():
+            # the adjustments have the new size after the allocation
+            self.center_area()
+            zoom = self.area.get_zoom()
+            hadjustment.set_value(center_x * zoom -
+                                  hadjustment.get_page_size() / 2)
+            vadjustment.set_value(center_y * zoom -
+                                  vadjustment.get_page_size() / 2)
+            return False
+
+        GObject.idle_add(scroll_cb)
 
     def toolset_intialize_from_journal(self):
         try:
@@ -0,0 +1,79 @@
+"""
+Compare the conversion of a cairo surface to a GdkPixbuf encoding a PNG,
+as the activity did before, with the direct conversion of Gdk, for the
+grayscale effect and the clipboard copy of a full canvas.
+
+Usage: python benchmark_pixbuf.py [width height [repeats]]
+"""
+
+import StringIO
+import sys
+import time
+
+import cairo
+from gi.repository import Gdk
+from gi.repository import GdkPixbuf
+
+
+def png_surface_to_pixbuf(surface):
+    pixbuf_data = StringIO.StringIO()
+    surface.write_to_png(pixbuf_data)
+    pxb_loader = GdkPixbuf.PixbufLoader.new_with_type('png')
+    pxb_loader.write(pixbuf_data.getvalue())
+    pxb_loader.close()
+    return pxb_loader.get_pixbuf()
+
+
+def direct_surface_to_pixbuf(surface):
+    return Gdk.pixbuf_get_from_surface(surface, 0, 0, surface.get_width(),
+                                       surface.get_height())
+
+
+def grayscale(surface, surface_to_pixbuf):
+    pixbuf = surface_to_pixbuf(surface)
+    pixbuf.saturate_and_pixelate(pixbuf, 0, 0)
+    ctx = cairo.Context(surface)
+    Gdk.cairo_set_source_pixbuf(ctx, pixbuf, 0, 0)
+    ctx.paint()
+
+
+def copy(surface, surface_to_pixbuf):
+    surface_to_pixbuf(surface)
+
+
+def create_canvas(width, height):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    ctx = cairo.Context(surface)
+    ctx.set_source_rgb(1.0, 1.0, 1.0)
+    ctx.paint()
+    # something to compress
+    for i in range(0, width, 7):
+        ctx.set_source_rgb(i % 3 / 2.0, i % 5 / 4.0, i % 7 / 6.0)
+        ctx.move_to(i, 0)
+        ctx.line_to(width - i, height)
+        ctx.stroke()
+    return surface
+
+
+def measure(function, surface, surface_to_pixbuf, repeats):
+    start = time.time()
+    for _i in range(repeats):
+        function(surface, surface_to_pixbuf)
+    return (time.time() - start) / repeats
+
+
+if __name__ == '__main__':
+    width, height, repeats = 1200, 900, 10
+    if len(sys.argv) > 2:
+        width, height = int(sys.argv[1]), int(sys.argv[2])
+    if len(sys.argv) > 3:
+        repeats = int(sys.argv[3])
+
+    surface = create_canvas(width, height)
+    print "canvas %dx%d, %d repeats" % (width, height, repeats)
+    for name, function in (('grayscale', grayscale), ('copy', copy)):
+        png = measure(function, surface, png_surface_to_pixbuf, repeats)
+        direct = measure(function, surface, direct_surface_to_pixbuf,
+                         repeats)
+        print "%-10s png %7.1f ms  direct %7.1f ms  speed-up %.1fx" % (
+            name, png * 1000, direct * 1000, png / direct)
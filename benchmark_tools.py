@@ -0,0 +1,319 @@
+"""
+Replay pointer traces through the drawing tools of a canvas.Canvas and
+report, for every tool and canvas size, the latency of the events
+(percentiles of the tool call plus the frame painted after it), the
+total time and the peak memory of the process replaying it.
+
+Every case runs in a forked process, to measure its memory alone. The
+results can be saved as a baseline, and compared with it in the next
+runs, the cases slower or bigger than the baseline by more than the
+tolerance are reported and the exit status is 1. The times depend on
+the computer, the baseline must be saved in the one running the
+comparison.
+
+The tools run through canvas.Canvas, that uses the dispatch, the
+bucket and the selection code of canvas.CanvasModel shared with the
+Area.
+
+Usage: python benchmark_tools.py [--sizes 320x240,1200x900]
+           [--cases brush-strokes,bucket] [--baseline FILE]
+           [--save] [--tolerance 0.25]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import cairo
+
+from canvas import Canvas
+from canvas import SHAPES
+
+SIZES = ((320, 240), (1200, 900), (2400, 1800))
+BASELINE = 'benchmark_tools.baseline'
+# a case is slower than the baseline if its time grows more than this
+TOLERANCE = 0.25
+PERCENTILES = (50, 90, 99)
+# positions of the pointer received in every frame while moving
+POINTS_PER_FRAME = 3
+
+
+def _stroke(rand, width, height, frames, step):
+    """Return the events of a drag of the pointer with the button
+    pressed, as ('start', x, y), ('move', [(x, y), ...]) for every frame
+    and ('end', x, y)."""
+    x, y = rand.randint(0, width - 1), rand.randint(0, height - 1)
+    events = [('start', x, y)]
+    for _frame in range(frames):
+        points = []
+        for _i in range(POINTS_PER_FRAME):
+            x = max(0, min(width - 1, x + rand.randint(-step, step)))
+            y = max(0, min(height - 1, y + rand.randint(-step, step)))
+            points.append((x, y))
+        events.append(('move', points))
+    events.append(('end', x, y))
+    return events
+
+
+def _drag(start, end, frames):
+    """Return the events of a straight drag from start to end."""
+    events = [('start', start[0], start[1])]
+    for frame in range(1, frames + 1):
+        events.append(('move', [(
+            start[0] + (end[0] - start[0]) * frame / frames,
+            start[1] + (end[1] - start[1]) * frame / frames)]))
+    events.append(('end', end[0], end[1]))
+    return events
+
+
+def short_strokes(rand, width, height):
+    events = []
+    for _i in range(20):
+        events.extend(_stroke(rand, width, height, 10, 8))
+    return events
+
+
+def long_scribble(rand, width, height):
+    return _stroke(rand, width, height, 600, 20)
+
+
+def shape_drags(rand, width, height):
+    events = []
+    for _i in range(5):
+        start = (rand.randint(0, width / 2), rand.randint(0, height / 2))
+        end = (rand.randint(width / 2, width - 1),
+               rand.randint(height / 2, height - 1))
+        events.extend(_drag(start, end, 30))
+    return events
+
+
+def freeform_polygons(rand, width, height):
+    events = []
+    for _i in range(5):
+        points = [(rand.randint(0, width - 1), rand.randint(0, height - 1))
+                  for _j in range(6)]
+        for start, end in zip(points, points[1:] + points[:1]):
+            events.extend(_drag(start, end, 5))
+    return events
+
+
+def bucket_clicks(rand, width, height):
+    events = []
+    for _i in range(10):
+        x, y = rand.randint(0, width - 1), rand.randint(0, height - 1)
+        events.extend([('start', x, y), ('end', x, y)])
+    return events
+
+
+def selection_move_resize(rand, width, height):
+    # select the center, move it and resize it from the corner
+    x, y = width / 4, height / 4
+    events = _drag((x, y), (x * 2, y * 2), 20)
+    events.extend(_drag((x + 10, y + 10), (x + 10 + width / 8,
+                                           y + 10 + height / 8), 30))
+    corner = (x * 2 + width / 8 + 5, y * 2 + height / 8 + 5)
+    events.extend(_drag(corner, (corner[0] + width / 8,
+                                 corner[1] + height / 8), 30))
+    return events
+
+
+def _draw_grid(canvas):
+    """Paint lines over the canvas, for the tools that depend on the
+    drawing, like the bucket."""
+    width, height = canvas.get_size()
+    ctx = canvas.drawing_ctx
+    ctx.save()
+    ctx.set_source_rgb(0.0, 0.0, 0.0)
+    ctx.set_line_width(2)
+    for x in range(0, width, 97):
+        ctx.move_to(x, 0)
+        ctx.line_to(width - x, height)
+    for y in range(0, height, 89):
+        ctx.move_to(0, y)
+        ctx.line_to(width, height - y)
+    ctx.stroke()
+    ctx.restore()
+    canvas.queue_draw()
+    canvas.render_frame()
+
+
+def _create_stamp(canvas):
+    stamp = cairo.ImageSurface(cairo.FORMAT_ARGB32, 44, 44)
+    ctx = cairo.Context(stamp)
+    ctx.arc(22, 22, 20, 0, 6.3)
+    ctx.set_source_rgba(0.8, 0.2, 0.2, 0.8)
+    ctx.fill()
+    canvas.set_stamp(stamp)
+
+
+# name: (tool values, trace, prepare the canvas)
+CASES = {
+    'brush-strokes': ({'name': 'brush'}, short_strokes, None),
+    'brush-scribble': ({'name': 'brush', 'line size': 20}, long_scribble,
+                       None),
+    'eraser-strokes': ({'name': 'eraser', 'line size': 20}, short_strokes,
+                       _draw_grid),
+    'rainbow-strokes': ({'name': 'rainbow'}, short_strokes, None),
+    'kalidoscope-strokes': ({'name': 'kalidoscope'}, short_strokes, None),
+    'stamp-strokes': ({'name': 'stamp'}, short_strokes, _create_stamp),
+    'freeform': ({'name': 'freeform'}, freeform_polygons, None),
+    'bucket': ({'name': 'bucket', 'bucket_color': (65535, 0, 0)},
+               bucket_clicks, _draw_grid),
+    'bucket-tolerance': ({'name': 'bucket', 'bucket_color': (0, 0, 65535),
+                          'bucket_tolerance': 30, 'bucket_antialias': True},
+                         bucket_clicks, _draw_grid),
+    'selection': ({'name': 'marquee-rectangular'}, selection_move_resize,
+                  _draw_grid),
+}
+for _shape in SHAPES:
+    CASES['shape-%s' % _shape] = ({'name': _shape}, shape_drags, None)
+
+
+def percentile(values, percent):
+    """Return the value under which are percent of values, sorted."""
+    if not values:
+        return 0.0
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def replay(canvas, events):
+    """Send events to canvas, painting a frame after every one, and
+    return the seconds used by every event."""
+    latencies = []
+    for event in events:
+        start = time.time()
+        if event[0] == 'start':
+            canvas.tool_start(event[1], event[2])
+        elif event[0] == 'move':
+            canvas.tool_move(event[1])
+        else:
+            canvas.tool_end(event[1], event[2])
+        canvas.render_frame()
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def run_case(name, width, height):
+    """Replay the case in a new canvas, return the result without the
+    memory."""
+    tool, trace, prepare = CASES[name]
+    canvas = Canvas(width, height, tool)
+    if prepare is not None:
+        prepare(canvas)
+    events = trace(random.Random(name), width, height)
+    latencies = replay(canvas, events)
+    total = sum(latencies)
+    latencies.sort()
+    result = {'events': len(events), 'total': total,
+              'max': latencies[-1]}
+    for percent in PERCENTILES:
+        result['p%d' % percent] = percentile(latencies, percent)
+    return result
+
+
+def run_forked(name, width, height):
+    """Run the case in a child process, return its result with the peak
+    resident memory of the child in KB."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            data = json.dumps(run_case(name, width, height))
+        except Exception, error:
+            data = json.dumps({'error': str(error)})
+            status = 1
+        with os.fdopen(write_fd, 'w') as pipe:
+            pipe.write(data)
+        os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        data = pipe.read()
+    _pid, _status, usage = os.wait4(pid, 0)
+    result = json.loads(data or '{"error": "no result"}')
+    result['memory'] = usage.ru_maxrss
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of messages with the cases of results that are
+    worse than the same cases in baseline."""
+    regressions = []
+    for key in sorted(results):
+        old = baseline.get(key)
+        new = results[key]
+        if old is None or 'error' in new or 'error' in old:
+            continue
+        for value in ('total', 'p90', 'memory'):
+            if new[value] > old[value] * (1 + tolerance):
+                regressions.append('%s %s %.4g -> %.4g (+%d%%)' % (
+                    key, value, old[value], new[value],
+                    (new[value] / float(old[value]) - 1) * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay pointer traces through the drawing tools')
+    parser.add_argument('--sizes', default=','.join(
+        '%dx%d' % size for size in SIZES),
+        help='canvas sizes, as WIDTHxHEIGHT separated by commas')
+    parser.add_argument('--cases', default=','.join(sorted(CASES)),
+                        help='cases to run, separated by commas')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='file with the results to compare')
+    parser.add_argument('--save', action='store_true',
+                        help='write the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='growth allowed over the baseline')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(value) for value in size.split('x'))
+             for size in args.sizes.split(',')]
+    results = {}
+    print "%-22s %9s %6s %8s %8s %8s %8s %9s %8s" % (
+        'case', 'size', 'events', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'total ms', 'peak KB')
+    for name in args.cases.split(','):
+        if name not in CASES:
+            parser.error('unknown case %s' % name)
+        for width, height in sizes:
+            result = run_forked(name, width, height)
+            size = '%dx%d' % (width, height)
+            results['%s %s' % (name, size)] = result
+            if 'error' in result:
+                print "%-22s %9s failed: %s" % (name, size, result['error'])
+                continue
+            print "%-22s %9s %6d %8.2f %8.2f %8.2f %8.2f %9.1f %8d" % (
+                name, size, result['events'], result['p50'] * 1000,
+                result['p90'] * 1000, result['p99'] * 1000,
+                result['max'] * 1000, result['total'] * 1000,
+                result['memory'])
+
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=1, sort_keys=True)
+        print "baseline saved in %s" % args.baseline
+        return 0
+    if not os.path.exists(args.baseline):
+        print >> sys.stderr, "warning: no baseline in %s, nothing compared," \
+            " run with --save to create it" % args.baseline
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, args.tolerance)
+    for message in regressions:
+        print "regression: %s" % message
+    if regressions:
+        return 1
+    print "no regressions over %s" % args.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,777 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace canvas
+
+    The drawing state used by the Desenho tools, without Gtk: the image
+    surfaces, the tool, the selection and the areas to show again.
+
+    The Desenho methods receive a canvas as widget, and use only these
+    members of it: drawing_canvas, drawing_ctx, temp_ctx, tool, oldx,
+    oldy, last, desenha, textos, text_in_progress, resized_stamp,
+    stamp_dimentions, pending_clean_selection_background,
+    selection_surface, get_size(), get_zoom(), queue_draw(),
+    queue_draw_area(), enable_undo(), calculate_damaged_area(),
+    is_background_layer(), set_clear_source() and the selection methods
+    of CanvasModel. The text tool uses the textview of the activity too.
+
+    CanvasModel has the code shared by the Area widget and by Canvas, a
+    canvas in memory to use the tools from tests, benchmarks or scripts
+    without a display.
+
+"""
+
+import logging
+
+import cairo
+
+import fill
+from Desenho import Desenho
+from commands import Command
+from regions import RegionIndex
+
+# The tool of a new canvas, a dictionary with the keys:
+# - 'name'          : a string
+# - 'line size'     : a integer
+# - 'stamp size'    : a integer
+# - 'line shape'    : a string - 'circle' or 'square', for now
+# - 'fill'          : a Boolean value
+# - 'vertices'      : a integer
+# - 'bucket_tolerance' : a integer, percent of color difference
+#                        accepted by the bucket
+# - 'bucket_antialias' : a Boolean value, soften the bucket borders
+# All values migth be None, execept in 'name' key.
+DEFAULT_TOOL = {
+    'name': 'brush',
+    'line size': 4,
+    'stamp size': 44,
+    'line shape': 'circle',
+    'fill': True,
+    'cairo_stroke_color': (0.0, 0.0, 0.0, 1.0),
+    'cairo_fill_color': (0.0, 0.0, 0.0, 1.0),
+    'bucket_color': (0, 0, 0),
+    'bucket_tolerance': 0,
+    'bucket_antialias': False,
+    'alpha': 1.0,
+    'vertices': 6.0,
+    'font_description': 'Sans 12'}
+
+# the tools painting a shape from the start point, with the Desenho
+# method and if it receives the number of vertices
+SHAPES = {'line': ('line', False),
+          'ellipse': ('circle', False),
+          'rectangle': ('square', False),
+          'triangle': ('triangle', False),
+          'trapezoid': ('trapezoid', False),
+          'arrow': ('arrow', False),
+          'parallelogram': ('parallelogram', False),
+          'star': ('star', True),
+          'polygon_regular': ('polygon_regular', True),
+          'heart': ('heart', False)}
+
+# the tools painting a trace over the positions of the pointer
+TRACES = ('eraser', 'brush', 'kalidoscope', 'rainbow', 'stamp',
+          'load-stamp')
+
+# size of the corner dragged to resize the selection, the one of the
+# Area with the default sugar style, see CanvasModel.resize_arrow_size
+RESIZE_ARROW_SIZE = 37
+
+
+class CanvasModel(object):
+    """The tool handling shared by the canvas implementations. The
+    subclasses define the members used by Desenho, and _stroke_command,
+    _selection_bounds, _selection_horizontal_scale,
+    _selection_vertical_scale, selection_resized_surface,
+    _selection_finished, _selmove, _selresize, keep_shape_ratio,
+    keep_aspect_ratio, drawing, _last_x_touch, _last_y_touch, _regions
+    (a regions.RegionIndex) and _set_undo_command(), keeping a change
+    without notifying canvas_changed().
+
+    The methods starting with _ and ending a action of a tool, like
+    _selection_created(), _queue_flood_fill() or _end_flood_fill(), are
+    the places where the Area adds what needs Gtk.
+    """
+
+    resize_arrow_size = RESIZE_ARROW_SIZE
+    # True in the stand in of commands.Command painting a action again,
+    # the brush traces are not painted segment by segment while moving
+    replaying = False
+
+    def _paint(self, name, *args):
+        """Call the method name of Desenho with the arguments after the
+        widget, and return the commands.Command that repeats it."""
+        command = Command(self, name, *args)
+        getattr(self.d, name)(self, *args)
+        return command
+
+    def paint_shape(self, coords, temp):
+        """Paint the shape of the tool from (oldx, oldy) to coords.
+
+            @param  temp -- if True is painted in the temp canvas, to show
+                            it while the pointer moves
+            @return  the commands.Command that repeats the shape, if not
+                     temp
+        """
+        method, with_vertices = SHAPES[self.tool['name']]
+        args = [coords]
+        if with_vertices:
+            args.append(self.tool['vertices'])
+        args.append(temp)
+        if method != 'line':
+            args.append(self.tool['fill'])
+        if temp:
+            getattr(self.d, method)(self, *args)
+            return None
+        return self._paint(method, *args)
+
+    def start_trace(self, coords):
+        """Start the trace of the tool at coords."""
+        self.last = []
+        if self.tool['name'] in ('stamp', 'load-stamp'):
+            self._stroke_command = self._paint('stamp', coords, self.last)
+        else:
+            self.trace_to(coords)
+        self.last = coords
+        self.drawing = True
+
+    def trace_to(self, coords):
+        """Continue the trace of the tool to coords."""
+        if self.tool['name'] == 'eraser':
+            self.d.eraser(self, coords, self.last)
+            self.last = coords
+
+        elif self.tool['name'] == 'brush':
+            self.d.brush(self, coords, self.last)
+            self.last = coords
+
+        elif self.tool['name'] == 'kalidoscope':
+            self.d.kalidoscope(self, coords, self.last)
+            self.last = coords
+
+        elif self.tool['name'] in ('stamp', 'load-stamp'):
+            self.d.stamp(self, coords, self.last,
+                         self.tool['stamp size'])
+            if self._stroke_command is not None:
+                self._stroke_command.add('stamp', coords, self.last,
+                                         self.tool['stamp size'])
+            self.last = coords
+
+        elif self.tool['name'] == 'rainbow':
+            self.d.rainbow(self, coords, self.last)
+            self.last = coords
+
+    def end_trace(self):
+        """Finish the trace, return the commands.Command that repeats it,
+        if can be repeated."""
+        self.last = []
+        command = None
+        if self.tool['name'] in ('brush', 'eraser'):
+            command = self._paint('finish_trace')
+        elif self.tool['name'] != 'kalidoscope':
+            if self.tool['name'] in ('stamp', 'load-stamp'):
+                command = self._stroke_command
+            self.d.finish_trace(self)
+        self._stroke_command = None
+        self.drawing = False
+        return command
+
+    def configure_line(self, size):
+        """Configure the new line's size."""
+        self.drawing_ctx.set_line_width(size)
+
+    def tool_start(self, x, y, button1_pressed=True):
+        """Start to use the tool at (x, y), where the button was pressed.
+        """
+        coords = (x, y)
+        if not self._selresize:
+            # if resizing don't update to remember previous resize
+            self.oldx, self.oldy = coords
+        if not button1_pressed:
+            return
+
+        name = self.tool['name']
+        if name in TRACES:
+            self.start_trace(coords)
+        elif name == 'freeform':
+            self.configure_line(self.tool['line size'])
+            self.d.freeform(self, coords, True, self.tool['fill'], 'motion')
+        elif name == 'marquee-rectangular':
+            if not self._start_selection(coords):
+                return
+        self.desenha = True
+
+    def _start_selection(self, coords):
+        """Start to move or resize the selection, or to select a new
+        area, return False if the selection was applied."""
+        if not self.is_selected():
+            self._selmove = False
+            return True
+        # verify is out of the selected area
+        sel_x, sel_y, sel_width, sel_height = self.get_selection_bounds()
+        if self.check_point_in_area(coords[0], coords[1], sel_x, sel_y,
+                                    sel_width, sel_height):
+            # be sure to have the last coords
+            # because can be older if was resized before
+            self.oldx, self.oldy = coords
+            # inside the selected area
+            self.d.move_selection(self, coords)
+            self._selmove = True
+            self._selresize = False
+        elif self.check_point_in_area(coords[0], coords[1],
+                                      sel_x + sel_width, sel_y + sel_height,
+                                      self.resize_arrow_size,
+                                      self.resize_arrow_size):
+            # in de resize area
+            self._selmove = False
+            self._selresize = True
+        else:
+            self.end_selection()
+            return False
+        return True
+
+    def end_selection(self):
+        if self.is_selected():
+            self.getout()
+            self._selmove = False
+            self._selresize = False
+            self.queue_draw()
+
+    def tool_move(self, points, button1_pressed=True, shift_pressed=False):
+        """Move the tool over the positions (x, y) of the pointer, oldest
+        first, return the ones used, see filter_motion()."""
+        moved = self.filter_motion(points)
+        if not moved:
+            return moved
+        coords = self.keep_shape_ratio_of(moved[-1], shift_pressed)
+        name = self.tool['name']
+
+        if button1_pressed:
+            # the traces use all the positions, the shapes only the last
+            for point in moved:
+                self.trace_to(point)
+
+            if self.desenha:
+                if name in SHAPES:
+                    self.paint_shape(coords, True)
+
+                elif name == 'marquee-rectangular':
+                    if self._selmove:
+                        # is inside a selected area, move it
+                        self.d.move_selection(self, coords)
+                    elif self._selresize:
+                        self.d.resize_selection(self, coords)
+                    else:
+                        # create a selected area
+                        if shift_pressed or self.keep_aspect_ratio:
+                            coords = self._keep_selection_ratio(coords)
+                        self.d.selection(self, coords)
+
+                elif name == 'freeform':
+                    self.configure_line(self.tool['line size'])
+                    for point in moved:
+                        self.d.freeform(self, point, True,
+                                        self.tool['fill'], 'motion')
+
+        elif name == 'freeform':
+            self.desenha = True
+            self.configure_line(self.tool['line size'])
+            self.d.freeform(self, coords, True, self.tool['fill'], 'moving')
+        return moved
+
+    def tool_end(self, x, y, shift_pressed=False):
+        """Finish the action of the tool at (x, y), where the button was
+        released."""
+        coords = self.keep_shape_ratio_of((x, y), shift_pressed)
+        name = self.tool['name']
+
+        private_undo = False
+        # the Command repeating the drawing, if can be repeated
+        command = None
+        if self.desenha:
+            if name in SHAPES:
+                command = self.paint_shape(coords, False)
+
+            elif name == 'marquee-rectangular':
+                private_undo = True
+                if self.is_selected() and not self._selmove and \
+                        not self._selresize:
+                    self.create_selection_surface()
+                    self._selection_created()
+                else:
+                    self.apply_temp_selection()
+
+            elif name == 'freeform':
+                self._end_freeform(coords)
+                private_undo = True
+
+            elif name == 'bucket':
+                self._queue_flood_fill(coords[0], coords[1])
+
+        elif name == 'marquee-rectangular':
+            if self.is_selected():
+                self.getout()
+
+        if name in TRACES:
+            command = self.end_trace()
+        if not private_undo and name not in ('bucket', 'marquee-rectangular'):
+            # We have to avoid saving an undo state if the bucket tool
+            # is selected because the fill can be done later, and keeps
+            # its own undo state
+            self.enable_undo(command)
+        if name not in ('marquee-rectangular', 'freeform'):
+            self.desenha = False
+
+        self.queue_draw()
+        self.d.clear_control_points()
+
+    def _selection_created(self):
+        """A new area was selected."""
+        pass
+
+    def _end_freeform(self, coords):
+        """Add the last point of the freeform polygon, released at
+        coords."""
+        self.d.freeform(self, coords, False, self.tool['fill'], 'release')
+
+    def _queue_flood_fill(self, x, y):
+        """Fill with the bucket from (x, y), now or later."""
+        self.flood_fill(x, y)
+
+    def flood_fill(self, x, y):
+        """Fill with the bucket color the area around (x, y) of the
+        drawing canvas, in place."""
+        bucket_color = self.tool['bucket_color']
+        # the values are between 0 and 65535
+        r, g, b = bucket_color[0] >> 8, bucket_color[1] >> 8, \
+            bucket_color[2] >> 8
+
+        # pack the color in a int as 0xAARRGGBB
+        fill_color = 0xff000000 + (r << 16) + (g << 8) + b
+        logging.debug('fill_color %d', fill_color)
+
+        # the tool can come from a older journal entry without these keys
+        tolerance = self.tool.get('bucket_tolerance', 0) * 255 / 100
+        antialias = self.tool.get('bucket_antialias', False)
+        if not fill.NATIVE_FILL_SURFACE:
+            # the options are not shown without the blob, but can come
+            # from a journal entry saved in other computer
+            tolerance = 0
+            antialias = False
+
+        # fill in place over the drawing canvas data
+        width = self.drawing_canvas.get_width()
+        height = self.drawing_canvas.get_height()
+        self.drawing_canvas.flush()
+        use_regions = tolerance == 0 and not antialias and \
+            self._regions.is_available()
+        command = Command(self, 'flood_fill', x, y, fill_color, tolerance,
+                          antialias)
+        logging.debug('using flood_fill, native: %s regions: %s',
+                      fill.NATIVE, use_regions)
+        if use_regions:
+            damage = self._regions.fill(self.drawing_canvas, x, y,
+                                        fill_color)
+        else:
+            damage = fill.fill_surface(self.drawing_canvas.get_data(),
+                                       self.drawing_canvas.get_stride(),
+                                       x, y, width, height, fill_color,
+                                       tolerance, antialias)
+
+        if damage is None:
+            logging.debug('Already filled')
+            self._end_flood_fill(False)
+            return
+
+        # repaint only the filled area
+        self.drawing_canvas.mark_dirty_rectangle(*damage)
+        self.queue_draw_area(*damage)
+        if use_regions:
+            # the region index was updated by the fill, keep it
+            self._set_undo_command(command)
+        else:
+            self.enable_undo(command)
+        self._end_flood_fill(True)
+
+    def _end_flood_fill(self, filled):
+        """The bucket finished, filled is False if the area already had
+        the color."""
+        pass
+
+    def _keep_selection_ratio(self, coords):
+
+        def sign(x):
+            return x and x / abs(x) or 0
+
+        dx = int(coords[0]) - self.oldx
+        dy = int(coords[1]) - self.oldy
+        size = max(abs(dx), abs(dy))
+
+        return (self.oldx + sign(dx) * size,
+                self.oldy + sign(dy) * size)
+
+    def _keep_line_ratio(self, coords):
+
+        def sign(x):
+            return x and x / abs(x) or 0
+
+        dx = int(coords[0]) - self.oldx
+        dy = int(coords[1]) - self.oldy
+        size = max(abs(dx), abs(dy))
+
+        if abs(dx) > 0.5 * size and abs(dy) > 0.5 * size:
+            return (self.oldx + sign(dx) * size, self.oldy + sign(dy) * size)
+        elif abs(dx) < 0.5 * size and abs(dy) > 0.5 * size:
+            return (self.oldx, self.oldy + sign(dy) * size)
+        elif abs(dx) > 0.5 * size and abs(dy) < 0.5 * size:
+            return (self.oldx + sign(dx) * size, self.oldy)
+
+    def keep_shape_ratio_of(self, coords, shift_pressed):
+        """Return coords moved to keep the rectangle, ellipse or line
+        proportional, if shift is pressed or keep_shape_ratio is set."""
+        if shift_pressed or self.keep_shape_ratio:
+            if self.tool['name'] in ('rectangle', 'ellipse'):
+                return self._keep_selection_ratio(coords)
+            elif self.tool['name'] == 'line':
+                return self._keep_line_ratio(coords)
+        return coords
+
+    def filter_motion(self, points):
+        """Return the positions of points moved more than one pixel from
+        the previous one, as integers."""
+        # the touch driver trigger many events sensing movements up and down
+        # by only a pixel. This code caches the last position and ignores
+        # the movements not bigger than one pixel to avoid redraws
+        moved = []
+        for x, y in points:
+            if abs(x - self._last_x_touch) > 1 or \
+                    abs(y - self._last_y_touch) > 1:
+                self._last_x_touch = x
+                self._last_y_touch = y
+                moved.append((int(x), int(y)))
+        return moved
+
+    def calculate_damaged_area(self, points):
+        min_x = points[0][0]
+        min_y = points[0][1]
+        max_x = 0
+        max_y = 0
+        for point in points:
+            if point[0] < min_x:
+                min_x = point[0]
+            if point[0] > max_x:
+                max_x = point[0]
+            if point[1] < min_y:
+                min_y = point[1]
+            if point[1] > max_y:
+                max_y = point[1]
+        # add the tool size
+        if self.tool['name'] in ('stamp', 'load-stamp'):
+            wr, hr = self.stamp_dimentions
+        elif self.tool['name'] == 'freeform':
+            wr = hr = 20
+        else:
+            wr = hr = self.tool['line size'] * 2
+        min_x = min_x - wr
+        min_y = min_y - wr
+        max_x = max_x + hr
+        max_y = max_y + hr
+
+        return (min_x, min_y, max_x - min_x, max_y - min_y)
+
+    def check_point_in_area(self, x_point, y_point, x_min, y_min,
+                            width, height):
+        return not ((x_point < x_min) or (x_point > x_min + width) or
+                    (y_point < y_min) or (y_point > y_min + height))
+
+    def is_background_layer(self):
+        """Return True if the drawing canvas is the bottom layer, erased
+        to white instead of transparent."""
+        return True
+
+    def set_clear_source(self, ctx):
+        """Set ctx to paint the cleared pixels: white in the background
+        layer, transparent in the other layers, to show the layers
+        below."""
+        if self.is_background_layer():
+            ctx.set_source_rgb(1.0, 1.0, 1.0)
+        else:
+            ctx.set_operator(cairo.OPERATOR_CLEAR)
+
+    def is_selected(self):
+        """
+        Return True if there is some thing selected
+        """
+        return self.get_selection_bounds() != (0, 0, 0, 0)
+
+    def clear_selection(self):
+        self.set_selection_bounds(0, 0, 0, 0)
+        # already painted in the canvas, if any
+        self.selection_surface = None
+        self._selection_horizontal_scale = 1.0
+        self._selection_vertical_scale = 1.0
+        self.selection_resized_surface = None
+        self._selection_finished = False
+
+    def set_selection_bounds(self, x, y, width, height):
+        """
+            Set selection bounds
+            @param x, y, width, height - the rectangle to define the area
+        """
+        self._selection_bounds = (x, y, width, height)
+
+    def set_selection_start(self, x, y):
+        self._selection_bounds = (x, y, self._selection_bounds[2],
+                                  self._selection_bounds[3])
+
+    def get_selection_bounds(self):
+        """
+            @return x1, y1, width, height - the rectangle to define the area
+        """
+        x, y = self._selection_bounds[0], self._selection_bounds[1]
+        width, height = self._selection_bounds[2], self._selection_bounds[3]
+        width = width * self._selection_horizontal_scale
+        height = height * self._selection_vertical_scale
+        return (x, y, int(width), int(height))
+
+    def create_selection_surface(self, clear_background=True,
+                                 temp_canvas=False):
+        x, y, width, height = self.get_selection_bounds()
+        logging.error('create_selection_surface %s', (x, y, width, height))
+        self.selection_surface = cairo.ImageSurface(
+            cairo.FORMAT_ARGB32, width, height)
+        selection_ctx = cairo.Context(self.selection_surface)
+        selection_ctx.translate(-x, -y)
+        if not temp_canvas:
+            selection_ctx.set_source_surface(self.drawing_canvas)
+        else:
+            selection_ctx.set_source_surface(self.temp_canvas)
+        selection_ctx.paint()
+        self.selection_resized_surface = None
+        self._selection_finished = True
+        if clear_background:
+            self.pending_clean_selection_background = True
+
+    def clear_selection_background(self, temp_canvas=False):
+        # clear the selection background
+        x, y, width, height = self.get_selection_bounds()
+        if not temp_canvas:
+            ctx = self.drawing_ctx
+        else:
+            ctx = self.temp_ctx
+        ctx.save()
+        ctx.new_path()
+        ctx.rectangle(x, y, width, height)
+        self.set_clear_source(ctx)
+        ctx.fill()
+        ctx.restore()
+        if not temp_canvas:
+            self.canvas_changed((x, y, width, height))
+
+    def getout(self, undo=False, clear_selection=True):
+        """
+        Apply the selected area in the canvas.
+
+        @param - undo: enable undo
+        """
+
+        try:
+            # apply selection over canvas
+            if self.is_selected():
+                x, y, width, height = self.get_selection_bounds()
+                selection_surface = self.get_selection()
+                self.drawing_ctx.save()
+                self.drawing_ctx.translate(x, y)
+                self.drawing_ctx.set_source_surface(selection_surface)
+                self.drawing_ctx.rectangle(0, 0, width, height)
+                self.drawing_ctx.paint()
+                self.drawing_ctx.restore()
+                self.canvas_changed((x, y, width, height))
+                self.desenha = False
+
+                if clear_selection:
+                    self.clear_selection()
+                if undo:
+                    self.enable_undo()
+
+        except NameError, message:
+            logging.debug(message)
+        except Exception, message:
+            logging.debug('Unexpected error: %s', message)
+
+    def apply_temp_selection(self):
+        """
+        Apply the selected area in the temp canvas.
+        """
+        # apply selection over canvas
+        if self.is_selected():
+            x, y, width, height = self.get_selection_bounds()
+            selection_surface = self.get_selection()
+            self.temp_ctx.save()
+            self.temp_ctx.translate(x, y)
+            self.temp_ctx.set_source_surface(selection_surface)
+            self.temp_ctx.rectangle(0, 0, width, height)
+            self.temp_ctx.paint()
+            self.temp_ctx.restore()
+
+    def resize_selection_surface(self, horizontal_scale, vertical_scale,
+                                 fast=True):
+        x, y = self._selection_bounds[0], self._selection_bounds[1]
+        new_width = int(self.selection_surface.get_width() * horizontal_scale)
+        new_height = int(self.selection_surface.get_height() * vertical_scale)
+
+        # create a surface with the selection scaled to the new size
+        self.selection_resized_surface = cairo.ImageSurface(
+            cairo.FORMAT_ARGB32, new_width, new_height)
+        temp_ctx = cairo.Context(self.selection_resized_surface)
+        temp_ctx.scale(horizontal_scale, vertical_scale)
+        temp_ctx.set_source_surface(self.selection_surface)
+        temp_ctx.paint()
+
+        # draw over temp canvas
+        self.temp_ctx.save()
+        self.temp_ctx.translate(x, y)
+        self.temp_ctx.set_source_surface(self.selection_resized_surface)
+        self.temp_ctx.rectangle(0, 0, new_width, new_height)
+        if fast:
+            self.temp_ctx.get_source().set_filter(cairo.FILTER_NEAREST)
+
+        self.temp_ctx.paint()
+        self.temp_ctx.restore()
+
+        self._selection_horizontal_scale = horizontal_scale
+        self._selection_vertical_scale = vertical_scale
+
+        self.desenha = True
+        self.queue_draw()
+
+    def get_selection(self):
+        if self.selection_resized_surface is not None:
+            return self.selection_resized_surface
+        if self.selection_surface is not None:
+            return self.selection_surface
+        else:
+            return None
+
+
+class Canvas(CanvasModel):
+    """A drawing in memory, painted with the same tools than the Area
+    widget, for the pointer positions given to tool_start(), tool_move()
+    and tool_end().
+
+    The areas queued to draw are kept until render_frame(), that copies
+    the drawing canvas to the temp canvas there, like the widget does
+    when painted. The text and picker tools need the widget, tool_start()
+    raises ValueError with them.
+    """
+
+    def __init__(self, width, height, tool=None):
+        """
+            @param  tool -- the values of DEFAULT_TOOL to change
+        """
+        self._width = width
+        self._height = height
+        self.drawing_canvas = cairo.ImageSurface(cairo.FORMAT_ARGB32, width,
+                                                 height)
+        self.drawing_ctx = cairo.Context(self.drawing_canvas)
+        self.drawing_ctx.set_source_rgb(1.0, 1.0, 1.0)
+        self.drawing_ctx.paint()
+        self.temp_canvas = cairo.ImageSurface(cairo.FORMAT_ARGB32, width,
+                                              height)
+        self.temp_ctx = cairo.Context(self.temp_canvas)
+        self.tool = dict(DEFAULT_TOOL)
+        if tool is not None:
+            self.tool.update(tool)
+
+        self.oldx = 0
+        self.oldy = 0
+        self.last = []
+        self.desenha = False
+        self.drawing = False
+        self.textos = []
+        self.text_in_progress = False
+        self.pending_clean_selection_background = False
+        self.selection_surface = None
+        # a cairo.ImageSurface or GdkPixbuf.Pixbuf painted by the stamp
+        self.resized_stamp = None
+        self.stamp_dimentions = (0, 0)
+        self._stroke_command = None
+        self._selmove = False
+        self._selresize = False
+        self.keep_shape_ratio = False
+        self.keep_aspect_ratio = False
+        self._last_x_touch = 0
+        self._last_y_touch = 0
+        self.clear_selection()
+        self.d = Desenho(self)
+        self._regions = RegionIndex()
+
+        # rectangles queued to draw since the last frame, None if all
+        self._damage = []
+        # the steps of Undo/Redo, with the command repeating it or None
+        self.undo_steps = []
+        self._render_frame()
+
+    def set_stamp(self, surface):
+        """Use a cairo.ImageSurface as the stamp."""
+        self.resized_stamp = surface
+        self.stamp_dimentions = (surface.get_width(), surface.get_height())
+
+    def get_size(self):
+        return self._width, self._height
+
+    def get_zoom(self):
+        return 1.0
+
+    def queue_draw(self):
+        self._damage = None
+
+    def queue_draw_area(self, x, y, width, height):
+        if self._damage is not None:
+            self._damage.append((x, y, width, height))
+
+    def enable_undo(self, command=None):
+        self._set_undo_command(command)
+        self.canvas_changed()
+
+    def _set_undo_command(self, command):
+        self.undo_steps.append(command)
+
+    def canvas_changed(self, area=None):
+        self._regions.invalidate()
+
+    def _render_frame(self, area=None):
+        self.temp_ctx.save()
+        if area is not None:
+            self.temp_ctx.rectangle(*area)
+            self.temp_ctx.clip()
+        self.temp_ctx.set_source_surface(self.drawing_canvas)
+        self.temp_ctx.set_operator(cairo.OPERATOR_SOURCE)
+        self.temp_ctx.paint()
+        self.temp_ctx.restore()
+
+    def render_frame(self):
+        """Do the work of a frame of the widget, return the rectangle
+        (x, y, width, height) that was queued to draw, None if nothing.
+        """
+        damage = self._damage
+        self._damage = []
+        if damage is None:
+            area = (0, 0, self._width, self._height)
+        elif not damage:
+            return None
+        else:
+            x1 = min(rect[0] for rect in damage)
+            y1 = min(rect[1] for rect in damage)
+            x2 = max(rect[0] + rect[2] for rect in damage)
+            y2 = max(rect[1] + rect[3] for rect in damage)
+            area = (x1, y1, x2 - x1, y2 - y1)
+        self._render_frame(area)
+        return area
+
+    def tool_start(self, x, y, button1_pressed=True):
+        name = self.tool['name']
+        if name not in TRACES and name not in SHAPES and \
+                name not in ('freeform', 'marquee-rectangular', 'bucket'):
+            raise ValueError('the tool %s needs the Area widget' % name)
+        CanvasModel.tool_start(self, x, y, button1_pressed)
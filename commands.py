@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace commands
+
+    Drawing actions recorded as the Desenho calls that painted them, to
+    keep in the Undo/Redo list a few bytes instead of the pixels, and to
+    paint them again over a restored checkpoint.
+
+"""
+
+import fill
+from Desenho import Desenho
+
+
+class _ReplayTarget(object):
+    """Stand in for the Area while a command is painted again.
+
+    The Desenho methods read and write attributes of the widget, the
+    ones that depend on the recorded action are taken from the command,
+    the others are read from the Area. The writes stay in this object.
+    """
+
+    replaying = True
+
+    def __init__(self, area, command):
+        self._area = area
+        self.tool = command.tool
+        self.oldx, self.oldy = command.origin
+        self.resized_stamp = command.stamp
+        self.last = []
+        self.desenha = False
+
+    def __getattr__(self, name):
+        return getattr(self._area, name)
+
+    def enable_undo(self):
+        pass
+
+    def queue_draw(self):
+        # the Area is painted once after all the commands
+        pass
+
+    def queue_draw_area(self, x, y, width, height):
+        pass
+
+
+class Command:
+    """A drawing action, as a list of calls to Desenho methods with the
+    tool used, that paint the same pixels when repeated over the canvas
+    as it was before the action.
+    """
+
+    def __init__(self, area, name=None, *args):
+        """
+            @param  area -- the Area object (GtkDrawingArea)
+            @param  name, args -- the first call, if any
+        """
+        self.tool = dict(area.tool)
+        self.origin = (area.oldx, area.oldy)
+        # the points of the brush trace or the freeform polygon
+        self.points = list(area.d.points)
+        self.stamp = None
+        if self.tool['name'] in ('stamp', 'load-stamp'):
+            self.stamp = area.resized_stamp
+        self.calls = []
+        if name is not None:
+            self.add(name, *args)
+
+    def add(self, name, *args):
+        """Add a call to the method name of Desenho, with the arguments
+        after the widget. The name 'flood_fill' fills with the bucket,
+        with the arguments (x, y, color, tolerance, antialias)."""
+        self.calls.append((name, args))
+
+    def replay(self, area):
+        """Paint the action again over the drawing canvas of area."""
+        target = _ReplayTarget(area, self)
+        desenho = Desenho(target)
+        desenho.points = list(self.points)
+        for name, args in self.calls:
+            if name == 'flood_fill':
+                _flood_fill(area.drawing_canvas, *args)
+            else:
+                getattr(desenho, name)(target, *args)
+
+
+def _flood_fill(surface, x, y, color, tolerance, antialias):
+    surface.flush()
+    damage = fill.fill_surface(surface.get_data(), surface.get_stride(), x,
+                               y, surface.get_width(), surface.get_height(),
+                               color, tolerance, antialias)
+    if damage is not None:
+        surface.mark_dirty_rectangle(*damage)
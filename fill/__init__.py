@@ -5,6 +5,15 @@ import logging
 _sys_path = sys.path
 _root_path = os.path.dirname(__file__)
 
+# True when a binary blob for this platform was loaded
+NATIVE = False
+# True when the blob has fill_surface, with tolerance and antialias
+NATIVE_FILL_SURFACE = False
+# True when the blob has label and fill_label, for regions.RegionIndex
+NATIVE_LABEL = False
+# True when the blob has filter_area, running without the interpreter lock
+NATIVE_FILTERS = False
+
 for i in os.listdir(_root_path):
     path = os.path.join(_root_path, i)
     if (os.path.isdir(path)):
@@ -13,9 +22,28 @@ for i in os.listdir(_root_path):
             from _fill import *
             logging.error('use %s blobs' % path)
             _sys_path = None
+            NATIVE = True
             break
         except Exception, e:
             logging.error('skip %s blobs: %s' % (path, e))
 
 if _sys_path:
-    raise('cannot find proper binary blobs')
+    sys.path = _sys_path
+    logging.error('cannot find proper binary blobs, using python fill')
+    from scanline import fill, fill_surface
+elif 'fill_surface' not in globals():
+    # blobs built from older sources
+    logging.error('old fill blobs, using python fill_surface')
+    from scanline import fill_surface
+else:
+    NATIVE_FILL_SURFACE = True
+    NATIVE_LABEL = 'label' in globals()
+
+if 'filter_area' in globals():
+    NATIVE_FILTERS = True
+else:
+    if NATIVE:
+        logging.error('old fill blobs, using python filter_area')
+    from effects import filter_area, FILTER_BLUR, FILTER_SHARPEN, \
+        FILTER_EDGES, FILTER_POSTERIZE, FILTER_BRIGHTNESS_CONTRAST, \
+        FILTER_HUE, FILTER_PIXELATE, FILTER_INVERT
@@ -0,0 +1,290 @@
+"""
+Python implementation of the image effects of filters.c.
+
+Used when no binary blob matches the running platform, with the same
+arguments and results as the filter_area() of the blobs. The effects
+changing every pixel alone translate whole rows with a table when they
+are opaque, the others work pixel by pixel and are much slower than the
+blobs.
+
+Pixels are 4 bytes each, in native byte order, as in a cairo
+ImageSurface with FORMAT_ARGB32.
+"""
+
+import array
+import math
+import sys
+
+# must match the enum in filters.h
+FILTER_BLUR = 0
+FILTER_SHARPEN = 1
+FILTER_EDGES = 2
+FILTER_POSTERIZE = 3
+FILTER_BRIGHTNESS_CONTRAST = 4
+FILTER_HUE = 5
+FILTER_PIXELATE = 6
+FILTER_INVERT = 7
+
+_PIXEL_SIZE = 4
+_MAX_BLOCK = 1024
+_HUE_SHIFT = 12
+# byte of the alpha channel inside a pixel
+_ALPHA = 3 if sys.byteorder == 'little' else 0
+
+
+def _clamp(value, maximum):
+    if value < 0:
+        return 0
+    if value > maximum:
+        return maximum
+    return value
+
+
+def _unpack(pixel):
+    return [pixel >> 24, (pixel >> 16) & 0xff, (pixel >> 8) & 0xff,
+            pixel & 0xff]
+
+
+def _pack(a, r, g, b):
+    return (a << 24) | (r << 16) | (g << 8) | b
+
+
+class _Rows:
+    """Read the rows of a buffer as lists of channels, repeating the
+    borders of the image."""
+
+    def __init__(self, buf, stride, width, height):
+        self._buf = buf
+        self._stride = stride
+        self.width = width
+        self.height = height
+        self._cache = {}
+
+    def get(self, y):
+        y = _clamp(y, self.height - 1)
+        row = self._cache.get(y)
+        if row is None:
+            offset = y * self._stride
+            row = array.array('I', self._buf[offset:offset + self.width *
+                                             _PIXEL_SIZE])
+            row = self._cache[y] = [_unpack(pixel) for pixel in row]
+        return row
+
+    def pixel(self, x, y):
+        return self.get(y)[_clamp(x, self.width - 1)]
+
+
+def _write_row(dst, stride, x, y, pixels):
+    offset = y * stride + x * _PIXEL_SIZE
+    dst[offset:offset + len(pixels) * _PIXEL_SIZE] = \
+        array.array('I', pixels).tostring()
+
+
+def _blur(rows, dst, stride, area_x, area_y, area_width, area_height,
+          radius):
+    first = max(0, area_y - radius)
+    last = min(rows.height, area_y + area_height + radius)
+    # horizontal sums of the rows needed, as [count, a, r, g, b]
+    sums = {}
+    for y in range(first, last):
+        row = rows.get(y)
+        line = []
+        for x in range(area_x, area_x + area_width):
+            left = max(0, x - radius)
+            right = min(rows.width, x + radius + 1)
+            cell = [right - left, 0, 0, 0, 0]
+            for channels in row[left:right]:
+                for c in range(4):
+                    cell[c + 1] += channels[c]
+            line.append(cell)
+        sums[y] = line
+
+    for y in range(area_y, area_y + area_height):
+        top = max(first, y - radius)
+        bottom = min(last, y + radius + 1)
+        pixels = []
+        for index in range(area_width):
+            total = [0, 0, 0, 0]
+            for row_y in range(top, bottom):
+                cell = sums[row_y][index]
+                for c in range(4):
+                    total[c] += cell[c + 1]
+            count = (bottom - top) * sums[top][index][0]
+            pixels.append(_pack(*[(value + count / 2) / count
+                                  for value in total]))
+        _write_row(dst, stride, area_x, y, pixels)
+
+
+def _convolve(rows, dst, stride, area_x, area_y, area_width, area_height,
+              filter, amount):
+    for y in range(area_y, area_y + area_height):
+        pixels = []
+        for x in range(area_x, area_x + area_width):
+            n = [rows.pixel(x + i - 1, y + j - 1)
+                 for j in range(3) for i in range(3)]
+            alpha = n[4][0]
+            result = [alpha]
+            for c in range(1, 4):
+                if filter == FILTER_SHARPEN:
+                    value = sum([channels[c] for channels in n])
+                    value = n[4][c] + \
+                        int(float(n[4][c] * 9 - value) * amount / 900)
+                else:
+                    gx = n[2][c] + 2 * n[5][c] + n[8][c] - \
+                        n[0][c] - 2 * n[3][c] - n[6][c]
+                    gy = n[6][c] + 2 * n[7][c] + n[8][c] - \
+                        n[0][c] - 2 * n[1][c] - n[2][c]
+                    value = abs(gx) + abs(gy)
+                result.append(_clamp(value, alpha))
+            pixels.append(_pack(*result))
+        _write_row(dst, stride, area_x, y, pixels)
+
+
+def _apply_lut(src, dst, stride, area_x, area_y, area_width, area_height,
+               lut):
+    table = ''.join([chr(value) for value in lut])
+    length = area_width * _PIXEL_SIZE
+    opaque = '\xff' * area_width
+    for y in range(area_y, area_y + area_height):
+        offset = y * stride + area_x * _PIXEL_SIZE
+        row = src[offset:offset + length]
+        if row[_ALPHA::_PIXEL_SIZE] == opaque:
+            # the alpha is translated too, and restored
+            out = bytearray(row.translate(table))
+            out[_ALPHA::_PIXEL_SIZE] = opaque
+            dst[offset:offset + length] = str(out)
+            continue
+        pixels = []
+        for pixel in array.array('I', row):
+            a, r, g, b = _unpack(pixel)
+            if a == 255:
+                pixel = _pack(255, lut[r], lut[g], lut[b])
+            elif a > 0:
+                r = lut[_clamp((r * 255 + a / 2) / a, 255)]
+                g = lut[_clamp((g * 255 + a / 2) / a, 255)]
+                b = lut[_clamp((b * 255 + a / 2) / a, 255)]
+                pixel = _pack(a, (r * a + 127) / 255, (g * a + 127) / 255,
+                              (b * a + 127) / 255)
+            pixels.append(pixel)
+        _write_row(dst, stride, area_x, y, pixels)
+
+
+def _rotate_hue(src, dst, stride, area_x, area_y, area_width, area_height,
+                degrees):
+    angle = math.radians(degrees)
+    cosine = math.cos(angle)
+    sine = math.sin(angle)
+    # fixed point as in filters.c, to give the same results
+    one = 1 << _HUE_SHIFT
+    same = int((cosine + (1.0 - cosine) / 3.0) * one)
+    plus = int(((1.0 - cosine) / 3.0 + math.sqrt(1.0 / 3.0) * sine) * one)
+    minus = int(((1.0 - cosine) / 3.0 - math.sqrt(1.0 / 3.0) * sine) * one)
+    half = one / 2
+    for y in range(area_y, area_y + area_height):
+        offset = y * stride + area_x * _PIXEL_SIZE
+        pixels = []
+        for pixel in array.array('I', src[offset:offset + area_width *
+                                          _PIXEL_SIZE]):
+            a, r, g, b = _unpack(pixel)
+            pixels.append(_pack(
+                a,
+                _clamp((r * same + g * minus + b * plus + half) >>
+                       _HUE_SHIFT, a),
+                _clamp((r * plus + g * same + b * minus + half) >>
+                       _HUE_SHIFT, a),
+                _clamp((r * minus + g * plus + b * same + half) >>
+                       _HUE_SHIFT, a)))
+        _write_row(dst, stride, area_x, y, pixels)
+
+
+def _invert(src, dst, stride, area_x, area_y, area_width, area_height):
+    # with premultiplied colors every channel becomes alpha - value
+    table = ''.join([chr(255 - i) for i in range(256)])
+    length = area_width * _PIXEL_SIZE
+    opaque = '\xff' * area_width
+    for y in range(area_y, area_y + area_height):
+        offset = y * stride + area_x * _PIXEL_SIZE
+        row = src[offset:offset + length]
+        if row[_ALPHA::_PIXEL_SIZE] == opaque:
+            out = bytearray(row.translate(table))
+            out[_ALPHA::_PIXEL_SIZE] = opaque
+            dst[offset:offset + length] = str(out)
+            continue
+        pixels = []
+        for pixel in array.array('I', row):
+            a, r, g, b = _unpack(pixel)
+            pixels.append(_pack(a, a - r, a - g, a - b))
+        _write_row(dst, stride, area_x, y, pixels)
+
+
+def _pixelate(rows, dst, stride, area_x, area_y, area_width, area_height,
+              size):
+    end_x = area_x + area_width
+    end_y = area_y + area_height
+    for block_y in range(area_y / size * size, end_y, size):
+        lines = dict([(y, []) for y in range(max(block_y, area_y),
+                                             min(block_y + size, end_y))])
+        for block_x in range(area_x / size * size, end_x, size):
+            total = [0, 0, 0, 0]
+            count = 0
+            for y in range(block_y, min(block_y + size, rows.height)):
+                for channels in rows.get(y)[block_x:block_x + size]:
+                    for c in range(4):
+                        total[c] += channels[c]
+                    count += 1
+            pixel = _pack(*[(value + count / 2) / count for value in total])
+            width = min(block_x + size, end_x) - max(block_x, area_x)
+            for line in lines.itervalues():
+                line.extend([pixel] * width)
+        for y, line in lines.iteritems():
+            _write_row(dst, stride, area_x, y, line)
+
+
+def filter_area(src, dst, stride, width, height, x, y, area_width,
+                area_height, filter, param1=0, param2=0):
+    """Apply a effect to a rectangle of a buffer, see filters.c for the
+    meaning of the parameters of every filter.
+
+        @param  src -- buffer read, with the same size as dst
+        @param  dst -- writable buffer of 32 bits pixels, like the one
+                       returned by cairo.ImageSurface.get_data()
+    """
+    if width <= 0 or height <= 0 or stride < width * 4 or stride % 4 or \
+            stride * height > len(src) or stride * height > len(dst) or \
+            x < 0 or y < 0 or area_width < 0 or area_height < 0 or \
+            x + area_width > width or y + area_height > height:
+        raise ValueError('size or stride out of the buffer')
+    if filter < FILTER_BLUR or filter > FILTER_INVERT:
+        raise ValueError('unknown filter')
+    if area_width == 0 or area_height == 0:
+        return
+
+    # slices in bytes for any kind of buffer
+    src = buffer(src)
+    area = (x, y, area_width, area_height)
+    if filter == FILTER_POSTERIZE:
+        levels = max(2, min(param1, 255))
+        lut = [((i * (levels - 1) + 127) / 255 * 255 + (levels - 1) / 2) /
+               (levels - 1) for i in range(256)]
+        _apply_lut(src, dst, stride, *(area + (lut,)))
+    elif filter == FILTER_BRIGHTNESS_CONTRAST:
+        brightness = max(-100, min(param1, 100))
+        contrast = max(-100, min(param2, 100))
+        lut = [_clamp(int(float(i - 128) * (100 + contrast) / 100) + 128 +
+                      int(brightness * 255.0 / 100), 255)
+               for i in range(256)]
+        _apply_lut(src, dst, stride, *(area + (lut,)))
+    elif filter == FILTER_HUE:
+        _rotate_hue(src, dst, stride, *(area + (int(math.fmod(param1, 360)),)))
+    elif filter == FILTER_INVERT:
+        _invert(src, dst, stride, *area)
+    else:
+        rows = _Rows(src, stride, width, height)
+        if filter == FILTER_BLUR:
+            _blur(rows, dst, stride, *(area + (_clamp(param1,
+                                                      width + height),)))
+        elif filter == FILTER_PIXELATE:
+            _pixelate(rows, dst, stride,
+                      *(area + (max(1, min(param1, _MAX_BLOCK)),)))
+        else:
+            _convolve(rows, dst, stride, *(area + (filter, param1)))
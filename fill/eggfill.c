@@ -1,7 +1,7 @@
 /*
 eggfill.c
 
-Fill function and queue list
+Scanline fill function and span stack
 
 
 Copyright 2007, NATE-LSI-EPUSP
@@ -53,128 +53,431 @@ Roseli de Deus Lopes                (roseli@lsi.usp.br)
 
 #include "eggfill.h"
 
-#define front(q)   ( (q)->front )
-#define rear(q)    ( (q)->rear )
+#define SPAN_STACK_MIN 64
 
-/* this queue has a Header that points to the Front and Rear elements */
-/* empty queue: q->front = NULL and q->rear = NULL                      */
+/* The stack is allocated once per fill and only grows by doubling, so a
+   fill does a handful of allocations instead of one per pixel. */
 
-/* check if queue q is empty */
-int queue_is_empty(queue *q){
-	return ((front(q)==NULL) && (rear(q)==NULL));
+int span_stack_init(span_stack *s, int capacity){
+    if (capacity < SPAN_STACK_MIN)
+        capacity = SPAN_STACK_MIN;
+    s->items = (span*)malloc(sizeof(span) * capacity);
+    if (s->items == NULL) {
+        printf("Out of space!!!");
+        s->size = 0;
+        s->capacity = 0;
+        return 0;
+    }
+    s->size = 0;
+    s->capacity = capacity;
+    return 1;
 }
 
-queue *queue_init(void){
-    queue *q;
-    q = (queue*)malloc(sizeof(queue));
-    /* check if there is enough space */
-    if( q == NULL )
-        printf( "Out of space!!!" );
-    q->front = NULL;
-    q->rear = NULL;
-    
-    return q;
+void span_stack_destroy(span_stack *s){
+    free(s->items);
+    s->items = NULL;
+    s->size = 0;
+    s->capacity = 0;
 }
 
-void queue_destroy(queue *q){
-	queue_make_empty(q);
-	free(q);
+int span_stack_push(span_stack *s, int y, int x1, int x2, int dy){
+    span *items;
+    if (s->size == s->capacity) {
+        items = (span*)realloc(s->items, sizeof(span) * s->capacity * 2);
+        if (items == NULL) {
+            printf("Out of space!!!");
+            return 0;
+        }
+        s->items = items;
+        s->capacity *= 2;
+    }
+    s->items[s->size].y = y;
+    s->items[s->size].x1 = x1;
+    s->items[s->size].x2 = x2;
+    s->items[s->size].dy = dy;
+    s->size++;
+    return 1;
 }
 
-void queue_make_empty(queue *q){
-    if( q == NULL )
-    	printf( "Must use CreateQueue first" );
-    else
-        while( !queue_is_empty(q) )
-            queue_dequeue(q);
+int span_stack_pop(span_stack *s, span *out){
+    if (s->size == 0)
+        return 0;
+    s->size--;
+    *out = s->items[s->size];
+    return 1;
+}/* end of span stack*/
+
+/* largest difference between the four channels of two pixels */
+static int
+color_distance(unsigned int a, unsigned int b) {
+    int d, max = 0, shift;
+    for (shift = 0; shift < 32; shift += 8) {
+        d = (int)((a >> shift) & 0xff) - (int)((b >> shift) & 0xff);
+        if (d < 0)
+            d = -d;
+        if (d > max)
+            max = d;
+    }
+    return max;
 }
 
-void queue_enqueue(int element, queue *q){
-    no *tmp;
-    tmp = (no*)malloc(sizeof(no));
-    if(tmp == NULL) {
-        printf("Out of space!!!");
-        return;
-    } else {
-        tmp->info = element;
-	tmp->next = NULL;
-	if (queue_is_empty(q)){
-	    q->front = tmp;
-	} else { 
-	    q->rear->next = tmp;
-	}
-	q->rear = tmp;
+/* blend color over pixel, alpha between 0 and 256 */
+static unsigned int
+blend(unsigned int pixel, unsigned int color, int alpha) {
+    unsigned int result = 0;
+    int shift, p, c;
+    for (shift = 0; shift < 32; shift += 8) {
+        p = (pixel >> shift) & 0xff;
+        c = (color >> shift) & 0xff;
+        result |= (unsigned int)((p * (256 - alpha) + c * alpha) >> 8)
+            << shift;
     }
+    return result;
 }
 
-void queue_dequeue(queue *q){
-    if(queue_is_empty(q)) {
-        printf( "Empty queue" );
+/* Without a mask a pixel belongs to the area if it has exactly the start
+   color. With a mask (tolerance mode) it must be close enough to the start
+   color and not be painted yet, because the new color can be close to the
+   start color too. */
+#define INSIDE(X) \
+    (mask == NULL ? row[X] == color_start : \
+        (!mask_row[X] && \
+         color_distance(row[X], color_start) <= tolerance))
+
+#define PAINT(X) \
+    { row[X] = color; if (mask != NULL) mask_row[X] = 1; }
+
+/* push a span only if the row it continues into is inside the image */
+#define PUSH(Y, XL, XR, DY) \
+    if ((Y) + (DY) >= 0 && (Y) + (DY) < height) \
+        if (!span_stack_push(&stack, (Y), (XL), (XR), (DY))) \
+            goto out_of_space;
+
+/*
+ Span based seed fill (Heckbert, "A Seed Fill Algorithm", Graphics Gems).
+ Every popped span is extended to the left and to the right on the next
+ row, the whole run is painted at once, and only the runs that can leak
+ into unvisited rows are pushed back.
+ The rows are stride pixels apart, so the function can work directly over
+ the data of a cairo ImageSurface. damage receives the bounding box of
+ the painted pixels as x, y, width, height (width is 0 if nothing was
+ painted). mask is NULL, or width * height bytes set to zero.
+*/
+static int
+scanfill(unsigned int * pixels, int x, int y, int width, int height,
+         int stride, unsigned int color, int tolerance, unsigned char *mask,
+         int *damage) {
+
+    span_stack stack;
+    span s;
+    unsigned int *row;
+    unsigned char *mask_row = NULL;
+    unsigned int color_start;
+    int l, x1, x2, dy;
+    int min_x = width, min_y = height, max_x = -1, max_y = -1;
+
+    damage[0] = damage[1] = damage[2] = damage[3] = 0;
+
+    color_start = pixels[x + y * stride];
+
+    if (!span_stack_init(&stack, height * 2))
+        return 0;
+
+    /* the seed span, popped first, and its continuation upwards */
+    span_stack_push(&stack, y, x, x, 1);
+    span_stack_push(&stack, y + 1, x, x, -1);
+
+    while (span_stack_pop(&stack, &s)) {
+        y = s.y + s.dy;
+        x1 = s.x1;
+        x2 = s.x2;
+        dy = s.dy;
+        if (y < 0 || y >= height)
+            continue;
+        row = pixels + y * stride;
+        if (mask != NULL)
+            mask_row = mask + y * width;
+
+        /* extend to the left of x1 */
+        for (x = x1; x >= 0 && INSIDE(x); x--)
+            PAINT(x);
+
+        if (x >= x1)
+            goto skip;
+
+        l = x + 1;
+        if (l < x1) {
+            /* leak on the left, the previous row needs a look */
+            PUSH(y, l, x1 - 1, -dy);
+        }
+        x = x1 + 1;
+
+        do {
+            for (; x < width && INSIDE(x); x++)
+                PAINT(x);
+
+            /* the run [l, x - 1] was painted */
+            if (l < min_x)
+                min_x = l;
+            if (x - 1 > max_x)
+                max_x = x - 1;
+            if (y < min_y)
+                min_y = y;
+            if (y > max_y)
+                max_y = y;
+            PUSH(y, l, x - 1, dy);
+            if (x > x2 + 1) {
+                /* leak on the right */
+                PUSH(y, x2 + 1, x - 1, -dy);
+            }
+skip:
+            for (x++; x <= x2 && !INSIDE(x); x++)
+                ;
+            l = x;
+        } while (x <= x2);
+    }
+    span_stack_destroy(&stack);
+    if (max_x >= 0) {
+        damage[0] = min_x;
+        damage[1] = min_y;
+        damage[2] = max_x - min_x + 1;
+        damage[3] = max_y - min_y + 1;
     }
-    else {
-        no *tmp = q->front;
-        q->front = q->front->next;
-        if (q->front==NULL) {
-		    q->rear=NULL;
+    return 1;
+
+out_of_space:
+    span_stack_destroy(&stack);
+    return 0;
+}
+
+/*
+ Anti-alias the border of a masked fill: every pixel not painted but
+ touching a painted one receives the new color with an opacity that
+ decreases with its distance to the start color, so the soft edges of
+ the strokes do not keep a halo of the old color.
+*/
+static void
+feather(unsigned int * pixels, int width, int height, int stride,
+        unsigned int color, unsigned int color_start, int tolerance,
+        unsigned char *mask, int *damage) {
+
+    int x, y, d, alpha;
+    int x0 = damage[0] - 1, y0 = damage[1] - 1;
+    int x1 = damage[0] + damage[2], y1 = damage[1] + damage[3];
+    unsigned int *row;
+    unsigned char *mask_row;
+
+    if (x0 < 0)
+        x0 = 0;
+    if (y0 < 0)
+        y0 = 0;
+    if (x1 >= width)
+        x1 = width - 1;
+    if (y1 >= height)
+        y1 = height - 1;
+
+    for (y = y0; y <= y1; y++) {
+        row = pixels + y * stride;
+        mask_row = mask + y * width;
+        for (x = x0; x <= x1; x++) {
+            if (mask_row[x])
+                continue;
+            if (!((x > 0 && mask_row[x - 1] == 1) ||
+                  (x < width - 1 && mask_row[x + 1] == 1) ||
+                  (y > 0 && mask_row[x - width] == 1) ||
+                  (y < height - 1 && mask_row[x + width] == 1)))
+                continue;
+            d = color_distance(row[x], color_start);
+            if (d >= 255)
+                continue;
+            alpha = (255 - d) * 256 / (256 - tolerance);
+            if (alpha > 256)
+                alpha = 256;
+            row[x] = blend(row[x], color, alpha);
+            /* do not count it as painted for its neighbors */
+            mask_row[x] = 2;
         }
-        free(tmp);
     }
-}/* end of queue*/
-
-void
-floodfill(unsigned long * pixels, int x, int y, int width, int height,unsigned long color) {
-
-    printf("\nEntrando to floodfill\n");
-    queue *lista_xy;
-    
-    lista_xy = queue_init();
-
-    int color_start = pixels[x + y * width];
-   
-    if (color != color_start) {
-        queue_enqueue(x, lista_xy);
-        queue_enqueue(y, lista_xy);
-
-        pixels[x + y * width] = color;
-
-        while (!queue_is_empty(lista_xy)) {
-            if (x + 1 < width) {
-                if (pixels[(x + 1) + y * width] == color_start) {
-                    pixels[(x + 1) + y * width] = color;
-                    queue_enqueue(x+1, lista_xy);
-                    queue_enqueue(y, lista_xy);
-                }
-            }
+    /* the feathered border can grow the damaged area by one pixel */
+    damage[0] = x0;
+    damage[1] = y0;
+    damage[2] = x1 - x0 + 1;
+    damage[3] = y1 - y0 + 1;
+}
 
-            if (x - 1 >= 0){
-                if (pixels[(x - 1) + y * width] == color_start) {
-                    pixels[(x - 1) + y * width] = color;
-                    queue_enqueue(x-1, lista_xy);
-                    queue_enqueue(y, lista_xy);
-                }
-            }
+/*
+ Fill the area connected to (x, y) with color. Pixels belong to the area
+ if no channel differs from the start color by more than tolerance (0 to
+ 255). If antialias is not 0, the border of the area is feathered.
+ If damage is not NULL it receives the bounding box of the changed pixels
+ as x, y, width, height (width is 0 if nothing changed).
+ Returns 0 if there was not enough memory, 1 otherwise.
+*/
+int
+floodfill(unsigned int * pixels, int x, int y, int width, int height,
+          int stride, unsigned int color, int tolerance, int antialias,
+          int *damage) {
+
+    int area[4] = {0, 0, 0, 0};
+    unsigned char *mask = NULL;
+    unsigned int color_start;
+    int ok;
+
+    if (damage == NULL)
+        damage = area;
+    damage[0] = damage[1] = damage[2] = damage[3] = 0;
+
+    if (x < 0 || x >= width || y < 0 || y >= height)
+        return 1;
+
+    color_start = pixels[x + y * stride];
+    if (tolerance < 0)
+        tolerance = 0;
+    if (tolerance > 255)
+        tolerance = 255;
+
+    if (tolerance == 0 && !antialias) {
+        if (color == color_start)
+            return 1;
+        return scanfill(pixels, x, y, width, height, stride, color, 0, NULL,
+                        damage);
+    }
 
-            if (y + 1 < height){
-                if (pixels[x + (y + 1) * width] == color_start) {
-                    pixels[x + (y + 1) * width] = color;
-                    queue_enqueue(x, lista_xy);
-                    queue_enqueue(y+1, lista_xy);
-                }
-            }
+    mask = (unsigned char *)calloc((size_t)width * height, 1);
+    if (mask == NULL)
+        return 0;
+    ok = scanfill(pixels, x, y, width, height, stride, color, tolerance,
+                  mask, damage);
+    if (ok && antialias && damage[2] > 0)
+        feather(pixels, width, height, stride, color, color_start,
+                tolerance, mask, damage);
+    free(mask);
+    return ok;
+}
 
-            if (y - 1 >= 0){
-                if (pixels[x + (y - 1) * width] == color_start){
-                    pixels[x + (y - 1) * width] = color;
-                    queue_enqueue(x, lista_xy);
-                    queue_enqueue(y-1, lista_xy);
+/* union find over the provisional labels */
+static unsigned int
+label_find(unsigned int *parent, unsigned int i) {
+    while (parent[i] != i) {
+        parent[i] = parent[parent[i]];
+        i = parent[i];
+    }
+    return i;
+}
+
+/*
+ Give the same label to all the pixels of each 4-connected area of the
+ same color. labels has width * height items and receives values from 0
+ to the returned count - 1. Returns -1 if there was not enough memory.
+ Two passes: provisional labels are merged with a union find when a
+ pixel joins the areas of its left and top neighbors, then every label
+ is replaced by a compact number for its root.
+*/
+int
+label_regions(unsigned int * pixels, int width, int height, int stride,
+              unsigned int *labels) {
+
+    unsigned int *parent, *grown, *compact;
+    unsigned int count = 0, capacity = 1024, left, top, a, b;
+    int x, y, regions = 0;
+    unsigned int *row, *label_row;
+
+    parent = (unsigned int *)malloc(sizeof(unsigned int) * capacity);
+    if (parent == NULL)
+        return -1;
+
+    for (y = 0; y < height; y++) {
+        row = pixels + y * stride;
+        label_row = labels + y * width;
+        for (x = 0; x < width; x++) {
+            left = (x > 0 && row[x - 1] == row[x]);
+            top = (y > 0 && row[x - stride] == row[x]);
+            if (left && top) {
+                label_row[x] = label_row[x - 1];
+                a = label_find(parent, label_row[x - 1]);
+                b = label_find(parent, label_row[x - width]);
+                if (a < b)
+                    parent[b] = a;
+                else if (b < a)
+                    parent[a] = b;
+            } else if (left) {
+                label_row[x] = label_row[x - 1];
+            } else if (top) {
+                label_row[x] = label_row[x - width];
+            } else {
+                if (count == capacity) {
+                    grown = (unsigned int *)realloc(
+                        parent, sizeof(unsigned int) * capacity * 2);
+                    if (grown == NULL) {
+                        free(parent);
+                        return -1;
+                    }
+                    parent = grown;
+                    capacity *= 2;
                 }
+                parent[count] = count;
+                label_row[x] = count++;
             }
-            x = lista_xy->front->info;
-            queue_dequeue(lista_xy);
-            y = lista_xy->front->info;
-            queue_dequeue(lista_xy);
-       }
-   }
-   queue_destroy(lista_xy);
-} 
+        }
+    }
+
+    /* roots are always smaller than their children, so one pass in order
+       is enough to give them consecutive numbers */
+    compact = (unsigned int *)malloc(sizeof(unsigned int) * (count + 1));
+    if (compact == NULL) {
+        free(parent);
+        return -1;
+    }
+    for (a = 0; a < count; a++) {
+        b = label_find(parent, a);
+        if (b == a)
+            compact[a] = regions++;
+        else
+            compact[a] = compact[b];
+    }
+    for (y = 0; y < height; y++) {
+        label_row = labels + y * width;
+        for (x = 0; x < width; x++)
+            label_row[x] = compact[label_row[x]];
+    }
+    free(compact);
+    free(parent);
+    return regions;
+}
 
+/*
+ Paint with color every pixel with the given label inside the rectangle
+ x, y, width, height. Returns 1 if the painted area now touches another
+ area that already had the new color, meaning that both should be one
+ area in the labels.
+*/
+int
+fill_label(unsigned int * pixels, int width, int height, int stride,
+           unsigned int *labels, unsigned int label, unsigned int color,
+           int area_x, int area_y, int area_width, int area_height) {
+
+    int x, y, touch = 0;
+    unsigned int *row, *label_row;
+
+    for (y = area_y; y < area_y + area_height; y++) {
+        row = pixels + y * stride;
+        label_row = labels + y * width;
+        for (x = area_x; x < area_x + area_width; x++) {
+            if (label_row[x] != label)
+                continue;
+            row[x] = color;
+            if (touch)
+                continue;
+            if ((x > 0 && label_row[x - 1] != label &&
+                    row[x - 1] == color) ||
+                (x < width - 1 && label_row[x + 1] != label &&
+                    row[x + 1] == color) ||
+                (y > 0 && label_row[x - width] != label &&
+                    row[x - stride] == color) ||
+                (y < height - 1 && label_row[x + width] != label &&
+                    row[x + stride] == color))
+                touch = 1;
+        }
+    }
+    return touch;
+}
@@ -1,7 +1,7 @@
 /*
 eggfill.h
 
-Fill function and queue list
+Scanline fill function and span stack
 
 
 Copyright 2007, NATE-LSI-EPUSP
@@ -50,27 +50,38 @@ Cientific Coordinator:
 Roseli de Deus Lopes                (roseli@lsi.usp.br)
 
 */
+
 #include <stdio.h>
 #include <stdlib.h>
 
-/*to implement a queue */
-typedef struct _tno {
-    int info;
-   struct _tno *next;
-} no;
-
-typedef struct _tqueue{
-    no *front;
-    no *rear;
-} queue;
-
-
-int queue_is_empty(queue *q);
-queue *queue_init(void);
-void disposequeue(queue *q);
-void queue_make_empty(queue *q);
-void queue_enqueue(int element, queue *q);
-void queue_dequeue(queue *q);
-/*end of queue*/
-
-void floodfill(unsigned long * pixels, int x, int y, int width, int height, unsigned long color);
+/* a horizontal run of pixels [x1, x2] in row y, to be continued in the
+   direction dy (+1 down, -1 up) */
+typedef struct _tspan {
+    int y;
+    int x1;
+    int x2;
+    int dy;
+} span;
+
+/* growable stack of spans, allocated once per fill */
+typedef struct _tspan_stack {
+    span *items;
+    int size;
+    int capacity;
+} span_stack;
+
+int span_stack_init(span_stack *s, int capacity);
+void span_stack_destroy(span_stack *s);
+int span_stack_push(span_stack *s, int y, int x1, int x2, int dy);
+int span_stack_pop(span_stack *s, span *out);
+/*end of span stack*/
+
+int floodfill(unsigned int * pixels, int x, int y, int width, int height,
+              int stride, unsigned int color, int tolerance, int antialias,
+              int *damage);
+
+int label_regions(unsigned int * pixels, int width, int height, int stride,
+                  unsigned int *labels);
+int fill_label(unsigned int * pixels, int width, int height, int stride,
+               unsigned int *labels, unsigned int label, unsigned int color,
+               int area_x, int area_y, int area_width, int area_height);
@@ -46,8 +46,10 @@ Cientific Coordinator:
 Roseli de Deus Lopes                (roseli@lsi.usp.br)
 
 */
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include "eggfill.h"
+#include "filters.h"
 
 static PyObject* fill(PyObject* self, PyObject* args)
 {
@@ -58,25 +60,40 @@ static PyObject* fill(PyObject* self, PyObject* args)
         return NULL;
 
     /* from http://mail.python.org/pipermail/tutor/1999-November/000758.html */
-    unsigned long *intarr, arrsize, index;
+    unsigned int *intarr;
+    Py_ssize_t arrsize, index;
     PyObject *item;
     PyObject *pylist;
+    int ok;
 
     /* how many elements are in the Python object */
     arrsize = PyObject_Length(mylist);
+    if (arrsize < 0)
+        return NULL;
+    if ((Py_ssize_t)width * height > arrsize || x >= width || y >= height) {
+        PyErr_SetString(PyExc_ValueError, "point or size out of the array");
+        return NULL;
+    }
     /* create a dynamic C array of integers */
-    intarr = (unsigned long *)malloc(sizeof(unsigned long)*arrsize);
+    intarr = (unsigned int *)malloc(sizeof(unsigned int) * arrsize);
+    if (intarr == NULL)
+        return PyErr_NoMemory();
     for (index = 0; index < arrsize; index++) {
         /* get the element from the list/tuple */
         item = PySequence_GetItem(mylist, index);
         /* assign to the C array */
-        intarr[index] = PyLong_AsUnsignedLong(item);
+        intarr[index] = (unsigned int)PyLong_AsUnsignedLong(item);
         Py_DECREF(item);
     }
 
     /* now use intarr and arrsize in you extension */
-    printf("x %u y %u width %u height %u color %u", x, y, width, height, color);
-    floodfill(intarr, x, y, width, height, color);
+    Py_BEGIN_ALLOW_THREADS
+    ok = floodfill(intarr, x, y, width, height, width, color, 0, 0, NULL);
+    Py_END_ALLOW_THREADS
+    if (!ok) {
+        free(intarr);
+        return PyErr_NoMemory();
+    }
 
     pylist = PyTuple_New(arrsize);
     for (index = 0; index < arrsize; index++) {
@@ -86,14 +103,246 @@ static PyObject* fill(PyObject* self, PyObject* args)
     return pylist;
 }
 
+/*
+ fill_surface(data, stride, x, y, width, height, color[, tolerance,
+              antialias])
+
+ Flood fill in place any writable buffer with 32 bits pixels, like the
+ one returned by cairo.ImageSurface.get_data(). stride is in bytes.
+ tolerance (0 to 255) is the largest difference allowed per channel with
+ the start color; antialias feathers the border of the filled area.
+ Returns the damaged rectangle as (x, y, width, height), or None if no
+ pixel was changed.
+*/
+static PyObject* fill_surface(PyObject* self, PyObject* args)
+{
+    char *data;
+    Py_ssize_t size;
+    int x, y, width, height, stride;
+    unsigned int color;
+    int tolerance = 0, antialias = 0;
+    int damage[4];
+    int ok;
+
+    if (!PyArg_ParseTuple(args, "w#iiiiiI|ii", &data, &size, &stride, &x, &y,
+                          &width, &height, &color, &tolerance, &antialias))
+        return NULL;
+
+    if (width < 0 || height < 0 || stride < width * 4 || stride % 4 != 0 ||
+            (Py_ssize_t)stride * height > size) {
+        PyErr_SetString(PyExc_ValueError, "size or stride out of the buffer");
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    ok = floodfill((unsigned int *)data, x, y, width, height, stride / 4,
+                   color, tolerance, antialias, damage);
+    Py_END_ALLOW_THREADS
+    if (!ok)
+        return PyErr_NoMemory();
+
+    if (damage[2] == 0)
+        Py_RETURN_NONE;
+    return Py_BuildValue("(iiii)", damage[0], damage[1], damage[2],
+                         damage[3]);
+}
+
+/*
+ label(data, stride, width, height, labels)
+
+ Find the connected areas of the same color in a buffer of 32 bits
+ pixels. labels is a writable buffer with room for width * height 32 bits
+ integers, it receives the number of area of every pixel.
+ Returns a list with the bounding box (x, y, width, height) of each area.
+*/
+static PyObject* label(PyObject* self, PyObject* args)
+{
+    char *data, *labels_data;
+    Py_ssize_t size, labels_size;
+    int x, y, width, height, stride, regions, i;
+    unsigned int *labels, *label_row;
+    int *bounds;
+    PyObject *result, *item;
+
+    if (!PyArg_ParseTuple(args, "w#iiiw#", &data, &size, &stride, &width,
+                          &height, &labels_data, &labels_size))
+        return NULL;
+
+    if (width <= 0 || height <= 0 || stride < width * 4 || stride % 4 != 0 ||
+            (Py_ssize_t)stride * height > size ||
+            (Py_ssize_t)width * height * 4 > labels_size) {
+        PyErr_SetString(PyExc_ValueError, "size or stride out of the buffer");
+        return NULL;
+    }
+    labels = (unsigned int *)labels_data;
+
+    Py_BEGIN_ALLOW_THREADS
+    regions = label_regions((unsigned int *)data, width, height, stride / 4,
+                            labels);
+    Py_END_ALLOW_THREADS
+    if (regions < 0)
+        return PyErr_NoMemory();
+
+    /* min x, min y, max x, max y of every area */
+    bounds = (int *)malloc(sizeof(int) * 4 * (regions + 1));
+    if (bounds == NULL)
+        return PyErr_NoMemory();
+    for (i = 0; i < regions; i++) {
+        bounds[i * 4] = width;
+        bounds[i * 4 + 1] = height;
+        bounds[i * 4 + 2] = -1;
+        bounds[i * 4 + 3] = -1;
+    }
+    for (y = 0; y < height; y++) {
+        label_row = labels + y * width;
+        for (x = 0; x < width; x++) {
+            i = label_row[x] * 4;
+            if (x < bounds[i])
+                bounds[i] = x;
+            if (y < bounds[i + 1])
+                bounds[i + 1] = y;
+            if (x > bounds[i + 2])
+                bounds[i + 2] = x;
+            if (y > bounds[i + 3])
+                bounds[i + 3] = y;
+        }
+    }
+
+    result = PyList_New(regions);
+    if (result == NULL) {
+        free(bounds);
+        return NULL;
+    }
+    for (i = 0; i < regions; i++) {
+        item = Py_BuildValue("(iiii)", bounds[i * 4], bounds[i * 4 + 1],
+                             bounds[i * 4 + 2] - bounds[i * 4] + 1,
+                             bounds[i * 4 + 3] - bounds[i * 4 + 1] + 1);
+        if (item == NULL) {
+            Py_DECREF(result);
+            free(bounds);
+            return NULL;
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+    free(bounds);
+    return result;
+}
+
+/*
+ fill_label(data, stride, width, height, labels, label, color, x, y,
+            area_width, area_height)
+
+ Paint with color all the pixels of one area found by label(), the area
+ bounding box is given to avoid looking at the whole buffer.
+ Returns True if the area now touches another area of the same color.
+*/
+static PyObject* fill_label_py(PyObject* self, PyObject* args)
+{
+    char *data, *labels_data;
+    Py_ssize_t size, labels_size;
+    int width, height, stride, x, y, area_width, area_height, touch;
+    unsigned int label, color;
+
+    if (!PyArg_ParseTuple(args, "w#iiiw#IIiiii", &data, &size, &stride,
+                          &width, &height, &labels_data, &labels_size,
+                          &label, &color, &x, &y, &area_width, &area_height))
+        return NULL;
+
+    if (width <= 0 || height <= 0 || stride < width * 4 || stride % 4 != 0 ||
+            (Py_ssize_t)stride * height > size ||
+            (Py_ssize_t)width * height * 4 > labels_size ||
+            x < 0 || y < 0 || area_width < 0 || area_height < 0 ||
+            x + area_width > width || y + area_height > height) {
+        PyErr_SetString(PyExc_ValueError, "size or stride out of the buffer");
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    touch = fill_label((unsigned int *)data, width, height, stride / 4,
+                       (unsigned int *)labels_data, label, color, x, y,
+                       area_width, area_height);
+    Py_END_ALLOW_THREADS
+
+    return PyBool_FromLong(touch);
+}
+
+
+/*
+ filter_area(src, dst, stride, width, height, x, y, area_width,
+             area_height, filter[, param1, param2])
+
+ Apply one of the effects of filters.c to a rectangle of a buffer of 32
+ bits pixels. The pixels are read from src and written to the writable
+ buffer dst, both with the same size and stride in bytes. The lock of
+ the interpreter is released while working, so many rectangles can be
+ done at the same time from different threads.
+*/
+static PyObject* filter_area_py(PyObject* self, PyObject* args)
+{
+    const char *src;
+    char *dst;
+    Py_ssize_t src_size, dst_size;
+    int width, height, stride, x, y, area_width, area_height, filter, ok;
+    int param1 = 0, param2 = 0;
+
+    if (!PyArg_ParseTuple(args, "s#w#iiiiiiii|ii", &src, &src_size, &dst,
+                          &dst_size, &stride, &width, &height, &x, &y,
+                          &area_width, &area_height, &filter, &param1,
+                          &param2))
+        return NULL;
+
+    if (width <= 0 || height <= 0 || stride < width * 4 || stride % 4 != 0 ||
+            (Py_ssize_t)stride * height > src_size ||
+            (Py_ssize_t)stride * height > dst_size ||
+            x < 0 || y < 0 || area_width < 0 || area_height < 0 ||
+            x + area_width > width || y + area_height > height) {
+        PyErr_SetString(PyExc_ValueError, "size or stride out of the buffer");
+        return NULL;
+    }
+    if (filter < 0 || filter >= FILTER_COUNT) {
+        PyErr_SetString(PyExc_ValueError, "unknown filter");
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    ok = filter_area((const unsigned int *)src, (unsigned int *)dst, width,
+                     height, stride / 4, x, y, area_width, area_height,
+                     filter, param1, param2);
+    Py_END_ALLOW_THREADS
+    if (!ok)
+        return PyErr_NoMemory();
+
+    Py_RETURN_NONE;
+}
 
 static PyMethodDef FillMethods[] = {
     {"fill", fill, METH_VARARGS, "do fill flood in a array with the image data"},
+    {"fill_surface", fill_surface, METH_VARARGS,
+     "do fill flood in place in a buffer, returns the damaged area"},
+    {"label", label, METH_VARARGS,
+     "find the connected areas of the same color in a buffer"},
+    {"fill_label", fill_label_py, METH_VARARGS,
+     "paint one of the areas found by label"},
+    {"filter_area", filter_area_py, METH_VARARGS,
+     "apply a image effect to a rectangle of a buffer"},
     {NULL, NULL, 0, NULL}
 };
  
 PyMODINIT_FUNC
 init_fill(void)
 {
-    (void) Py_InitModule("_fill", FillMethods);
+    PyObject *module;
+
+    module = Py_InitModule("_fill", FillMethods);
+    if (module == NULL)
+        return;
+    PyModule_AddIntConstant(module, "FILTER_BLUR", FILTER_BLUR);
+    PyModule_AddIntConstant(module, "FILTER_SHARPEN", FILTER_SHARPEN);
+    PyModule_AddIntConstant(module, "FILTER_EDGES", FILTER_EDGES);
+    PyModule_AddIntConstant(module, "FILTER_POSTERIZE", FILTER_POSTERIZE);
+    PyModule_AddIntConstant(module, "FILTER_BRIGHTNESS_CONTRAST",
+                            FILTER_BRIGHTNESS_CONTRAST);
+    PyModule_AddIntConstant(module, "FILTER_HUE", FILTER_HUE);
+    PyModule_AddIntConstant(module, "FILTER_PIXELATE", FILTER_PIXELATE);
+    PyModule_AddIntConstant(module, "FILTER_INVERT", FILTER_INVERT);
 }
@@ -0,0 +1,407 @@
+/*
+filters.c
+
+Image effects over a rectangle of a ARGB32 buffer. The pixels are read
+from src and written to dst, both with the same size and stride. The
+effects looking at the neighbors of a pixel need a src different from
+dst, the ones changing every pixel alone (posterize, brightness and
+contrast, hue, invert) can use the same buffer.
+
+The rectangles of a image can be processed in parallel, every one only
+reads src outside of it.
+
+Oficina is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation version 2 of
+the License.
+*/
+
+#include <stdlib.h>
+#include <math.h>
+#include "filters.h"
+
+#define ALPHA(p) ((int)((p) >> 24))
+#define RED(p) ((int)(((p) >> 16) & 0xff))
+#define GREEN(p) ((int)(((p) >> 8) & 0xff))
+#define BLUE(p) ((int)((p) & 0xff))
+#define PACK(a, r, g, b) (((unsigned int)(a) << 24) | \
+                          ((unsigned int)(r) << 16) | \
+                          ((unsigned int)(g) << 8) | (unsigned int)(b))
+
+/* biggest pixelate block, to not overflow the sums */
+#define MAX_BLOCK 1024
+/* fixed point precision of the hue rotation */
+#define HUE_SHIFT 12
+
+static int
+clamp(int value, int max) {
+    if (value < 0)
+        return 0;
+    if (value > max)
+        return max;
+    return value;
+}
+
+/* the pixel at x, y, repeating the borders of the image */
+static unsigned int
+pixel_at(const unsigned int *src, int width, int height, int stride,
+         int x, int y) {
+    return src[clamp(y, height - 1) * stride + clamp(x, width - 1)];
+}
+
+/* channels of a pixel, alpha first */
+static void
+unpack(unsigned int pixel, int *channels) {
+    channels[0] = ALPHA(pixel);
+    channels[1] = RED(pixel);
+    channels[2] = GREEN(pixel);
+    channels[3] = BLUE(pixel);
+}
+
+/*
+ Average of the pixels in a square of side 2 * radius + 1, done as a
+ horizontal and a vertical pass with running sums, so the cost does not
+ depend on the radius. Near the borders only the pixels inside the image
+ are counted.
+*/
+static int
+box_blur(const unsigned int *src, unsigned int *dst, int width, int height,
+         int stride, int area_x, int area_y, int area_width,
+         int area_height, int radius) {
+
+    int first, last, rows, x, y, i, c, count, left, right, total;
+    int *sums, *counts, *cell;
+    int sum[4], channels[4];
+    const unsigned int *row;
+
+    first = area_y - radius < 0 ? 0 : area_y - radius;
+    last = area_y + area_height + radius > height ?
+        height : area_y + area_height + radius;
+    rows = last - first;
+    sums = (int *)malloc(sizeof(int) * 4 * area_width * rows);
+    counts = (int *)malloc(sizeof(int) * area_width);
+    if (sums == NULL || counts == NULL) {
+        free(sums);
+        free(counts);
+        return 0;
+    }
+
+    /* horizontal sums of all the rows needed by the area */
+    for (y = first; y < last; y++) {
+        row = src + y * stride;
+        cell = sums + (y - first) * area_width * 4;
+        sum[0] = sum[1] = sum[2] = sum[3] = 0;
+        count = 0;
+        left = area_x - radius;
+        right = area_x + radius;
+        for (i = left < 0 ? 0 : left; i <= right && i < width; i++) {
+            unpack(row[i], channels);
+            for (c = 0; c < 4; c++)
+                sum[c] += channels[c];
+            count++;
+        }
+        for (x = 0; x < area_width; x++) {
+            for (c = 0; c < 4; c++)
+                cell[x * 4 + c] = sum[c];
+            counts[x] = count;
+            /* move the window one pixel to the right */
+            if (left >= 0) {
+                unpack(row[left], channels);
+                for (c = 0; c < 4; c++)
+                    sum[c] -= channels[c];
+                count--;
+            }
+            left++;
+            right++;
+            if (right < width) {
+                unpack(row[right], channels);
+                for (c = 0; c < 4; c++)
+                    sum[c] += channels[c];
+                count++;
+            }
+        }
+    }
+
+    /* vertical sums of the horizontal ones */
+    for (x = 0; x < area_width; x++) {
+        sum[0] = sum[1] = sum[2] = sum[3] = 0;
+        count = 0;
+        left = area_y - radius;
+        right = area_y + radius;
+        for (i = left < first ? first : left; i <= right && i < last; i++) {
+            cell = sums + ((i - first) * area_width + x) * 4;
+            for (c = 0; c < 4; c++)
+                sum[c] += cell[c];
+            count++;
+        }
+        for (y = 0; y < area_height; y++) {
+            total = count * counts[x];
+            dst[(area_y + y) * stride + area_x + x] = PACK(
+                (sum[0] + total / 2) / total, (sum[1] + total / 2) / total,
+                (sum[2] + total / 2) / total, (sum[3] + total / 2) / total);
+            if (left >= first) {
+                cell = sums + ((left - first) * area_width + x) * 4;
+                for (c = 0; c < 4; c++)
+                    sum[c] -= cell[c];
+                count--;
+            }
+            left++;
+            right++;
+            if (right < last) {
+                cell = sums + ((right - first) * area_width + x) * 4;
+                for (c = 0; c < 4; c++)
+                    sum[c] += cell[c];
+                count++;
+            }
+        }
+    }
+    free(counts);
+    free(sums);
+    return 1;
+}
+
+/*
+ Sharpen (unsharp mask against the average of the 3x3 neighborhood,
+ amount in percent) or edge detection (Sobel operator). The alpha is
+ kept, the colors are limited to it to stay valid premultiplied values.
+*/
+static void
+convolve(const unsigned int *src, unsigned int *dst, int width, int height,
+         int stride, int area_x, int area_y, int area_width,
+         int area_height, int filter, int amount) {
+
+    int x, y, i, j, c, value, gx, gy;
+    int n[9][4];
+
+    for (y = area_y; y < area_y + area_height; y++) {
+        for (x = area_x; x < area_x + area_width; x++) {
+            for (j = 0; j < 3; j++)
+                for (i = 0; i < 3; i++)
+                    unpack(pixel_at(src, width, height, stride,
+                                    x + i - 1, y + j - 1), n[j * 3 + i]);
+            for (c = 1; c < 4; c++) {
+                if (filter == FILTER_SHARPEN) {
+                    value = 0;
+                    for (i = 0; i < 9; i++)
+                        value += n[i][c];
+                    value = n[4][c] +
+                        (n[4][c] * 9 - value) * amount / 900;
+                } else {
+                    gx = n[2][c] + 2 * n[5][c] + n[8][c] -
+                        n[0][c] - 2 * n[3][c] - n[6][c];
+                    gy = n[6][c] + 2 * n[7][c] + n[8][c] -
+                        n[0][c] - 2 * n[1][c] - n[2][c];
+                    value = abs(gx) + abs(gy);
+                }
+                n[4][c] = clamp(value, n[4][0]);
+            }
+            dst[y * stride + x] = PACK(n[4][0], n[4][1], n[4][2], n[4][3]);
+        }
+    }
+}
+
+/*
+ Replace every color channel with lut[channel]. The table works on not
+ premultiplied colors, the translucent pixels are converted back and
+ forth.
+*/
+static void
+apply_lut(const unsigned int *src, unsigned int *dst, int stride,
+          int area_x, int area_y, int area_width, int area_height,
+          const unsigned char *lut) {
+
+    int x, y, a, r, g, b;
+    unsigned int pixel;
+
+    for (y = area_y; y < area_y + area_height; y++) {
+        for (x = area_x; x < area_x + area_width; x++) {
+            pixel = src[y * stride + x];
+            a = ALPHA(pixel);
+            if (a == 255) {
+                pixel = PACK(255, lut[RED(pixel)], lut[GREEN(pixel)],
+                             lut[BLUE(pixel)]);
+            } else if (a > 0) {
+                r = lut[clamp((RED(pixel) * 255 + a / 2) / a, 255)];
+                g = lut[clamp((GREEN(pixel) * 255 + a / 2) / a, 255)];
+                b = lut[clamp((BLUE(pixel) * 255 + a / 2) / a, 255)];
+                pixel = PACK(a, (r * a + 127) / 255, (g * a + 127) / 255,
+                             (b * a + 127) / 255);
+            }
+            dst[y * stride + x] = pixel;
+        }
+    }
+}
+
+/*
+ Rotate the colors around the gray axis of the RGB cube. The rotation is
+ linear, so it works directly over premultiplied colors.
+*/
+static void
+rotate_hue(const unsigned int *src, unsigned int *dst, int stride,
+           int area_x, int area_y, int area_width, int area_height,
+           int degrees) {
+
+    double angle = degrees * M_PI / 180.0;
+    double cosine = cos(angle), sine = sin(angle);
+    double same = cosine + (1.0 - cosine) / 3.0;
+    double plus = (1.0 - cosine) / 3.0 + sqrt(1.0 / 3.0) * sine;
+    double minus = (1.0 - cosine) / 3.0 - sqrt(1.0 / 3.0) * sine;
+    int k_same = (int)(same * (1 << HUE_SHIFT));
+    int k_plus = (int)(plus * (1 << HUE_SHIFT));
+    int k_minus = (int)(minus * (1 << HUE_SHIFT));
+    int round = 1 << (HUE_SHIFT - 1);
+    int x, y, a, r, g, b;
+    unsigned int pixel;
+
+    for (y = area_y; y < area_y + area_height; y++) {
+        for (x = area_x; x < area_x + area_width; x++) {
+            pixel = src[y * stride + x];
+            a = ALPHA(pixel);
+            r = RED(pixel);
+            g = GREEN(pixel);
+            b = BLUE(pixel);
+            dst[y * stride + x] = PACK(
+                a,
+                clamp((r * k_same + g * k_minus + b * k_plus + round) >>
+                      HUE_SHIFT, a),
+                clamp((r * k_plus + g * k_same + b * k_minus + round) >>
+                      HUE_SHIFT, a),
+                clamp((r * k_minus + g * k_plus + b * k_same + round) >>
+                      HUE_SHIFT, a));
+        }
+    }
+}
+
+/*
+ Invert the colors keeping the alpha. With premultiplied colors the
+ inverted value of a channel is alpha - value, exact for the translucent
+ pixels too.
+*/
+static void
+invert(const unsigned int *src, unsigned int *dst, int stride, int area_x,
+       int area_y, int area_width, int area_height) {
+
+    int x, y, a;
+    unsigned int pixel;
+
+    for (y = area_y; y < area_y + area_height; y++) {
+        for (x = area_x; x < area_x + area_width; x++) {
+            pixel = src[y * stride + x];
+            a = ALPHA(pixel);
+            dst[y * stride + x] = PACK(a, a - RED(pixel), a - GREEN(pixel),
+                                       a - BLUE(pixel));
+        }
+    }
+}
+
+/*
+ Paint every square block of size x size pixels, aligned to the origin
+ of the image, with its average color. The blocks crossing the border of
+ the area are averaged over all their pixels in src, so the areas do not
+ need to be aligned to the blocks.
+*/
+static void
+pixelate(const unsigned int *src, unsigned int *dst, int width, int height,
+         int stride, int area_x, int area_y, int area_width,
+         int area_height, int size) {
+
+    int block_x, block_y, x, y, x1, y1, x2, y2, c, count;
+    int sum[4], channels[4];
+    unsigned int pixel;
+
+    for (block_y = area_y / size * size; block_y < area_y + area_height;
+         block_y += size) {
+        for (block_x = area_x / size * size; block_x < area_x + area_width;
+             block_x += size) {
+            sum[0] = sum[1] = sum[2] = sum[3] = 0;
+            count = 0;
+            for (y = block_y; y < block_y + size && y < height; y++) {
+                for (x = block_x; x < block_x + size && x < width; x++) {
+                    unpack(src[y * stride + x], channels);
+                    for (c = 0; c < 4; c++)
+                        sum[c] += channels[c];
+                    count++;
+                }
+            }
+            pixel = PACK((sum[0] + count / 2) / count,
+                         (sum[1] + count / 2) / count,
+                         (sum[2] + count / 2) / count,
+                         (sum[3] + count / 2) / count);
+
+            x1 = block_x < area_x ? area_x : block_x;
+            y1 = block_y < area_y ? area_y : block_y;
+            x2 = block_x + size < area_x + area_width ?
+                block_x + size : area_x + area_width;
+            y2 = block_y + size < area_y + area_height ?
+                block_y + size : area_y + area_height;
+            for (y = y1; y < y2; y++)
+                for (x = x1; x < x2; x++)
+                    dst[y * stride + x] = pixel;
+        }
+    }
+}
+
+/*
+ Apply a effect to the rectangle area_x, area_y, area_width, area_height
+ of the image. stride is counted in pixels. The parameters are:
+   blur -- param1 radius in pixels
+   sharpen -- param1 amount in percent
+   edges -- none
+   posterize -- param1 levels of every channel, 2 to 255
+   brightness and contrast -- param1 brightness and param2 contrast,
+                              from -100 to 100
+   hue -- param1 rotation in degrees
+   pixelate -- param1 size of the blocks in pixels, up to MAX_BLOCK
+   invert -- none
+ Returns 1 when done, 0 if there was not enough memory and -1 if the
+ filter is unknown.
+*/
+int
+filter_area(const unsigned int *src, unsigned int *dst, int width,
+            int height, int stride, int x, int y, int area_width,
+            int area_height, int filter, int param1, int param2) {
+
+    unsigned char lut[256];
+    int i, levels, brightness, contrast;
+
+    if (area_width <= 0 || area_height <= 0)
+        return 1;
+
+    switch (filter) {
+    case FILTER_BLUR:
+        return box_blur(src, dst, width, height, stride, x, y, area_width,
+                        area_height, clamp(param1, width + height));
+    case FILTER_SHARPEN:
+    case FILTER_EDGES:
+        convolve(src, dst, width, height, stride, x, y, area_width,
+                 area_height, filter, param1);
+        return 1;
+    case FILTER_POSTERIZE:
+        levels = param1 < 2 ? 2 : clamp(param1, 255);
+        for (i = 0; i < 256; i++)
+            lut[i] = ((i * (levels - 1) + 127) / 255 * 255 +
+                      (levels - 1) / 2) / (levels - 1);
+        apply_lut(src, dst, stride, x, y, area_width, area_height, lut);
+        return 1;
+    case FILTER_BRIGHTNESS_CONTRAST:
+        brightness = clamp(param1 + 100, 200) - 100;
+        contrast = clamp(param2 + 100, 200) - 100;
+        for (i = 0; i < 256; i++)
+            lut[i] = clamp((i - 128) * (100 + contrast) / 100 + 128 +
+                           brightness * 255 / 100, 255);
+        apply_lut(src, dst, stride, x, y, area_width, area_height, lut);
+        return 1;
+    case FILTER_HUE:
+        rotate_hue(src, dst, stride, x, y, area_width, area_height,
+                   param1 % 360);
+        return 1;
+    case FILTER_PIXELATE:
+        pixelate(src, dst, width, height, stride, x, y, area_width,
+                 area_height, param1 < 1 ? 1 : clamp(param1, MAX_BLOCK));
+        return 1;
+    case FILTER_INVERT:
+        invert(src, dst, stride, x, y, area_width, area_height);
+        return 1;
+    }
+    return -1;
+}
@@ -0,0 +1,28 @@
+/*
+filters.h
+
+Image effects over a rectangle of a ARGB32 buffer, used by the filters
+module of the activity. See filters.c.
+
+Oficina is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation version 2 of
+the License.
+*/
+
+/* must match the constants in effects.py */
+enum {
+    FILTER_BLUR = 0,
+    FILTER_SHARPEN,
+    FILTER_EDGES,
+    FILTER_POSTERIZE,
+    FILTER_BRIGHTNESS_CONTRAST,
+    FILTER_HUE,
+    FILTER_PIXELATE,
+    FILTER_INVERT,
+    FILTER_COUNT
+};
+
+int filter_area(const unsigned int *src, unsigned int *dst, int width,
+                int height, int stride, int x, int y, int area_width,
+                int area_height, int filter, int param1, int param2);
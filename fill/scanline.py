@@ -0,0 +1,227 @@
+"""
+Python implementation of the scanline flood fill.
+
+Used when no binary blob matches the running platform. It follows the
+same span algorithm as eggfill.c, but every run of pixels is found with
+a regular expression and painted with a single slice assignment, so the
+per pixel work is done in C by the re module and the buffer types.
+
+Pixels are 4 bytes each, in native byte order, as in a cairo
+ImageSurface with FORMAT_ARGB32.
+"""
+
+import array
+import re
+import struct
+
+_PIXEL_SIZE = 4
+
+
+def _pack(color):
+    return struct.pack('=I', color & 0xffffffff)
+
+
+class _Matcher:
+    """Find runs of pixels equal to a given color inside a row."""
+
+    def __init__(self, buf, color):
+        self._buf = buf
+        packed = _pack(color)
+        self._run = re.compile(b'(?:' + re.escape(packed) + b')*')
+        self._reversed_run = re.compile(
+            b'(?:' + re.escape(packed[::-1]) + b')*')
+        # skip whole pixels that are not of the color
+        self._others = re.compile(
+            b'(?:(?!' + re.escape(packed) + b').{4})*', re.DOTALL)
+
+    def right(self, start, end):
+        """Return the byte offset where the run beginning at start ends."""
+        return self._run.match(self._buf, start, end).end()
+
+    def left(self, start, end):
+        """Return the byte offset where the run finishing at end begins."""
+        reversed_row = bytes(self._buf[start:end])[::-1]
+        return end - self._reversed_run.match(reversed_row).end()
+
+    def skip(self, start, end):
+        """Return the byte offset of the first pixel of the color."""
+        return self._others.match(self._buf, start, end).end()
+
+
+def fill_surface(buf, stride, x, y, width, height, color, tolerance=0,
+                 antialias=False):
+    """Flood fill the 4-connected area around (x, y) with color.
+
+        @param  buf -- writable buffer with the pixels, modified in place
+        @param  stride -- number of bytes between two rows
+        @param  x, y -- the seed point
+        @param  width, height -- size of the image in pixels
+        @param  color -- the new color, packed as 0xAARRGGBB
+        @param  tolerance -- largest difference per channel (0 to 255)
+        @param  antialias -- feather the border of the filled area
+        @return  the damaged area as (x, y, width, height), or None
+
+    """
+    if x < 0 or x >= width or y < 0 or y >= height:
+        return None
+    if tolerance > 0 or antialias:
+        return _fill_tolerance(buf, stride, x, y, width, height, color,
+                               min(tolerance, 255), antialias)
+    start = y * stride + x * _PIXEL_SIZE
+    old = bytes(buf[start:start + _PIXEL_SIZE])
+    new = _pack(color)
+    if old == new:
+        return None
+    min_x, min_y, max_x, max_y = width, height, -1, -1
+
+    matcher = _Matcher(buf, struct.unpack('=I', old)[0])
+
+    stack = [(y, x, x, 1), (y + 1, x, x, -1)]
+    while stack:
+        y, x1, x2, dy = stack.pop()
+        y += dy
+        if y < 0 or y >= height:
+            continue
+        row = y * stride
+
+        # extend to the left of x1
+        l = (matcher.left(row, row + (x1 + 1) * _PIXEL_SIZE) - row) / \
+            _PIXEL_SIZE
+        if l <= x1:
+            if l < x1 and 0 <= y - dy < height:
+                # leak on the left
+                stack.append((y, l, x1 - 1, -dy))
+            x = x1
+        else:
+            x = l = _skip(matcher, row, x1 + 1, x2)
+
+        while x <= x2:
+            # extend to the right and paint the whole run
+            end = (matcher.right(row + x * _PIXEL_SIZE,
+                                 row + width * _PIXEL_SIZE) - row) / \
+                _PIXEL_SIZE
+            buf[row + l * _PIXEL_SIZE:row + end * _PIXEL_SIZE] = \
+                new * (end - l)
+            min_x, max_x = min(min_x, l), max(max_x, end - 1)
+            min_y, max_y = min(min_y, y), max(max_y, y)
+            if 0 <= y + dy < height:
+                stack.append((y, l, end - 1, dy))
+            if end > x2 + 1 and 0 <= y - dy < height:
+                # leak on the right
+                stack.append((y, x2 + 1, end - 1, -dy))
+            x = l = _skip(matcher, row, end + 1, x2)
+
+    return (min_x, min_y, max_x - min_x + 1, max_y - min_y + 1)
+
+
+def _distance(a, b):
+    return max(abs(((a >> shift) & 0xff) - ((b >> shift) & 0xff))
+               for shift in (0, 8, 16, 24))
+
+
+def _blend(pixel, color, alpha):
+    result = 0
+    for shift in (0, 8, 16, 24):
+        p = (pixel >> shift) & 0xff
+        c = (color >> shift) & 0xff
+        result |= ((p * (256 - alpha) + c * alpha) >> 8) << shift
+    return result
+
+
+def _fill_tolerance(buf, stride, x, y, width, height, color, tolerance,
+                    antialias):
+    """Slow version of the fill with tolerance of eggfill.c.
+
+    The runs can not be found with a regular expression, so every pixel
+    is compared in Python.
+    """
+    pixel = struct.Struct('=I')
+    new = pixel.pack(color)
+    start = pixel.unpack_from(buf, y * stride + x * _PIXEL_SIZE)[0]
+    mask = bytearray(width * height)
+    min_x, min_y, max_x, max_y = width, height, -1, -1
+
+    def inside(x, y):
+        return not mask[y * width + x] and _distance(
+            pixel.unpack_from(buf, y * stride + x * _PIXEL_SIZE)[0],
+            start) <= tolerance
+
+    def paint(l, r, y):
+        buf[y * stride + l * _PIXEL_SIZE:y * stride + (r + 1) *
+            _PIXEL_SIZE] = new * (r - l + 1)
+        mask[y * width + l:y * width + r + 1] = b'\x01' * (r - l + 1)
+
+    stack = [(y, x, x, 1), (y + 1, x, x, -1)]
+    while stack:
+        y, x1, x2, dy = stack.pop()
+        y += dy
+        if y < 0 or y >= height:
+            continue
+        x = x1
+        while x <= x2:
+            if not inside(x, y):
+                x += 1
+                continue
+            l = x
+            if x == x1:
+                while l > 0 and inside(l - 1, y):
+                    l -= 1
+            r = x
+            while r < width - 1 and inside(r + 1, y):
+                r += 1
+            paint(l, r, y)
+            min_x, max_x = min(min_x, l), max(max_x, r)
+            min_y, max_y = min(min_y, y), max(max_y, y)
+            if 0 <= y + dy < height:
+                stack.append((y, l, r, dy))
+            if 0 <= y - dy < height:
+                if l < x1:
+                    stack.append((y, l, x1 - 1, -dy))
+                if r > x2:
+                    stack.append((y, x2 + 1, r, -dy))
+            x = r + 2
+
+    if max_x < 0:
+        return None
+    if antialias:
+        min_x, min_y = max(min_x - 1, 0), max(min_y - 1, 0)
+        max_x, max_y = min(max_x + 1, width - 1), min(max_y + 1, height - 1)
+        for y in range(min_y, max_y + 1):
+            for x in range(min_x, max_x + 1):
+                i = y * width + x
+                if mask[i] or not (
+                        (x > 0 and mask[i - 1] == 1) or
+                        (x < width - 1 and mask[i + 1] == 1) or
+                        (y > 0 and mask[i - width] == 1) or
+                        (y < height - 1 and mask[i + width] == 1)):
+                    continue
+                offset = y * stride + x * _PIXEL_SIZE
+                old = pixel.unpack_from(buf, offset)[0]
+                d = _distance(old, start)
+                if d >= 255:
+                    continue
+                alpha = min((255 - d) * 256 / (256 - tolerance), 256)
+                buf[offset:offset + _PIXEL_SIZE] = pixel.pack(
+                    _blend(old, color, alpha))
+                mask[i] = 2
+    return (min_x, min_y, max_x - min_x + 1, max_y - min_y + 1)
+
+
+def _skip(matcher, row, x, x2):
+    """Return the first pixel of the old color in [x, x2], or x2 + 1."""
+    if x > x2:
+        return x
+    return (matcher.skip(row + x * _PIXEL_SIZE,
+                         row + (x2 + 1) * _PIXEL_SIZE) - row) / _PIXEL_SIZE
+
+
+def fill(pixels, x, y, width, height, color):
+    """Same interface as the binary blob: fill a array of pixels.
+
+        @return  a new array with the filled pixels
+    """
+    buf = bytearray(pixels.tostring())
+    fill_surface(buf, width * _PIXEL_SIZE, x, y, width, height, color)
+    filled = array.array(pixels.typecode)
+    filled.fromstring(str(buf))
+    return filled
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace filters
+
+    Image effects (blur, sharpen, edges, posterize, brightness and
+    contrast, hue, pixelate, invert) applied to a ARGB32 image surface,
+    alone or as a chain. The surface is split in tiles processed at the
+    same time by a pool of threads, the filters of the binary blobs
+    release the lock of the interpreter while working.
+
+    FilterPreview shows the effects over a reduced copy of the image
+    while the parameters are changed, FilterJob applies them to the full
+    image in a background thread.
+
+"""
+
+import logging
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+
+import cairo
+
+import fill
+import tiles
+
+BLUR = 'blur'
+SHARPEN = 'sharpen'
+EDGES = 'edges'
+POSTERIZE = 'posterize'
+BRIGHTNESS_CONTRAST = 'brightness-contrast'
+HUE = 'hue'
+PIXELATE = 'pixelate'
+INVERT = 'invert'
+
+_KERNELS = {BLUR: fill.FILTER_BLUR,
+            SHARPEN: fill.FILTER_SHARPEN,
+            EDGES: fill.FILTER_EDGES,
+            POSTERIZE: fill.FILTER_POSTERIZE,
+            BRIGHTNESS_CONTRAST: fill.FILTER_BRIGHTNESS_CONTRAST,
+            HUE: fill.FILTER_HUE,
+            PIXELATE: fill.FILTER_PIXELATE,
+            INVERT: fill.FILTER_INVERT}
+
+# parameters used when not given: blur radius, sharpen amount in percent,
+# posterize levels, brightness and contrast (-100 to 100), hue rotation in
+# degrees and pixelate block size
+DEFAULTS = {BLUR: (4, 0),
+            SHARPEN: (100, 0),
+            EDGES: (0, 0),
+            POSTERIZE: (4, 0),
+            BRIGHTNESS_CONTRAST: (20, 20),
+            HUE: (180, 0),
+            PIXELATE: (8, 0),
+            INVERT: (0, 0)}
+
+# minimum and maximum of param1 and param2, None if not used
+RANGES = {BLUR: ((1, 50), None),
+          SHARPEN: ((0, 500), None),
+          EDGES: (None, None),
+          POSTERIZE: ((2, 16), None),
+          BRIGHTNESS_CONTRAST: ((-100, 100), (-100, 100)),
+          HUE: ((-180, 180), None),
+          PIXELATE: ((2, 64), None),
+          INVERT: (None, None)}
+
+# the filters with param1 measured in pixels, scaled in the previews
+_SPATIAL = (BLUR, PIXELATE)
+
+# the filters reading the neighbors of every pixel need the source pixels
+# in a copy, the others work in place
+_NEIGHBORHOOD = (BLUR, SHARPEN, EDGES, PIXELATE)
+
+# bigger than the tiles of the history, to share the cost of the borders
+# read twice by the neighborhood filters
+TILE_SIZE = 128
+
+# longest side of the reduced image of the previews, smaller with the
+# python filters
+PREVIEW_SIZE = 480
+SLOW_PREVIEW_SIZE = 160
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(multiprocessing.cpu_count())
+    return _pool
+
+
+def is_parallel():
+    """The python filters hold the lock of the interpreter, only the
+    ones in the binary blobs run in parallel."""
+    return fill.NATIVE_FILTERS
+
+
+class Filter:
+    """A effect with its parameters."""
+
+    def __init__(self, name, param1=None, param2=None):
+        if name not in _KERNELS:
+            raise ValueError('unknown filter %s' % name)
+        default1, default2 = DEFAULTS[name]
+        self.name = name
+        self.param1 = default1 if param1 is None else int(param1)
+        self.param2 = default2 if param2 is None else int(param2)
+
+    def __repr__(self):
+        return 'Filter(%r, %d, %d)' % (self.name, self.param1, self.param2)
+
+    def apply(self, surface, area=None):
+        """Apply the effect to surface, see FilterChain.apply()."""
+        FilterChain([self]).apply(surface, area)
+
+    def scaled(self, scale):
+        """Return a copy of the filter for a image scaled by scale, with
+        the sizes in pixels changed to look the same."""
+        if self.name not in _SPATIAL:
+            return Filter(self.name, self.param1, self.param2)
+        minimum = 0 if self.name == BLUR else 1
+        return Filter(self.name, max(minimum, int(round(self.param1 *
+                                                          scale))),
+                      self.param2)
+
+    def apply_to_tiles(self, surface, rects, tile_cb=None):
+        """Apply the effect to the rectangles (x, y, width, height) of a
+        surface already flushed, in parallel when possible. The caller
+        marks the surface as dirty.
+
+            @param  tile_cb -- called after every tile, if returns False
+                               the rest of the tiles are not done
+            @return  False if stopped by tile_cb
+        """
+        width = surface.get_width()
+        height = surface.get_height()
+        stride = surface.get_stride()
+        data = surface.get_data()
+        source = data
+        if self.name in _NEIGHBORHOOD:
+            source = data[:]
+        kernel = _KERNELS[self.name]
+
+        def apply_tile(rect):
+            x, y, tile_width, tile_height = rect
+            fill.filter_area(source, data, stride, width, height, x, y,
+                             tile_width, tile_height, kernel, self.param1,
+                             self.param2)
+
+        if is_parallel() and len(rects) > 1:
+            done = _get_pool().imap_unordered(apply_tile, rects)
+        else:
+            done = (apply_tile(rect) for rect in rects)
+        for _result in done:
+            if tile_cb is not None and tile_cb() is False:
+                # the tiles already given to the pool are finished, but
+                # nobody waits for them
+                return False
+        return True
+
+
+class FilterChain:
+    """A list of filters applied one after the other."""
+
+    def __init__(self, filters=None):
+        self.filters = list(filters or [])
+
+    def __len__(self):
+        return len(self.filters)
+
+    def __iter__(self):
+        return iter(self.filters)
+
+    def append(self, name, param1=None, param2=None):
+        """Add a filter at the end of the chain, return the chain."""
+        self.filters.append(Filter(name, param1, param2))
+        return self
+
+    def scaled(self, scale):
+        """Return a copy of the chain for a image scaled by scale."""
+        return FilterChain([item.scaled(scale) for item in self.filters])
+
+    def apply(self, surface, area=None, progress_cb=None):
+        """Apply all the filters to a cairo.ImageSurface with
+        FORMAT_ARGB32.
+
+            @param  area -- the rectangle (x, y, width, height) changed,
+                            all the surface if None. The filters read the
+                            pixels around it.
+            @param  progress_cb -- called with the fraction done after
+                                   every tile, if returns False the work
+                                   is stopped
+            @return  False if stopped by progress_cb
+        """
+        rects = get_filter_rects(surface.get_width(), surface.get_height(),
+                                 area)
+        if not rects or not self.filters:
+            return True
+        logging.debug('FilterChain: %s over %d tiles', self.filters,
+                      len(rects))
+        total = float(len(rects) * len(self.filters))
+        done = [0]
+
+        def tile_cb():
+            done[0] += 1
+            return progress_cb(done[0] / total)
+
+        surface.flush()
+        finished = True
+        for item in self.filters:
+            finished = item.apply_to_tiles(
+                surface, rects, tile_cb if progress_cb else None)
+            if not finished:
+                break
+        surface.mark_dirty()
+        return finished
+
+
+def copy_surface(surface):
+    """Return a new ARGB32 cairo.ImageSurface with the pixels of surface.
+    """
+    copy = cairo.ImageSurface(cairo.FORMAT_ARGB32, surface.get_width(),
+                              surface.get_height())
+    ctx = cairo.Context(copy)
+    ctx.set_operator(cairo.OPERATOR_SOURCE)
+    ctx.set_source_surface(surface)
+    ctx.paint()
+    return copy
+
+
+class FilterPreview:
+    """Effects applied to a reduced copy of a surface, fast enough to be
+    done again every time the parameters change.
+    """
+
+    def __init__(self, surface, x=0, y=0, max_size=None):
+        """
+            @param  surface -- the cairo.ImageSurface to preview
+            @param  x, y -- where the surface is shown in the canvas
+            @param  max_size -- longest side of the reduced copy
+        """
+        if max_size is None:
+            max_size = PREVIEW_SIZE if is_parallel() else SLOW_PREVIEW_SIZE
+        self.x = x
+        self.y = y
+        self.width = surface.get_width()
+        self.height = surface.get_height()
+        self.scale = min(1.0, float(max_size) / max(self.width,
+                                                    self.height, 1))
+        self._surface = surface
+        self._source = None
+        self._result = None
+        self._reduce()
+
+    def _reduce(self):
+        self._source = cairo.ImageSurface(
+            cairo.FORMAT_ARGB32, max(1, int(round(self.width * self.scale))),
+            max(1, int(round(self.height * self.scale))))
+        ctx = cairo.Context(self._source)
+        ctx.scale(float(self._source.get_width()) / self.width,
+                  float(self._source.get_height()) / self.height)
+        ctx.set_source_surface(self._surface)
+        ctx.paint()
+
+    def get_bytes(self):
+        """Return the bytes used by the reduced copy and the result."""
+        return sum(surface.get_stride() * surface.get_height()
+                   for surface in (self._source, self._result)
+                   if surface is not None)
+
+    def release(self):
+        """Free the reduced copy, made again by the next render(), the
+        result is kept to be shown."""
+        self._source = None
+
+    def render(self, chain):
+        """Apply chain to the reduced copy, replacing the previous
+        result."""
+        if self._source is None:
+            self._reduce()
+        result = copy_surface(self._source)
+        chain.scaled(self.scale).apply(result)
+        self._result = result
+
+    def paint(self, ctx):
+        """Paint the last result over ctx, scaled to the size and position
+        of the original surface."""
+        if self._result is None:
+            return
+        ctx.save()
+        ctx.translate(self.x, self.y)
+        ctx.rectangle(0, 0, self.width, self.height)
+        ctx.clip()
+        ctx.scale(float(self.width) / self._result.get_width(),
+                  float(self.height) / self._result.get_height())
+        ctx.set_source_surface(self._result)
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.paint()
+        ctx.restore()
+
+
+class FilterJob(threading.Thread):
+    """Apply a chain to a copy of a surface in a background thread.
+
+    The callbacks are called from the thread, the copy is in self.result
+    when done_cb is called.
+    """
+
+    def __init__(self, chain, surface, progress_cb=None, done_cb=None):
+        """
+            @param  progress_cb -- called with the fraction done
+            @param  done_cb -- called with the job when finished, if not
+                               cancelled
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.chain = chain
+        # copied here to not read the surface while is modified
+        self.result = copy_surface(surface)
+        self._progress_cb = progress_cb
+        self._done_cb = done_cb
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        self.chain.apply(self.result, progress_cb=self._progress)
+        if not self._cancelled and self._done_cb is not None:
+            self._done_cb(self)
+
+    def _progress(self, fraction):
+        if self._cancelled:
+            return False
+        if self._progress_cb is not None:
+            self._progress_cb(fraction)
+        return True
+
+
+def get_filter_rects(width, height, area=None, tile_size=TILE_SIZE):
+    """Return the tiles of area, limited to a image of the given size."""
+    if area is None:
+        area = (0, 0, width, height)
+    x, y, area_width, area_height = [int(value) for value in area]
+    x1, y1 = max(0, x), max(0, y)
+    x2 = min(width, x + area_width)
+    y2 = min(height, y + area_height)
+    if x2 <= x1 or y2 <= y1:
+        return []
+    return [(x1 + tile_x, y1 + tile_y, tile_width, tile_height)
+            for tile_x, tile_y, tile_width, tile_height
+            in tiles.get_tile_rects(x2 - x1, y2 - y1, tile_size)]
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace history
+
+    List of steps for the Undo/Redo commands, limited by the bytes used
+    instead of by a number of steps. The steps are checkpoints with all
+    the pixels or drawing commands to repeat over them.
+
+    The tiles of the newest steps are kept as strings. The tiles used
+    only by older steps are compressed with zlib in a background thread,
+    and when the tiles in memory exceed the budget the oldest compressed
+    tiles are moved to a memory mapped temporary file.
+
+"""
+
+import collections
+import logging
+import mmap
+import Queue
+import tempfile
+import threading
+import zlib
+
+import tiles
+
+# steps at the end of the list with the tiles not compressed
+RAW_STEPS = 8
+# bytes of tiles kept in memory, compressed or not
+MEMORY_BUDGET = 48 * 1024 * 1024
+# bytes of tiles in the temporary file, the oldest steps are dropped
+# when exceeded
+DISK_BUDGET = 256 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+# most commands between two checkpoints
+CHECKPOINT_INTERVAL = 20
+
+RAW = 'raw'
+COMPRESSED = 'compressed'
+SPILLED = 'spilled'
+
+
+class _SpillFile:
+    """Temporary file mapped in memory, where the data is only appended.
+    """
+
+    GROW_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(prefix='undo-', dir=directory)
+        self._map = None
+        self._size = 0
+        self.end = 0
+
+    def write(self, data):
+        """Append data to the file, return the offset where was written."""
+        if self.end + len(data) > self._size:
+            size = max(self._size * 2, self.end + len(data) + self.GROW_SIZE)
+            if self._map is not None:
+                self._map.close()
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+            self._size = size
+        offset = self.end
+        self._map[offset:offset + len(data)] = data
+        self.end += len(data)
+        return offset
+
+    def read(self, offset, length):
+        return self._map[offset:offset + length]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+class _PackedTile(object):
+    """A tile compressed with zlib, kept in memory or in a _SpillFile."""
+
+    __slots__ = ('data', 'spill', 'offset', 'size')
+
+    def __init__(self, data):
+        self.data = data
+        self.spill = None
+        self.offset = 0
+        self.size = len(data)
+
+    def get_data(self):
+        data = self.data
+        if data is None:
+            data = self.spill.read(self.offset, self.size)
+        return zlib.decompress(data)
+
+    def move_to(self, spill):
+        self.offset = spill.write(self.data)
+        self.spill = spill
+        self.data = None
+
+
+def _get_tier(tile):
+    if isinstance(tile, str):
+        return RAW
+    if tile.spill is None:
+        return COMPRESSED
+    return SPILLED
+
+
+def _get_size(tile):
+    if isinstance(tile, str):
+        return len(tile)
+    return tile.size
+
+
+def _is_checkpoint(step):
+    return isinstance(step, tiles.Snapshot)
+
+
+def _has_tile(snapshot, index, tile):
+    # snapshots of different sizes have different number of tiles
+    return index < len(snapshot.tiles) and snapshot.tiles[index] is tile
+
+
+def _compress(requests, results):
+    while True:
+        snapshot, items = requests.get()
+        results.put((snapshot, [
+            (index, tile, _PackedTile(zlib.compress(tile, COMPRESSION_LEVEL)))
+            for index, tile in items]))
+
+
+class UndoHistory:
+    """List of the Undo/Redo steps, oldest first, with the tiles of the
+    old steps compressed or moved to the disk.
+
+    Every step is a tiles.Snapshot (a checkpoint) or a commands.Command,
+    to be replayed over the nearest checkpoint before it. The first step
+    is always a checkpoint. The snapshots are returned as they were
+    appended, the compressed tiles are expanded by
+    tiles.Snapshot.get_tile() when restored.
+    """
+
+    def __init__(self, directory=None, memory_budget=MEMORY_BUDGET,
+                 disk_budget=DISK_BUDGET, raw_steps=RAW_STEPS):
+        """
+            @param  directory -- where the temporary file is created,
+                                 usually the instance directory of the
+                                 activity
+        """
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.raw_steps = raw_steps
+        self._directory = directory
+        self._steps = []
+        # id of every tile in the list -> [tile, number of steps using it]
+        self._refs = {}
+        self._sizes = {RAW: 0, COMPRESSED: 0, SPILLED: 0}
+        # compressed tiles in memory, oldest first
+        self._in_memory = collections.deque()
+        self._spill = None
+        self._requests = Queue.Queue()
+        self._results = Queue.Queue()
+        self._worker = None
+
+    def __len__(self):
+        return len(self._steps)
+
+    def __getitem__(self, index):
+        return self._steps[index]
+
+    def get_checkpoint(self, index):
+        """Return the index of the nearest checkpoint at or before the
+        step at index."""
+        while not _is_checkpoint(self._steps[index]):
+            index -= 1
+        return index
+
+    def get_last(self):
+        """Return the newest checkpoint, or None if the list is empty."""
+        if not self._steps:
+            return None
+        return self._steps[self.get_checkpoint(len(self._steps) - 1)]
+
+    def needs_checkpoint(self):
+        """Return True if the next step should be a checkpoint, to limit
+        the commands replayed to restore a step."""
+        if not self._steps:
+            return True
+        last = len(self._steps) - 1
+        return last - self.get_checkpoint(last) >= CHECKPOINT_INTERVAL
+
+    def append(self, step):
+        """Add the newest step.
+
+            @return  the number of old steps dropped to keep the disk
+                     budget
+        """
+        self._steps.append(step)
+        self._apply_compressed()
+        if not _is_checkpoint(step):
+            return 0
+
+        for tile in step.tiles:
+            self._add_ref(tile)
+        # keep the tiles of the last raw_steps checkpoints as strings
+        checkpoints = [index for index, old_step in enumerate(self._steps)
+                       if _is_checkpoint(old_step)]
+        if len(checkpoints) > self.raw_steps:
+            self._request_compression(checkpoints[-self.raw_steps - 1],
+                                      checkpoints[-self.raw_steps])
+
+        self._spill_to_budget()
+        dropped = 0
+        while self._sizes[SPILLED] > self.disk_budget and \
+                dropped < checkpoints[-1]:
+            self._remove_step(0)
+            dropped += 1
+        # the commands can not be replayed without the checkpoint before
+        while dropped < checkpoints[-1] and \
+                not _is_checkpoint(self._steps[0]):
+            self._remove_step(0)
+            dropped += 1
+        if dropped:
+            logging.debug('UndoHistory: dropped %d steps', dropped)
+            self._compact_spill()
+        return dropped
+
+    def truncate(self, length):
+        """Drop the steps after the first length ones (the redos)."""
+        while len(self._steps) > length:
+            self._remove_step(-1)
+        self._apply_compressed()
+        self._compact_spill()
+
+    def release_memory(self, size):
+        """Move compressed tiles to the temporary file until size bytes
+        are freed or there are not more to move, return the bytes
+        freed. The tiles of the newest steps are not moved."""
+        self._apply_compressed()
+        in_memory = self._sizes[RAW] + self._sizes[COMPRESSED]
+        budget = self.memory_budget
+        self.memory_budget = max(0, in_memory - size)
+        try:
+            self._spill_to_budget()
+        finally:
+            self.memory_budget = budget
+        return in_memory - self._sizes[RAW] - self._sizes[COMPRESSED]
+
+    def get_sizes(self):
+        """Return the bytes used by the tiles, counting only once the
+        tiles shared between steps, as a dictionary with keys 'raw',
+        'compressed' (in memory) and 'spilled' (in the temporary file).
+        """
+        self._apply_compressed()
+        return dict(self._sizes)
+
+    def _add_ref(self, tile):
+        ref = self._refs.get(id(tile))
+        if ref is None:
+            self._refs[id(tile)] = [tile, 1]
+            self._sizes[_get_tier(tile)] += _get_size(tile)
+        else:
+            ref[1] += 1
+
+    def _remove_ref(self, tile):
+        ref = self._refs[id(tile)]
+        ref[1] -= 1
+        if ref[1] == 0:
+            del self._refs[id(tile)]
+            self._sizes[_get_tier(tile)] -= _get_size(tile)
+            if not isinstance(tile, str):
+                # can be waiting in self._in_memory
+                tile.data = None
+
+    def _remove_step(self, index):
+        step = self._steps.pop(index)
+        if _is_checkpoint(step):
+            for tile in step.tiles:
+                self._remove_ref(tile)
+
+    def _request_compression(self, index, following_index):
+        """Compress the tiles of the checkpoint at index not used by the
+        next checkpoint, they will be replaced in all the checkpoints
+        sharing them."""
+        snapshot = self._steps[index]
+        following = self._steps[following_index]
+        items = [(tile_index, tile)
+                 for tile_index, tile in enumerate(snapshot.tiles)
+                 if isinstance(tile, str) and
+                 not _has_tile(following, tile_index, tile)]
+        if not items:
+            return
+        if self._worker is None:
+            self._worker = threading.Thread(
+                target=_compress, args=(self._requests, self._results))
+            self._worker.daemon = True
+            self._worker.start()
+        self._requests.put((snapshot, items))
+
+    def _apply_compressed(self):
+        while True:
+            try:
+                snapshot, items = self._results.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                last = self._steps.index(snapshot)
+            except ValueError:
+                # already dropped
+                continue
+            checkpoints = [step for step in reversed(self._steps[:last + 1])
+                           if _is_checkpoint(step)]
+            for tile_index, tile, packed in items:
+                for step in checkpoints:
+                    if not _has_tile(step, tile_index, tile):
+                        break
+                    step.tiles[tile_index] = packed
+                    self._remove_ref(tile)
+                    self._add_ref(packed)
+                if snapshot.tiles[tile_index] is packed:
+                    self._in_memory.append(packed)
+
+    def _spill_to_budget(self):
+        while self._sizes[RAW] + self._sizes[COMPRESSED] > \
+                self.memory_budget and self._in_memory:
+            packed = self._in_memory.popleft()
+            if packed.spill is not None or id(packed) not in self._refs:
+                continue
+            if self._spill is None:
+                self._spill = _SpillFile(self._directory)
+            packed.move_to(self._spill)
+            self._sizes[COMPRESSED] -= packed.size
+            self._sizes[SPILLED] += packed.size
+
+    def _compact_spill(self):
+        """Rewrite the temporary file when most of it is not used."""
+        if self._spill is None or \
+                self._spill.end <= 2 * self._sizes[SPILLED] + \
+                _SpillFile.GROW_SIZE:
+            return
+        old_spill = self._spill
+        self._spill = None
+        if self._sizes[SPILLED] > 0:
+            self._spill = _SpillFile(self._directory)
+            for tile, count in self._refs.itervalues():
+                if _get_tier(tile) == SPILLED:
+                    data = old_spill.read(tile.offset, tile.size)
+                    tile.offset = self._spill.write(data)
+                    tile.spill = self._spill
+        old_spill.close()
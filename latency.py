@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace latency
+
+    Histograms of the time used by the operations of the Area, by tool,
+    and the rates of the frames and the input events, to see which tool
+    or canvas size makes the activity slow.
+
+    The methods of the Area are measured with the timed() decorator.
+    The statistics are returned by Area.get_latency_stats() and logged
+    by Area.log_latency_stats(), and are shown over the canvas when the
+    environment variable PAINT_LATENCY_OVERLAY is set, or with
+    Area.set_latency_overlay().
+
+"""
+
+import functools
+import time
+
+import cairo
+
+# upper limits of the buckets of the histograms, in milliseconds, the
+# last bucket has the slower times
+BUCKETS = (0.5, 1, 2, 4, 8, 16, 33, 66, 133, 266, 533, 1066)
+# seconds between the updates of the rates
+RATE_INTERVAL = 1.0
+# position and size of the overlay, in pixels of the widget
+OVERLAY_RECT = (8, 8, 270, 86)
+
+
+class Histogram:
+    """The times of a operation, counted in BUCKETS."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        milliseconds = seconds * 1000
+        self.count += 1
+        self.total += milliseconds
+        if milliseconds > self.max:
+            self.max = milliseconds
+        index = 0
+        while index < len(BUCKETS) and milliseconds > BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+
+    def percentile(self, percent):
+        """Return the upper limit in milliseconds of the bucket with the
+        time under which are percent of the times, max for the last."""
+        wanted = self.count * percent / 100.0
+        counted = 0
+        for index, count in enumerate(self.buckets):
+            counted += count
+            if counted >= wanted and count:
+                if index < len(BUCKETS):
+                    return min(BUCKETS[index], self.max)
+                return self.max
+        return 0.0
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': self.max,
+                'buckets': list(self.buckets)}
+
+
+class LatencyMonitor:
+    """The histograms of the operations by tool, and the rates of the
+    last RATE_INTERVAL."""
+
+    def __init__(self):
+        # (operation, tool name): Histogram
+        self._histograms = {}
+        self.last_frame_time = 0.0
+        self.frames_per_second = 0.0
+        self.events_per_second = 0.0
+        self.dropped_per_second = 0.0
+        # totals since created
+        self.events = 0
+        self.dropped = 0
+        self._rate_start = time.time()
+        self._rate_frames = 0
+        self._rate_events = 0
+        self._rate_dropped = 0
+
+    def add(self, operation, tool_name, seconds):
+        key = (operation, tool_name)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.add(seconds)
+
+    def add_frame(self, seconds):
+        self.last_frame_time = seconds * 1000
+        self._rate_frames += 1
+        self._update_rates()
+
+    def add_events(self, received, dropped=0):
+        """Count input events received, and the ones not used by the
+        tool."""
+        self.events += received
+        self.dropped += dropped
+        self._rate_events += received
+        self._rate_dropped += dropped
+        self._update_rates()
+
+    def _update_rates(self):
+        now = time.time()
+        elapsed = now - self._rate_start
+        if elapsed < RATE_INTERVAL:
+            return
+        self.frames_per_second = self._rate_frames / elapsed
+        self.events_per_second = self._rate_events / elapsed
+        self.dropped_per_second = self._rate_dropped / elapsed
+        self._rate_start = now
+        self._rate_frames = self._rate_events = self._rate_dropped = 0
+
+    def get_stats(self):
+        """Return a dictionary with the key 'operations', a dictionary
+        of operation: {tool name: histogram as a dictionary}, and the
+        rates."""
+        operations = {}
+        for (operation, tool_name), histogram in self._histograms.items():
+            operations.setdefault(operation, {})[tool_name] = \
+                histogram.to_dict()
+        return {'operations': operations,
+                'last_frame_time': self.last_frame_time,
+                'frames_per_second': self.frames_per_second,
+                'events_per_second': self.events_per_second,
+                'dropped_per_second': self.dropped_per_second,
+                'events': self.events,
+                'dropped': self.dropped}
+
+    def reset(self):
+        self.__init__()
+
+    def format_stats(self):
+        """Return the statistics as lines of text."""
+        lines = ['%-16s %-18s %7s %8s %8s %8s' % (
+            'operation', 'tool', 'count', 'mean ms', 'p90 ms', 'max ms')]
+        for (operation, tool_name) in sorted(self._histograms):
+            histogram = self._histograms[(operation, tool_name)]
+            stats = histogram.to_dict()
+            lines.append('%-16s %-18s %7d %8.2f %8.2f %8.2f' % (
+                operation, tool_name, stats['count'], stats['mean'],
+                stats['p90'], stats['max']))
+        return lines
+
+    def paint_overlay(self, ctx, undo_bytes):
+        """Paint the frame time, the rates and the memory of the undo
+        list over ctx, in OVERLAY_RECT."""
+        x, y, width, height = OVERLAY_RECT
+        lines = ['frame %.1f ms  %.0f fps' % (self.last_frame_time,
+                                              self.frames_per_second),
+                 'events %.0f/s  dropped %.0f/s' % (
+                     self.events_per_second, self.dropped_per_second),
+                 'undo %.1f MB' % (undo_bytes / 1048576.0)]
+        ctx.save()
+        ctx.rectangle(x, y, width, height)
+        ctx.set_source_rgba(0.0, 0.0, 0.0, 0.6)
+        ctx.fill()
+        ctx.set_source_rgb(1.0, 1.0, 1.0)
+        ctx.select_font_face('Monospace', cairo.FONT_SLANT_NORMAL,
+                             cairo.FONT_WEIGHT_NORMAL)
+        ctx.set_font_size(14)
+        for number, line in enumerate(lines):
+            ctx.move_to(x + 8, y + 24 + number * 24)
+            ctx.show_text(line)
+        ctx.restore()
+
+
+def timed(operation):
+    """Decorator of the methods of a object with the members latency (a
+    LatencyMonitor) and tool, adding the time used by every call to the
+    histogram of operation and the tool."""
+
+    def decorator(method):
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.latency.add(operation, self.tool['name'],
+                                 time.time() - start)
+        return wrapper
+
+    return decorator
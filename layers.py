@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace layers
+
+    Layers of the drawing, every one a image surface of the size of the
+    canvas, with opacity, visibility and a blend mode. The tools paint in
+    the active layer only.
+
+    LayerStack keeps the layers below the active one composited in a
+    cached surface, and the ones above in other, so showing the drawing
+    while painting is three surfaces whatever the number of layers. The
+    caches are built again only in the areas where a layer not active is
+    modified.
+
+"""
+
+import logging
+import math
+
+import cairo
+
+# blend modes, with the names of the composite-op attribute of OpenRaster
+NORMAL = 'svg:src-over'
+MULTIPLY = 'svg:multiply'
+SCREEN = 'svg:screen'
+OVERLAY = 'svg:overlay'
+DARKEN = 'svg:darken'
+LIGHTEN = 'svg:lighten'
+DIFFERENCE = 'svg:difference'
+
+_OPERATORS = {NORMAL: cairo.OPERATOR_OVER,
+              MULTIPLY: cairo.OPERATOR_MULTIPLY,
+              SCREEN: cairo.OPERATOR_SCREEN,
+              OVERLAY: cairo.OPERATOR_OVERLAY,
+              DARKEN: cairo.OPERATOR_DARKEN,
+              LIGHTEN: cairo.OPERATOR_LIGHTEN,
+              DIFFERENCE: cairo.OPERATOR_DIFFERENCE}
+
+BLEND_MODES = (NORMAL, MULTIPLY, SCREEN, OVERLAY, DARKEN, LIGHTEN,
+               DIFFERENCE)
+
+
+def get_operator(blend_mode):
+    """Return the cairo operator of a blend mode, OPERATOR_OVER if
+    unknown."""
+    return _OPERATORS.get(blend_mode, cairo.OPERATOR_OVER)
+
+
+class Layer:
+    """A ARGB32 surface with the properties used to composite it."""
+
+    def __init__(self, name, width, height, opacity=1.0, visible=True,
+                 blend_mode=NORMAL):
+        if blend_mode not in _OPERATORS:
+            raise ValueError('unknown blend mode %s' % blend_mode)
+        self.name = name
+        self.opacity = opacity
+        self.visible = visible
+        self.blend_mode = blend_mode
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        # the Undo/Redo list of the layer and its position, kept here by
+        # the area while the layer is not the active one
+        self.undo_list = None
+        self.undo_index = None
+
+    def __repr__(self):
+        return 'Layer(%r)' % self.name
+
+    def paint(self, ctx, source=None, pattern_filter=None):
+        """Composite the layer over ctx.
+
+            @param  source -- a cairo.Surface or cairo.Pattern painted
+                              instead of the surface of the layer
+            @param  pattern_filter -- the cairo filter used to scale the
+                                      pixels, the default if None
+        """
+        if not self.visible:
+            return
+        ctx.save()
+        if source is None:
+            source = self.surface
+        if isinstance(source, cairo.Surface):
+            ctx.set_source_surface(source)
+        else:
+            ctx.set_source(source)
+        if pattern_filter is not None:
+            ctx.get_source().set_filter(pattern_filter)
+        ctx.set_operator(get_operator(self.blend_mode))
+        if self.opacity < 1.0:
+            ctx.paint_with_alpha(self.opacity)
+        else:
+            ctx.paint()
+        ctx.restore()
+
+
+class _Cache:
+    """A surface with some layers composited, and the areas where is not
+    updated."""
+
+    def __init__(self):
+        self.surface = None
+        # rectangles (x, y, width, height) to composite again, None if
+        # all the surface
+        self.damage = None
+
+    def invalidate(self, area=None):
+        if self.damage is None or area is None:
+            self.damage = None
+        else:
+            self.damage.append(area)
+
+    def update(self, layers, width, height):
+        """Composite again the damaged areas of layers, bottom first."""
+        if self.damage == []:
+            return
+        if self.surface is None or \
+                self.surface.get_width() != width or \
+                self.surface.get_height() != height:
+            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width,
+                                              height)
+            self.damage = None
+        ctx = cairo.Context(self.surface)
+        if self.damage is not None:
+            for x, y, area_width, area_height in self.damage:
+                ctx.rectangle(x, y, area_width, area_height)
+            ctx.clip()
+        ctx.set_operator(cairo.OPERATOR_CLEAR)
+        ctx.paint()
+        for layer in layers:
+            layer.paint(ctx)
+        self.damage = []
+
+    def release(self):
+        self.surface = None
+        self.damage = None
+
+
+class LayerStack:
+    """The layers of the drawing, bottom first, and the index of the
+    active one.
+
+    Every change to a layer that is not the active one must be notified
+    with layer_changed(), to update the caches.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.layers = []
+        self.active = -1
+        self._below = _Cache()
+        self._above = _Cache()
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __getitem__(self, index):
+        return self.layers[index]
+
+    def get_active(self):
+        return self.layers[self.active]
+
+    def index(self, layer):
+        return self.layers.index(layer)
+
+    def _invalidate(self, index=None, area=None):
+        """The layer at index changed in area, all if index is None."""
+        if index is None or index < self.active:
+            self._below.invalidate(area)
+        if index is None or index > self.active:
+            self._above.invalidate(area)
+
+    def add(self, name, index=None):
+        """Add a transparent layer at index, above the active one if
+        None, and return it. The active layer is not changed."""
+        if index is None:
+            index = self.active + 1
+        layer = Layer(name, self.width, self.height)
+        self.layers.insert(index, layer)
+        if index <= self.active:
+            self.active += 1
+        elif self.active < 0:
+            self.active = index
+        self._invalidate(index)
+        return layer
+
+    def remove(self, index):
+        """Remove the layer at index, the one below is activated if was
+        the active one. The last layer can not be removed."""
+        if len(self.layers) == 1:
+            raise ValueError('the last layer can not be removed')
+        layer = self.layers.pop(index)
+        if index < self.active or (index == self.active and index > 0):
+            self.active -= 1
+        self._invalidate()
+        return layer
+
+    def move(self, index, new_index):
+        """Move the layer at index to new_index, keeping the same active
+        layer."""
+        new_index = max(0, min(len(self.layers) - 1, new_index))
+        if new_index == index:
+            return
+        active = self.get_active()
+        self.layers.insert(new_index, self.layers.pop(index))
+        self.active = self.layers.index(active)
+        self._invalidate()
+
+    def set_active(self, index):
+        if index != self.active:
+            self.active = index
+            self._invalidate()
+
+    def set_opacity(self, index, opacity):
+        self.layers[index].opacity = max(0.0, min(1.0, opacity))
+        self._invalidate(index)
+
+    def set_visible(self, index, visible):
+        self.layers[index].visible = visible
+        self._invalidate(index)
+
+    def set_blend_mode(self, index, blend_mode):
+        if blend_mode not in _OPERATORS:
+            raise ValueError('unknown blend mode %s' % blend_mode)
+        self.layers[index].blend_mode = blend_mode
+        self._invalidate(index)
+
+    def layer_changed(self, index, area=None):
+        """The pixels of the layer at index were modified.
+
+            @param  area -- the rectangle (x, y, width, height) modified,
+                            or None if can be all the layer
+        """
+        self._invalidate(index, area)
+
+    def rotate(self, angle):
+        """Rotate all the layers by angle degrees, 90 or 270, exchanging
+        the width and the height."""
+        radians_angle = math.pi * float(angle) / 180.0
+        for layer in self.layers:
+            rotated = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.height,
+                                         self.width)
+            ctx = cairo.Context(rotated)
+            ctx.rotate(radians_angle)
+            if radians_angle > math.pi:
+                ctx.translate(-self.width, 0)
+            else:
+                ctx.translate(0, -self.height)
+            ctx.set_source_surface(layer.surface)
+            ctx.paint()
+            layer.surface = rotated
+        self.width, self.height = self.height, self.width
+        self._invalidate()
+
+    def get_cache_bytes(self):
+        """Return the bytes used by the caches."""
+        return sum(cache.surface.get_stride() * cache.surface.get_height()
+                   for cache in (self._below, self._above)
+                   if cache.surface is not None)
+
+    def release_caches(self):
+        """Free the memory of the caches, composited again when needed."""
+        self._below.release()
+        self._above.release()
+
+    def _can_cache_above(self, above):
+        # the blend modes other than normal need the layers below as
+        # backdrop, these layers are composited every time
+        return all(layer.blend_mode == NORMAL for layer in above)
+
+    def paint(self, ctx, source=None, pattern_filter=None):
+        """Composite all the layers over ctx.
+
+            @param  source -- a cairo.Surface or cairo.Pattern shown
+                              instead of the active layer, like the
+                              canvas with the shape being drawn
+            @param  pattern_filter -- the cairo filter used to scale the
+                                      pixels, the default if None
+        """
+        below = self.layers[:self.active]
+        above = self.layers[self.active + 1:]
+        if below:
+            self._below.update(below, self.width, self.height)
+            ctx.save()
+            ctx.set_source_surface(self._below.surface)
+            if pattern_filter is not None:
+                ctx.get_source().set_filter(pattern_filter)
+            ctx.set_operator(cairo.OPERATOR_SOURCE)
+            ctx.paint()
+            ctx.restore()
+        self.get_active().paint(ctx, source, pattern_filter)
+        if not above:
+            return
+        if self._can_cache_above(above):
+            self._above.update(above, self.width, self.height)
+            ctx.save()
+            ctx.set_source_surface(self._above.surface)
+            if pattern_filter is not None:
+                ctx.get_source().set_filter(pattern_filter)
+            ctx.paint()
+            ctx.restore()
+        else:
+            for layer in above:
+                layer.paint(ctx, None, pattern_filter)
+
+    def flatten(self):
+        """Return a new cairo.ImageSurface with all the layers
+        composited."""
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width,
+                                     self.height)
+        ctx = cairo.Context(surface)
+        for layer in self.layers:
+            layer.paint(ctx)
+        logging.debug('LayerStack: %d layers flattened', len(self.layers))
+        return surface
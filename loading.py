@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace loading
+
+    Read image files of any format known by gdk-pixbuf into a cairo image
+    surface, decoding them by parts with a PixbufLoader. The size is
+    chosen before decoding, the loaders of some formats (like jpeg) decode
+    the big images directly at the reduced size, and the rows are copied
+    to the surface while they are decoded, so a big photo never is in
+    memory at full size.
+
+"""
+
+import logging
+
+import cairo
+from gi.repository import Gdk
+from gi.repository import GdkPixbuf
+from gi.repository import GObject
+
+# bytes given to the loader on every write
+CHUNK_SIZE = 64 * 1024
+
+
+class SurfaceLoader:
+    """Decode a image file in a new ARGB32 cairo.ImageSurface, reduced to
+    fit in a maximum size, keeping the aspect.
+    """
+
+    def __init__(self, max_width=None, max_height=None):
+        """
+            @param  max_width, max_height -- the maximum size of the
+                                             surface, not limited if None
+        """
+        self.max_width = max_width
+        self.max_height = max_height
+        # size of the image in the file
+        self.width = 0
+        self.height = 0
+        self.surface = None
+        self._ctx = None
+
+    def load(self, file_path):
+        """Return a new cairo.ImageSurface with the image of file_path.
+        Raises GObject.GError if the file can not be decoded."""
+        loader = GdkPixbuf.PixbufLoader()
+        loader.connect('size-prepared', self.__size_prepared_cb)
+        loader.connect('area-prepared', self.__area_prepared_cb)
+        loader.connect('area-updated', self.__area_updated_cb)
+        try:
+            with open(file_path, 'rb') as image_file:
+                while True:
+                    data = image_file.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    loader.write(data)
+        finally:
+            # decodes the last rows, raises the errors not found before
+            loader.close()
+        surface = self.surface
+        self.surface = None
+        self._ctx = None
+        if surface is None:
+            # a empty file, or a format the loader did not recognize
+            raise GObject.GError('%s has not a image' % file_path)
+        surface.flush()
+        return surface
+
+    def __size_prepared_cb(self, loader, width, height):
+        self.width = width
+        self.height = height
+        scale = 1.0
+        if self.max_width:
+            scale = min(scale, float(self.max_width) / width)
+        if self.max_height:
+            scale = min(scale, float(self.max_height) / height)
+        if scale < 1.0:
+            logging.debug('SurfaceLoader: reducing %d x %d to %.3f',
+                          width, height, scale)
+            loader.set_size(max(1, int(width * scale)),
+                            max(1, int(height * scale)))
+
+    def __area_prepared_cb(self, loader):
+        pixbuf = loader.get_pixbuf()
+        self.surface = cairo.ImageSurface(
+            cairo.FORMAT_ARGB32, pixbuf.get_width(), pixbuf.get_height())
+        self._ctx = cairo.Context(self.surface)
+        self._ctx.set_operator(cairo.OPERATOR_SOURCE)
+
+    def __area_updated_cb(self, loader, x, y, width, height):
+        if width <= 0 or height <= 0:
+            return
+        # gdk converts the decoded rows to premultiplied BGRA, only the
+        # updated part is converted, the subpixbuf shares the pixels
+        area = loader.get_pixbuf().new_subpixbuf(x, y, width, height)
+        self._ctx.save()
+        self._ctx.rectangle(x, y, width, height)
+        self._ctx.clip()
+        Gdk.cairo_set_source_pixbuf(self._ctx, area, x, y)
+        self._ctx.paint()
+        self._ctx.restore()
+
+
+def load_surface(file_path, max_width=None, max_height=None):
+    """Return a new cairo.ImageSurface with the image of file_path, see
+    SurfaceLoader."""
+    return SurfaceLoader(max_width, max_height).load(file_path)
+
+
+def get_screen_size():
+    """The size used to fit the images when not loaded at full size."""
+    return Gdk.Screen.width(), Gdk.Screen.height()
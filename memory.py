@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace memory
+
+    Count the bytes of the surfaces kept by the Area, by category, and
+    free the ones that can be made again when the total exceeds a
+    budget: first the memory of the Undo/Redo list (moved to the disk),
+    then the caches, then the previews.
+
+    The budget is BUDGET, or the megabytes in the environment variable
+    PAINT_MEMORY_BUDGET.
+
+"""
+
+import logging
+
+import cairo
+
+# the drawing, the layers
+CANVAS = 'canvas'
+# the canvas where the tools show what they are drawing
+TEMP = 'temp'
+# images loaded, used once to paint the canvas
+TRANSIENT = 'transient'
+SELECTION = 'selection'
+STAMP = 'stamp'
+UNDO = 'undo'
+# the layers composited, the mipmap pyramid, the bucket region index
+CACHE = 'cache'
+# the effects applied to a reduced copy
+PREVIEW = 'preview'
+
+CATEGORIES = (CANVAS, TEMP, TRANSIENT, SELECTION, STAMP, UNDO, CACHE,
+              PREVIEW)
+# the categories freed when over the budget, in this order
+EVICTION_ORDER = (UNDO, CACHE, PREVIEW)
+
+BUDGET = 192 * 1024 * 1024
+
+
+def get_surface_bytes(surface):
+    """Return the bytes of the pixels of a cairo.ImageSurface or a
+    GdkPixbuf.Pixbuf, 0 if None or other kind of surface."""
+    if surface is None:
+        return 0
+    if isinstance(surface, cairo.ImageSurface):
+        return surface.get_stride() * surface.get_height()
+    if hasattr(surface, 'get_rowstride'):
+        return surface.get_rowstride() * surface.get_height()
+    return 0
+
+
+class MemoryBudget:
+    """The sources of memory of every category, and the budget of all
+    them together."""
+
+    def __init__(self, budget=BUDGET):
+        self.budget = budget
+        # (category, size_cb, release_cb)
+        self._sources = []
+
+    def add_source(self, category, size_cb, release_cb=None):
+        """Count the bytes returned by size_cb in category.
+
+            @param  release_cb -- called with the bytes to free when over
+                                  the budget, only for the categories in
+                                  EVICTION_ORDER
+        """
+        if category not in CATEGORIES:
+            raise ValueError('unknown category %s' % category)
+        self._sources.append((category, size_cb, release_cb))
+
+    def get_usage(self):
+        """Return a dictionary with the bytes used by every category."""
+        usage = dict.fromkeys(CATEGORIES, 0)
+        for category, size_cb, _release_cb in self._sources:
+            usage[category] += size_cb()
+        return usage
+
+    def get_total(self):
+        return sum(self.get_usage().values())
+
+    def enforce(self):
+        """Free memory of the categories in EVICTION_ORDER until the
+        total is in the budget, or nothing more can be freed. Return the
+        bytes freed."""
+        total = self.get_total()
+        if total <= self.budget:
+            return 0
+        freed = 0
+        for category in EVICTION_ORDER:
+            for source_category, size_cb, release_cb in self._sources:
+                excess = total - freed - self.budget
+                if excess <= 0:
+                    break
+                if source_category != category or release_cb is None:
+                    continue
+                before = size_cb()
+                release_cb(excess)
+                freed += before - size_cb()
+        logging.debug('MemoryBudget: %d bytes used, %d freed, budget %d',
+                      total, freed, self.budget)
+        if total - freed > self.budget:
+            logging.warning('MemoryBudget: %d bytes over the budget',
+                            total - freed - self.budget)
+        return freed
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace mipmap
+
+    Reduced copies of the drawing, every one half the size of the
+    previous, used to show the canvas zoomed out without reducing all
+    the full size image in every frame. The copies are updated only in
+    the tiles where the drawing was modified, when needed.
+
+"""
+
+import logging
+
+import cairo
+
+import tiles
+
+# size of the tiles in the full size image, divisible by 2 for every level
+TILE_SIZE = 256
+# the levels are not smaller than this scale
+MIN_SCALE = 0.1
+
+
+class MipmapPyramid:
+    """The levels with scale 1/2, 1/4, ... of a image, down to
+    MIN_SCALE, and the tiles of every level to paint again.
+    """
+
+    def __init__(self, width, height, paint_cb, min_scale=MIN_SCALE):
+        """
+            @param  width, height -- size of the full size image
+            @param  paint_cb -- called with a cairo.Context to paint the
+                                full size image, clipped to the area
+                                updated
+        """
+        self.width = width
+        self.height = height
+        self._paint_cb = paint_cb
+        self._rects = tiles.get_tile_rects(width, height, TILE_SIZE)
+        self._scales = []
+        scale = 0.5
+        while scale / 2 >= min_scale:
+            self._scales.append(scale)
+            scale /= 2
+        self._scales.append(scale)
+        # created when first used
+        self._levels = [None] * len(self._scales)
+        # indexes of the tiles to paint again in every level
+        self._dirty = [set(range(len(self._rects))) for _scale in
+                       self._scales]
+
+    def invalidate(self, area=None):
+        """The full size image changed in area (x, y, width, height), or
+        all the image if None."""
+        if area is None:
+            indexes = range(len(self._rects))
+        else:
+            indexes = tiles.get_tiles_in_area(self.width, self.height, area,
+                                              TILE_SIZE)
+        for dirty in self._dirty:
+            dirty.update(indexes)
+
+    def get_bytes(self):
+        """Return the bytes used by the levels created."""
+        return sum(level.get_stride() * level.get_height()
+                   for level in self._levels if level is not None)
+
+    def release(self):
+        """Free the memory of the levels, painted again when needed."""
+        self._levels = [None] * len(self._scales)
+        self.invalidate()
+
+    def get_level(self, zoom):
+        """Return (surface, scale) of the smallest level not reduced more
+        than zoom, updated, or None if zoom needs the full size image."""
+        chosen = None
+        for number, scale in enumerate(self._scales):
+            if scale < zoom:
+                break
+            chosen = number
+        if chosen is None:
+            return None
+        for number in range(chosen + 1):
+            self._update(number)
+        return self._levels[chosen], self._scales[chosen]
+
+    def _get_rect(self, number, index):
+        # the tile of the full size image in the level, the borders are
+        # rounded out
+        x, y, width, height = self._rects[index]
+        divisor = 2 ** (number + 1)
+        return (x // divisor, y // divisor,
+                -(-(x + width) // divisor) - x // divisor,
+                -(-(y + height) // divisor) - y // divisor)
+
+    def _update(self, number):
+        dirty = self._dirty[number]
+        if not dirty:
+            return
+        scale = self._scales[number]
+        if self._levels[number] is None:
+            self._levels[number] = cairo.ImageSurface(
+                cairo.FORMAT_ARGB32,
+                max(1, -(-self.width // 2 ** (number + 1))),
+                max(1, -(-self.height // 2 ** (number + 1))))
+        ctx = cairo.Context(self._levels[number])
+        for index in sorted(dirty):
+            ctx.save()
+            ctx.rectangle(*self._get_rect(number, index))
+            ctx.clip()
+            ctx.set_operator(cairo.OPERATOR_CLEAR)
+            ctx.paint()
+            ctx.set_operator(cairo.OPERATOR_OVER)
+            if number == 0:
+                ctx.scale(scale, scale)
+                self._paint_cb(ctx)
+            else:
+                # reduced from the previous level, already updated
+                ctx.scale(0.5, 0.5)
+                ctx.set_source_surface(self._levels[number - 1])
+                ctx.paint()
+            ctx.restore()
+        logging.debug('MipmapPyramid: %d tiles of level %d updated',
+                      len(dirty), number)
+        dirty.clear()
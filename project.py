@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace project
+
+    Drawings saved with their layers, as a OpenRaster zip file where
+    every layer is split in PNG tiles, so a project is opened without
+    decoding the tiles, and they are decoded when needed.
+
+    The layers written by other programs, with a single PNG file, can be
+    read too. The tiles are described with attributes in the namespace
+    _NAMESPACE of stack.xml, ignored by the other programs.
+
+"""
+
+import logging
+import StringIO
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+import cairo
+from gi.repository import Gdk
+
+import layers
+import tiles
+
+MIME_TYPE = 'image/openraster'
+TILE_SIZE = 256
+THUMBNAIL_SIZE = 256
+COMPRESSION_LEVEL = 6
+# blend mode of the layers without the composite-op attribute
+COMPOSITE_OP = layers.NORMAL
+
+_NAMESPACE = 'urn:paint-activity:project'
+_TILES = '{%s}tiles' % _NAMESPACE
+_TILE_SIZE = '{%s}tile-size' % _NAMESPACE
+
+
+class ProjectLayer:
+    """A layer of a project, with the names of its tiles in the zip
+    file."""
+
+    def __init__(self, name, opacity=1.0, visible=True,
+                 composite_op=COMPOSITE_OP):
+        self.name = name
+        self.opacity = opacity
+        self.visible = visible
+        self.composite_op = composite_op
+        # path prefix of the tiles, or the PNG with all the layer
+        self.src = None
+        self.tiled = False
+        self.x = 0
+        self.y = 0
+
+
+class Project:
+    """A project file open for reading, the tiles are read from the zip
+    file and decoded by get_tile() or paint_tile().
+    """
+
+    def __init__(self, file_path):
+        self._zip = zipfile.ZipFile(file_path)
+        try:
+            mime_type = self._zip.read('mimetype').strip()
+        except KeyError:
+            mime_type = None
+        if mime_type != MIME_TYPE:
+            self._zip.close()
+            raise ValueError('%s is not a OpenRaster file' % file_path)
+
+        image = ElementTree.fromstring(self._zip.read('stack.xml'))
+        self.width = int(image.get('w'))
+        self.height = int(image.get('h'))
+        self.tile_size = TILE_SIZE
+        self.layers = []
+        self._names = set(self._zip.namelist())
+        # whole layers of other programs, decoded once
+        self._layer_surfaces = {}
+        # the first layer in the file is the top one
+        for element in reversed(image.findall('./stack/layer')):
+            layer = ProjectLayer(
+                element.get('name', ''),
+                float(element.get('opacity', '1.0')),
+                element.get('visibility', 'visible') != 'hidden',
+                element.get('composite-op', COMPOSITE_OP))
+            layer.x = int(element.get('x', '0'))
+            layer.y = int(element.get('y', '0'))
+            if element.get(_TILES) is not None:
+                layer.tiled = True
+                layer.src = element.get(_TILES)
+                self.tile_size = int(element.get(_TILE_SIZE, TILE_SIZE))
+            else:
+                layer.src = element.get('src')
+            self.layers.append(layer)
+        self.tile_rects = tiles.get_tile_rects(self.width, self.height,
+                                               self.tile_size)
+
+    def close(self):
+        self._zip.close()
+        self._layer_surfaces = {}
+
+    def _decode(self, name):
+        return cairo.ImageSurface.create_from_png(
+            StringIO.StringIO(self._zip.read(name)))
+
+    def get_tile(self, layer, index):
+        """Return a cairo.ImageSurface with the tile at index of layer, or
+        None if the tile is empty."""
+        if layer.tiled:
+            name = '%s%d.png' % (layer.src, index)
+            if name not in self._names:
+                return None
+            return self._decode(name)
+
+        # the layer is a single image, keep it decoded
+        surface = self._layer_surfaces.get(layer.src)
+        if surface is None:
+            if layer.src not in self._names:
+                return None
+            logging.debug('Project: decoding %s', layer.src)
+            surface = self._layer_surfaces[layer.src] = \
+                self._decode(layer.src)
+        x, y, width, height = self.tile_rects[index]
+        tile = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(tile)
+        ctx.set_source_surface(surface, layer.x - x, layer.y - y)
+        ctx.paint()
+        return tile
+
+    def paint_tile(self, ctx, index, layers=None):
+        """Paint in ctx the visible layers, bottom first, in the tile at
+        index.
+
+            @param  layers -- the layers to paint, all if None
+        """
+        x, y, _width, _height = self.tile_rects[index]
+        for layer in layers or self.layers:
+            if not layer.visible:
+                continue
+            tile = self.get_tile(layer, index)
+            if tile is None:
+                continue
+            ctx.save()
+            ctx.set_source_surface(tile, x, y)
+            ctx.paint_with_alpha(layer.opacity)
+            ctx.restore()
+
+
+def _is_empty(surface, rect):
+    data = surface.get_data()
+    tile = tiles.read_tile(data, surface.get_stride(), rect)
+    return tile.count('\0') == len(tile)
+
+
+def _encode(surface, rect, compression):
+    x, y, width, height = rect
+    pixbuf = Gdk.pixbuf_get_from_surface(surface, x, y, width, height)
+    return pixbuf.save_to_bufferv('png', ['compression'],
+                                  [str(compression)])[1]
+
+
+def write_project(file_path, project_layers, compression=COMPRESSION_LEVEL):
+    """Write a project file.
+
+        @param  project_layers -- a list of (ProjectLayer,
+                                  cairo.ImageSurface), bottom first, all
+                                  the surfaces of the same size
+        @param  compression -- zlib level of the tiles, 0 to 9
+    """
+    width = project_layers[0][1].get_width()
+    height = project_layers[0][1].get_height()
+    rects = tiles.get_tile_rects(width, height, TILE_SIZE)
+    ElementTree.register_namespace('paint', _NAMESPACE)
+    image = ElementTree.Element('image', w=str(width), h=str(height),
+                                version='0.0.5')
+    stack = ElementTree.SubElement(image, 'stack')
+
+    with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_STORED) as project:
+        # must be the first, not compressed
+        project.writestr('mimetype', MIME_TYPE)
+        for number, (layer, surface) in reversed(
+                list(enumerate(project_layers))):
+            surface.flush()
+            prefix = 'data/layer%d/' % number
+            element = ElementTree.SubElement(stack, 'layer')
+            element.set('name', layer.name)
+            element.set('opacity', '%.3f' % layer.opacity)
+            element.set('visibility',
+                        'visible' if layer.visible else 'hidden')
+            element.set('composite-op', layer.composite_op)
+            element.set('x', '0')
+            element.set('y', '0')
+            element.set(_TILES, prefix)
+            element.set(_TILE_SIZE, str(TILE_SIZE))
+            for index, rect in enumerate(rects):
+                # the empty tiles are not written
+                if not _is_empty(surface, rect):
+                    project.writestr('%s%d.png' % (prefix, index),
+                                     _encode(surface, rect, compression))
+
+        project.writestr('Thumbnails/thumbnail.png',
+                         _get_thumbnail(project_layers, width, height))
+        project.writestr('stack.xml', ElementTree.tostring(image))
+
+
+def _get_thumbnail(project_layers, width, height):
+    scale = min(1.0, float(THUMBNAIL_SIZE) / max(width, height))
+    thumbnail = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                   max(1, int(width * scale)),
+                                   max(1, int(height * scale)))
+    ctx = cairo.Context(thumbnail)
+    ctx.scale(scale, scale)
+    for layer, surface in project_layers:
+        if layer.visible:
+            ctx.save()
+            ctx.set_source_surface(surface)
+            ctx.set_operator(layers.get_operator(layer.composite_op))
+            ctx.paint_with_alpha(layer.opacity)
+            ctx.restore()
+    data = StringIO.StringIO()
+    thumbnail.write_to_png(data)
+    return data.getvalue()
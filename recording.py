@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace recording
+
+    Record the input received by the Area in a compact binary file, and
+    replay it over a canvas.Canvas, without display, measuring the time
+    used by every event. Used to find what makes a long session slow.
+
+    The recording starts when the environment variable
+    PAINT_RECORD_EVENTS has the path of the file, or with
+    Area.start_recording(). The positions are recorded in coordinates of
+    the canvas, not scaled by the zoom.
+
+    The file has a header (MAGIC, VERSION) and the events, every one with
+    its type and the milliseconds since the recording started:
+
+        CANVAS   width, height  -- the canvas was created with this size
+        TOOL     the tool, as JSON -- set_tool() or the tool changed
+        PRESS    x, y, button1 pressed
+        MOTION   x, y  -- a position received while moving
+        FLUSH    button1 pressed, shift pressed -- the tool moves over the
+                                                   MOTION positions
+        RELEASE  x, y, shift pressed
+        KEY      keyval, state
+
+    The drawing that the canvas had when the recording started is not
+    recorded, the replay starts with a white canvas. The stamps are
+    replaced by a gray square of the same size.
+
+    Usage: python recording.py FILE [--window SECONDS]
+
+"""
+
+import argparse
+import json
+import logging
+import struct
+import time
+
+import cairo
+
+from canvas import Canvas
+
+MAGIC = 'PAINTREC'
+VERSION = 1
+
+CANVAS = 1
+TOOL = 2
+PRESS = 3
+MOTION = 4
+FLUSH = 5
+RELEASE = 6
+KEY = 7
+
+_HEADER = struct.Struct('<8sB')
+# type, milliseconds
+_EVENT = struct.Struct('<BI')
+_PAYLOADS = {CANVAS: struct.Struct('<II'),
+             TOOL: struct.Struct('<I'),  # length of the JSON that follows
+             PRESS: struct.Struct('<ff?'),
+             MOTION: struct.Struct('<ff'),
+             FLUSH: struct.Struct('<??'),
+             RELEASE: struct.Struct('<ff?'),
+             KEY: struct.Struct('<II')}
+
+# the Gdk key values used by Area.key_press
+KEY_RETURN = 0xff0d
+KEY_A = 0x61
+KEY_D = 0x64
+
+# seconds of the session in every line of the report
+WINDOW = 10.0
+
+
+class EventRecorder:
+    """Write the events to a file, see the module documentation."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file = open(file_path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+        self._start = time.time()
+        self._tool = None
+
+    def _write(self, event_type, *values):
+        milliseconds = int((time.time() - self._start) * 1000)
+        self._file.write(_EVENT.pack(event_type, milliseconds))
+        self._file.write(_PAYLOADS[event_type].pack(*values))
+
+    def record_canvas(self, width, height):
+        self._write(CANVAS, width, height)
+
+    def record_tool(self, tool):
+        """Write the tool if is not equal to the last one written."""
+        if tool == self._tool:
+            return
+        self._tool = dict(tool)
+        data = json.dumps(tool, default=str)
+        self._write(TOOL, len(data))
+        self._file.write(data)
+
+    def record_press(self, x, y, button1_pressed, tool):
+        # the values of the tool can be changed without set_tool()
+        self.record_tool(tool)
+        self._write(PRESS, x, y, bool(button1_pressed))
+
+    def record_motion(self, points):
+        for x, y in points:
+            self._write(MOTION, x, y)
+
+    def record_flush(self, button1_pressed, shift_pressed):
+        self._write(FLUSH, bool(button1_pressed), bool(shift_pressed))
+
+    def record_release(self, x, y, shift_pressed):
+        self._write(RELEASE, x, y, bool(shift_pressed))
+        # keep the finished strokes if the activity is closed
+        self._file.flush()
+
+    def record_key(self, keyval, state):
+        self._write(KEY, keyval, int(state))
+
+    def close(self):
+        self._file.close()
+        logging.debug('EventRecorder: session recorded in %s',
+                      self.file_path)
+
+
+def read_events(file_path):
+    """Return the events recorded in file_path, as a list of
+    (milliseconds, type, values). The values of TOOL are the tool dict.
+    Raises ValueError if the file is not a recording."""
+    with open(file_path, 'rb') as record_file:
+        data = record_file.read()
+    if len(data) < _HEADER.size:
+        raise ValueError('%s is not a recording' % file_path)
+    magic, version = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('%s is not a recording of version %d' %
+                         (file_path, VERSION))
+    events = []
+    offset = _HEADER.size
+    while offset + _EVENT.size <= len(data):
+        event_type, milliseconds = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        payload = _PAYLOADS[event_type]
+        if offset + payload.size > len(data):
+            # the last event was not written completely
+            break
+        values = payload.unpack_from(data, offset)
+        offset += payload.size
+        if event_type == TOOL:
+            length = values[0]
+            if offset + length > len(data):
+                break
+            values = json.loads(data[offset:offset + length])
+            offset += length
+        events.append((milliseconds, event_type, values))
+    return events
+
+
+class SessionReplayer:
+    """Send the recorded events to a canvas.Canvas, like the Area sent
+    them to its tools, and keep the time used by every one."""
+
+    def __init__(self, events):
+        self.events = events
+        self.canvas = None
+        # (milliseconds in the session, type, tool name, seconds used)
+        self.timings = []
+        # the events sent to a tool that needs the Area
+        self.skipped = 0
+        self._tool = None
+        self._points = []
+        self._unsupported = False
+
+    def run(self):
+        """Replay all the events, return the timings."""
+        for milliseconds, event_type, values in self.events:
+            start = time.time()
+            self._replay(event_type, values)
+            if self.canvas is not None:
+                self.canvas.render_frame()
+            tool_name = self._tool['name'] if self._tool else None
+            self.timings.append((milliseconds, event_type, tool_name,
+                                 time.time() - start))
+        return self.timings
+
+    def _set_tool(self, tool):
+        self._tool = tool
+        if self.canvas is None:
+            return
+        self.canvas.tool = dict(tool)
+        self.canvas.d.points = []
+        if tool['name'] in ('stamp', 'load-stamp'):
+            size = int(tool.get('stamp size', 44)) or 44
+            stamp = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+            ctx = cairo.Context(stamp)
+            ctx.set_source_rgba(0.5, 0.5, 0.5, 1.0)
+            ctx.paint()
+            self.canvas.set_stamp(stamp)
+
+    def _replay(self, event_type, values):
+        if event_type == CANVAS:
+            self.canvas = Canvas(*values)
+            if self._tool is not None:
+                self._set_tool(self._tool)
+        elif event_type == TOOL:
+            self._set_tool(values)
+        elif self.canvas is None:
+            self.skipped += 1
+        elif event_type == PRESS:
+            self._points = []
+            if not values[2]:
+                return
+            try:
+                self.canvas.tool_start(int(values[0]), int(values[1]))
+                self._unsupported = False
+            except ValueError:
+                self._unsupported = True
+                self.skipped += 1
+        elif event_type == MOTION:
+            self._points.append(values)
+        elif event_type == FLUSH:
+            points, self._points = self._points, []
+            if self._unsupported:
+                self.skipped += 1
+            elif points:
+                self.canvas.tool_move(points, *values)
+        elif event_type == RELEASE:
+            if self._unsupported:
+                self.skipped += 1
+                self._unsupported = False
+                return
+            self.canvas.tool_end(int(values[0]), int(values[1]), values[2])
+        elif event_type == KEY:
+            self._key_press(*values)
+
+    def _key_press(self, keyval, state):
+        # the keys of Area.key_press() changing the selection
+        if keyval in (KEY_RETURN, KEY_D):
+            self.canvas.getout(True)
+            self.canvas.queue_draw()
+        elif keyval == KEY_A:
+            if self.canvas.is_selected():
+                self.canvas.getout()
+            width, height = self.canvas.get_size()
+            self.canvas.set_selection_bounds(0, 0, width - 1, height - 1)
+            self.canvas.queue_draw()
+
+
+def percentile(values, percent):
+    """Return the value under which are percent of values, sorted."""
+    if not values:
+        return 0.0
+    return values[int(round((len(values) - 1) * percent / 100.0))]
+
+
+def print_report(timings, window=WINDOW):
+    """Print the time used by the events in every window seconds of the
+    session, and by every tool."""
+    print '%9s %7s %8s %8s %8s %9s' % ('session', 'events', 'mean ms',
+                                       'p90 ms', 'max ms', 'total ms')
+    windows = {}
+    tools = {}
+    for milliseconds, _event_type, tool_name, seconds in timings:
+        windows.setdefault(int(milliseconds / 1000.0 / window),
+                           []).append(seconds)
+        tools.setdefault(tool_name, []).append(seconds)
+    for number in sorted(windows):
+        _print_line('%8ds' % (number * window), windows[number])
+    print
+    for tool_name in sorted(tools):
+        _print_line('%9s' % tool_name, tools[tool_name])
+
+
+def _print_line(label, values):
+    values = sorted(values)
+    total = sum(values)
+    print '%s %7d %8.2f %8.2f %8.2f %9.1f' % (
+        label, len(values), total / len(values) * 1000,
+        percentile(values, 90) * 1000, values[-1] * 1000, total * 1000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay a recorded session without display')
+    parser.add_argument('file', help='the recorded session')
+    parser.add_argument('--window', type=float, default=WINDOW,
+                        help='seconds of the session in every line')
+    args = parser.parse_args()
+    replayer = SessionReplayer(read_events(args.file))
+    print_report(replayer.run(), args.window)
+    if replayer.skipped:
+        print '%d events of tools that need the display not replayed' % \
+            replayer.skipped
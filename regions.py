@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace regions
+
+    Index of the connected areas of the drawing canvas, to make
+    repeated bucket fills a lookup plus a masked color write.
+
+"""
+
+import array
+import logging
+import struct
+
+import fill
+
+
+class RegionIndex:
+    """Label every area of the same color of a image surface once, and
+    reuse the labels for all the bucket fills until the canvas is
+    modified by something else.
+    """
+
+    def __init__(self):
+        self._labels = None
+        self._bounds = None
+        self._size = None
+
+    @staticmethod
+    def is_available():
+        """The index needs the binary blobs, the python labeling would be
+        slower than a plain fill."""
+        return fill.NATIVE_LABEL
+
+    def is_valid(self):
+        return self._labels is not None
+
+    def get_bytes(self):
+        """Return the bytes used by the labels."""
+        if self._labels is None:
+            return 0
+        return len(self._labels) * self._labels.itemsize
+
+    def invalidate(self):
+        """The canvas was modified. Any change can split or join areas,
+        so all the labels are discarded and built again on the next fill.
+        """
+        self._labels = None
+        self._bounds = None
+
+    def fill(self, surface, x, y, color):
+        """Paint the area under (x, y) with color.
+
+            @param  surface -- a cairo.ImageSurface with FORMAT_ARGB32
+            @param  color -- the new color, packed as 0xAARRGGBB
+            @return  the damaged area as (x, y, width, height), or None
+                     if the area already had the color
+        """
+        width = surface.get_width()
+        height = surface.get_height()
+        if x < 0 or x >= width or y < 0 or y >= height:
+            return None
+        if self._size != (width, height):
+            self.invalidate()
+            self._size = (width, height)
+
+        surface.flush()
+        data = surface.get_data()
+        stride = surface.get_stride()
+
+        if self._labels is None:
+            logging.debug('RegionIndex: labeling %dx%d', width, height)
+            self._labels = array.array('I', [0]) * (width * height)
+            self._bounds = fill.label(data, stride, width, height,
+                                      self._labels)
+
+        label = self._labels[x + y * width]
+        pixel = struct.unpack_from('=I', data, y * stride + x * 4)[0]
+        if pixel == color:
+            return None
+
+        area = self._bounds[label]
+        touch = fill.fill_label(data, stride, width, height, self._labels,
+                                label, color, *area)
+        if touch:
+            # the area joined a neighbor of the same color
+            self.invalidate()
+        return area
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace saving
+
+    Write the drawing as a PNG file, or as a project with its layers, in
+    a background thread, to not stop the drawing while the pixels are
+    compressed.
+
+"""
+
+import logging
+import os
+import threading
+
+import cairo
+from gi.repository import Gdk
+
+import project
+
+# zlib level used in the PNG files, from 0 (none, fastest) to 9
+COMPRESSION_LEVEL = 6
+
+
+class PngWriter(threading.Thread):
+    """Save a copy of a image surface as a PNG file.
+
+    The surface is copied when the writer is created, in the thread that
+    creates it, the conversion to a pixbuf and the compression are done
+    in the new thread, with the lock of the interpreter released by the
+    gdk-pixbuf calls.
+    """
+
+    def __init__(self, surface, file_path, done_cb=None,
+                 compression=COMPRESSION_LEVEL):
+        """
+            @param  surface -- a cairo.ImageSurface
+            @param  file_path -- where the PNG file is written
+            @param  done_cb -- called from the thread with the writer when
+                               finished, self.error is None if the file
+                               was written
+            @param  compression -- zlib level, 0 to 9
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.file_path = file_path
+        self.compression = compression
+        self.error = None
+        self._done_cb = done_cb
+        self._surface = _copy_surface(surface)
+
+    def _write(self):
+        write_png(self._surface, self.file_path, self.compression)
+
+    def run(self):
+        try:
+            self._write()
+        except Exception, error:
+            logging.error('PngWriter: can not write %s: %s', self.file_path,
+                          error)
+            self.error = error
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+        self._surface = None
+        if self._done_cb is not None:
+            self._done_cb(self)
+
+
+class ProjectWriter(PngWriter):
+    """Save a copy of the layers as a project file, see
+    project.write_project()."""
+
+    def __init__(self, layers, file_path, done_cb=None,
+                 compression=COMPRESSION_LEVEL):
+        """
+            @param  layers -- a list of (project.ProjectLayer,
+                              cairo.ImageSurface), bottom first
+        """
+        PngWriter.__init__(self, layers[0][1], file_path, done_cb,
+                           compression)
+        self._layers = [(layer, _copy_surface(surface))
+                        for layer, surface in layers[1:]]
+        self._layers.insert(0, (layers[0][0], self._surface))
+
+    def _write(self):
+        project.write_project(self.file_path, self._layers,
+                              self.compression)
+        self._layers = None
+
+
+def _copy_surface(surface):
+    copy = cairo.ImageSurface(cairo.FORMAT_ARGB32, surface.get_width(),
+                              surface.get_height())
+    ctx = cairo.Context(copy)
+    ctx.set_operator(cairo.OPERATOR_SOURCE)
+    ctx.set_source_surface(surface)
+    ctx.paint()
+    return copy
+
+
+def write_png(surface, file_path, compression=COMPRESSION_LEVEL):
+    """Write a cairo.ImageSurface as a PNG file with the given zlib level.
+    """
+    pixbuf = Gdk.pixbuf_get_from_surface(surface, 0, 0, surface.get_width(),
+                                         surface.get_height())
+    pixbuf.savev(file_path, 'png', ['compression'], [str(compression)])
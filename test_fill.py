@@ -18,3 +18,125 @@ b = fill.fill(a, 2, 2, 3, 3, 4278190080)
 print "after", b
 
 print "after 2", array.array('I', b)
+
+c = array.array('I', a)
+damage = fill.fill_surface(c, 3 * 4, 2, 2, 3, 3, 4278190080)
+print "fill_surface damage", damage, "pixels", c
+
+from fill import scanline
+
+RED = 0xffff0000
+BLACK = 0xff000000
+WHITE = 0xffffffff
+
+
+def image(rows):
+    data = array.array('I')
+    for row in rows:
+        data.extend(row)
+    return bytearray(data.tostring())
+
+
+def pixels(buf):
+    return list(array.array('I', str(buf)))
+
+
+# a white image 4x3 with a black wall, and a light gray pixel
+WALL = [[WHITE, BLACK, WHITE, WHITE],
+        [WHITE, BLACK, 0xfff0f0f0, WHITE],
+        [WHITE, WHITE, WHITE, BLACK]]
+
+
+def test_fill_surface():
+    # exact fill, the gray pixel stops it
+    buf = image(WALL)
+    damage = scanline.fill_surface(buf, 4 * 4, 0, 0, 4, 3, RED)
+    assert damage == (0, 0, 3, 3), damage
+    assert pixels(buf) == [RED, BLACK, WHITE, WHITE,
+                           RED, BLACK, 0xfff0f0f0, WHITE,
+                           RED, RED, RED, BLACK], pixels(buf)
+
+    # the same color again
+    assert scanline.fill_surface(buf, 4 * 4, 0, 0, 4, 3, RED) is None
+    # outside of the image
+    assert scanline.fill_surface(buf, 4 * 4, 4, 0, 4, 3, RED) is None
+
+
+def test_fill_surface_tolerance():
+    # with tolerance the gray pixel is filled, not the black ones
+    buf = image([[WHITE, BLACK, WHITE, WHITE],
+                 [WHITE, BLACK, 0xfff0f0f0, WHITE],
+                 [WHITE, BLACK, WHITE, BLACK]])
+    damage = scanline.fill_surface(buf, 4 * 4, 3, 0, 4, 3, RED, 0x20)
+    assert damage == (2, 0, 2, 3), damage
+    assert pixels(buf) == [WHITE, BLACK, RED, RED,
+                           WHITE, BLACK, RED, RED,
+                           WHITE, BLACK, RED, BLACK], pixels(buf)
+
+
+def test_fill_surface_stride():
+    # the rows are stride bytes apart, the padding is not touched
+    buf = image([[WHITE, WHITE, 0], [WHITE, BLACK, 0]])
+    damage = scanline.fill_surface(buf, 3 * 4, 0, 0, 2, 2, RED)
+    assert damage == (0, 0, 2, 2), damage
+    assert pixels(buf) == [RED, RED, 0, RED, BLACK, 0], pixels(buf)
+
+
+def test_native_fill_surface():
+    # the blob and the python fill do the same
+    if not fill.NATIVE_FILL_SURFACE:
+        return
+    for tolerance in (0, 0x20):
+        python = image(WALL)
+        native = array.array('I', str(python))
+        assert fill.fill_surface(native, 4 * 4, 0, 0, 4, 3, RED,
+                                 tolerance) == \
+            scanline.fill_surface(python, 4 * 4, 0, 0, 4, 3, RED, tolerance)
+        assert list(native) == pixels(python)
+
+
+class Surface:
+    """The methods of a cairo.ImageSurface used by RegionIndex."""
+
+    def __init__(self, data, width, height):
+        self.data = data
+        self.width = width
+        self.height = height
+
+    def get_width(self):
+        return self.width
+
+    def get_height(self):
+        return self.height
+
+    def get_stride(self):
+        return self.width * 4
+
+    def get_data(self):
+        return self.data
+
+    def flush(self):
+        pass
+
+
+def test_region_index():
+    # the region index paints the same pixels as the fill
+    if not fill.NATIVE_LABEL:
+        return
+    from regions import RegionIndex
+    python = image(WALL)
+    surface = Surface(array.array('I', str(python)), 4, 3)
+    index = RegionIndex()
+    for x, y, color in ((0, 0, RED), (3, 0, RED), (1, 0, WHITE)):
+        assert index.fill(surface, x, y, color) == \
+            scanline.fill_surface(python, 4 * 4, x, y, 4, 3, color)
+        assert list(surface.data) == pixels(python)
+
+
+if __name__ == '__main__':
+    test_fill_surface()
+    test_fill_surface_tolerance()
+    test_fill_surface_stride()
+    test_native_fill_surface()
+    test_region_index()
+    print "scanline fill ok"
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+
+import cairo
+
+import layers
+import project
+import tiles
+
+
+def _surface(width, height, color, rect=None):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    ctx = cairo.Context(surface)
+    if rect is not None:
+        ctx.rectangle(*rect)
+    else:
+        ctx.rectangle(0, 0, width, height)
+    ctx.set_source_rgb(*color)
+    ctx.fill()
+    surface.flush()
+    return surface
+
+
+def test_write_read_two_layers():
+    # bigger than a tile, the top layer empty in some tiles
+    width, height = project.TILE_SIZE + 44, project.TILE_SIZE / 2
+    background = _surface(width, height, (1.0, 1.0, 1.0))
+    top = _surface(width, height, (1.0, 0.0, 0.0), (10, 10, 50, 30))
+    written = [(project.ProjectLayer('Background'), background),
+               (project.ProjectLayer('Layer 1', 0.5, False,
+                                     layers.MULTIPLY), top)]
+
+    directory = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(directory, 'drawing.ora')
+        project.write_project(file_path, written)
+        read = project.Project(file_path)
+        try:
+            assert (read.width, read.height) == (width, height)
+            assert [layer.name for layer in read.layers] == \
+                ['Background', 'Layer 1']
+            assert read.layers[1].opacity == 0.5
+            assert not read.layers[1].visible
+            assert read.layers[1].composite_op == layers.MULTIPLY
+            for layer, (_written_layer, surface) in zip(read.layers,
+                                                        written):
+                for index, rect in enumerate(read.tile_rects):
+                    tile = read.get_tile(layer, index)
+                    pixels = tiles.read_tile(surface.get_data(),
+                                             surface.get_stride(), rect)
+                    if tile is None:
+                        assert pixels.count('\0') == len(pixels)
+                        continue
+                    assert tiles.read_tile(
+                        tile.get_data(), tile.get_stride(),
+                        (0, 0, rect[2], rect[3])) == pixels
+        finally:
+            read.close()
+    finally:
+        shutil.rmtree(directory)
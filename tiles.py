@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace tiles
+
+    Split the pixels of a image surface in square tiles, to keep and
+    compare only the parts of the drawing that changed.
+
+"""
+
+import cairo
+
+TILE_SIZE = 64
+PIXEL_SIZE = 4
+
+
+def get_tile_rects(width, height, tile_size=TILE_SIZE):
+    """Return the rectangles (x, y, width, height) covering a image of the
+    given size, row by row. The tiles in the right and bottom borders can
+    be smaller."""
+    rects = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            rects.append((x, y, min(tile_size, width - x),
+                          min(tile_size, height - y)))
+    return rects
+
+
+def get_tiles_in_area(width, height, area, tile_size=TILE_SIZE):
+    """Return the indexes in get_tile_rects() of the tiles touched by area
+    (x, y, width, height)."""
+    x, y, area_width, area_height = area
+    columns = (width + tile_size - 1) / tile_size
+    rows = (height + tile_size - 1) / tile_size
+    first_column = max(0, int(x) / tile_size)
+    first_row = max(0, int(y) / tile_size)
+    last_column = min(columns - 1, int(x + area_width) / tile_size)
+    last_row = min(rows - 1, int(y + area_height) / tile_size)
+    return [row * columns + column
+            for row in range(first_row, last_row + 1)
+            for column in range(first_column, last_column + 1)]
+
+
+def read_tile(data, stride, rect):
+    """Copy the pixels of rect from a surface data to a string."""
+    x, y, width, height = rect
+    start = y * stride + x * PIXEL_SIZE
+    length = width * PIXEL_SIZE
+    return b''.join([data[offset:offset + length]
+                     for offset in range(start, start + height * stride,
+                                         stride)])
+
+
+def write_tile(data, stride, rect, tile):
+    """Copy the pixels of a string returned by read_tile() to a surface
+    data."""
+    x, y, width, height = rect
+    start = y * stride + x * PIXEL_SIZE
+    length = width * PIXEL_SIZE
+    for row in range(height):
+        offset = start + row * stride
+        data[offset:offset + length] = tile[row * length:
+                                            (row + 1) * length]
+
+
+class Snapshot:
+    """Read only copy of a ARGB32 image surface, kept as a list of tiles.
+
+    The tiles equal to the ones in the previous snapshot are not copied,
+    both snapshots share the same string, so a list of snapshots uses
+    memory for the modified tiles only.
+    """
+
+    def __init__(self, surface, previous=None):
+        surface.flush()
+        self.width = surface.get_width()
+        self.height = surface.get_height()
+        self.rects = get_tile_rects(self.width, self.height)
+        data = surface.get_data()
+        stride = surface.get_stride()
+
+        shared = previous is not None and \
+            (previous.width, previous.height) == (self.width, self.height)
+        self.tiles = []
+        for index, rect in enumerate(self.rects):
+            tile = read_tile(data, stride, rect)
+            if shared and previous.get_tile(index) == tile:
+                tile = previous.tiles[index]
+            self.tiles.append(tile)
+
+    def get_tile(self, index):
+        """Return the pixels of a tile as a string.
+
+        The items of self.tiles are strings, or objects with a get_data()
+        method returning the string, used to keep the tiles in a
+        compressed form (see history.UndoHistory).
+        """
+        tile = self.tiles[index]
+        if isinstance(tile, str):
+            return tile
+        return tile.get_data()
+
+    def get_changed_tiles(self, other):
+        """Return the indexes of the tiles not shared with other."""
+        if other is None or \
+                (other.width, other.height) != (self.width, self.height):
+            return range(len(self.tiles))
+        return [index for index, tile in enumerate(self.tiles)
+                if tile is not other.tiles[index]]
+
+    def restore(self, surface, current=None):
+        """Copy the snapshot over surface, if has the same size.
+
+            @param  current -- the snapshot with the actual content of
+                               the surface, if known, to copy only the
+                               tiles that are different
+            @return  False if the sizes do not match
+        """
+        if (surface.get_width(), surface.get_height()) != \
+                (self.width, self.height):
+            return False
+        surface.flush()
+        data = surface.get_data()
+        stride = surface.get_stride()
+        for index in self.get_changed_tiles(current):
+            write_tile(data, stride, self.rects[index], self.get_tile(index))
+        surface.mark_dirty()
+        return True
+
+    def to_surface(self):
+        """Return a new cairo.ImageSurface with the snapshot content."""
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width,
+                                     self.height)
+        self.restore(surface)
+        return surface
+
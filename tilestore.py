@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+@namespace tilestore
+
+    Copy of the drawing canvas kept in the instance directory of the
+    activity as raw tiles, updated with the tiles modified since the last
+    update only. Used to recover the drawing after a crash and to resume
+    without decoding the PNG of the journal.
+
+"""
+
+import json
+import logging
+import os
+import shutil
+import time
+import zlib
+
+import cairo
+
+import tiles
+
+# seconds between the updates while drawing
+UPDATE_INTERVAL = 10
+# the stores not used in this time are removed
+MAX_AGE = 30 * 24 * 60 * 60
+
+_PREFIX = 'tiles-'
+_MANIFEST = 'manifest.json'
+_DATA = 'tiles.data'
+
+
+def _crc(tile):
+    return zlib.crc32(tile) & 0xffffffff
+
+
+class TileStore:
+    """A directory with a file of tiles in fixed slots, and a manifest
+    with the size of the image, a version incremented on every update and
+    a checksum of every tile to know which ones changed.
+
+    The manifest is replaced after the tiles are written, its version is
+    saved in the journal metadata to know if the store is as new as the
+    journal entry. The files are not synced, to not wait for the disk in
+    the main loop: if the system stops before the tiles reach the disk
+    their checksums do not match and load() fails, the drawing is taken
+    from the journal then.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.version = 0
+        self.width = 0
+        self.height = 0
+        self._crcs = []
+        # indexes of the tiles that can be modified, None if all
+        self._dirty = None
+        self._read_manifest()
+
+    @staticmethod
+    def for_activity(instance_path, activity_id):
+        """Return the store of a activity, in the instance directory."""
+        return TileStore(os.path.join(instance_path, _PREFIX + activity_id))
+
+    @staticmethod
+    def remove_old(instance_path, max_age=MAX_AGE):
+        """Remove the stores not updated in max_age seconds."""
+        if not os.path.isdir(instance_path):
+            return
+        limit = time.time() - max_age
+        for name in os.listdir(instance_path):
+            path = os.path.join(instance_path, name)
+            if name.startswith(_PREFIX) and os.path.isdir(path) and \
+                    os.path.getmtime(path) < limit:
+                logging.debug('TileStore: removing %s', path)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def remove(self):
+        """Remove the directory, the drawing will not be recovered."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.width = self.height = self.version = 0
+        self._crcs = []
+        self._dirty = None
+
+    def _read_manifest(self):
+        path = os.path.join(self.directory, _MANIFEST)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as manifest_file:
+                manifest = json.load(manifest_file)
+            self.width = manifest['width']
+            self.height = manifest['height']
+            self.version = manifest['version']
+            self._crcs = manifest['crcs']
+            if manifest['tile_size'] != tiles.TILE_SIZE or \
+                    len(self._crcs) != len(self._get_rects()):
+                raise ValueError('tiles do not match')
+        except (IOError, ValueError, KeyError), error:
+            logging.error('TileStore: can not read %s: %s', path, error)
+            self.width = self.height = self.version = 0
+            self._crcs = []
+
+    def _write_manifest(self):
+        path = os.path.join(self.directory, _MANIFEST)
+        with open(path + '.tmp', 'w') as manifest_file:
+            json.dump({'width': self.width, 'height': self.height,
+                       'tile_size': tiles.TILE_SIZE,
+                       'version': self.version, 'crcs': self._crcs},
+                      manifest_file)
+        # atomic, the manifest always matches tiles already written
+        os.rename(path + '.tmp', path)
+
+    def _get_rects(self):
+        return tiles.get_tile_rects(self.width, self.height)
+
+    def has_image(self):
+        return self.width > 0 and self.height > 0
+
+    def mark_dirty(self, area=None):
+        """The pixels inside area (x, y, width, height), or all the image
+        if area is None, can be different from the stored ones."""
+        if self._dirty is None or area is None or not self.has_image():
+            self._dirty = None
+            return
+        self._dirty.update(tiles.get_tiles_in_area(self.width, self.height,
+                                                   area))
+
+    def is_dirty(self):
+        return self._dirty is None or len(self._dirty) > 0
+
+    def update(self, surface):
+        """Write the tiles of surface marked as dirty and different from
+        the stored ones.
+
+            @return  the number of tiles written
+        """
+        if not self.is_dirty():
+            return 0
+        surface.flush()
+        width = surface.get_width()
+        height = surface.get_height()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        data_path = os.path.join(self.directory, _DATA)
+        if (width, height) != (self.width, self.height) or \
+                not os.path.exists(data_path):
+            self.width = width
+            self.height = height
+            self._crcs = [None] * len(self._get_rects())
+            self._dirty = None
+            open(data_path, 'wb').close()
+
+        rects = self._get_rects()
+        indexes = range(len(rects)) if self._dirty is None \
+            else sorted(self._dirty)
+        data = surface.get_data()
+        stride = surface.get_stride()
+        slot = tiles.TILE_SIZE * tiles.TILE_SIZE * tiles.PIXEL_SIZE
+        written = 0
+        with open(data_path, 'r+b') as data_file:
+            for index in indexes:
+                tile = tiles.read_tile(data, stride, rects[index])
+                crc = _crc(tile)
+                if crc == self._crcs[index]:
+                    continue
+                data_file.seek(index * slot)
+                data_file.write(tile)
+                self._crcs[index] = crc
+                written += 1
+        self._dirty = set()
+        if written:
+            self.version += 1
+            self._write_manifest()
+            logging.debug('TileStore: version %d, %d of %d tiles written',
+                          self.version, written, len(rects))
+        return written
+
+    def load(self):
+        """Return a new cairo.ImageSurface with the stored image, or None
+        if it can not be read."""
+        if not self.has_image():
+            return None
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width,
+                                     self.height)
+        data = surface.get_data()
+        stride = surface.get_stride()
+        slot = tiles.TILE_SIZE * tiles.TILE_SIZE * tiles.PIXEL_SIZE
+        try:
+            with open(os.path.join(self.directory, _DATA), 'rb') as data_file:
+                for index, rect in enumerate(self._get_rects()):
+                    length = rect[2] * rect[3] * tiles.PIXEL_SIZE
+                    data_file.seek(index * slot)
+                    tile = data_file.read(length)
+                    if len(tile) != length or _crc(tile) != self._crcs[index]:
+                        raise IOError('tile %d is damaged' % index)
+                    tiles.write_tile(data, stride, rect, tile)
+        except IOError, error:
+            logging.error('TileStore: can not load %s: %s', self.directory,
+                          error)
+            return None
+        surface.mark_dirty()
+        # the tiles are equal to the surface
+        self._dirty = set()
+        return surface
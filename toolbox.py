@@ -95,6 +95,9 @@ from fontcombobox import FontComboBox
 from fontcombobox import FontSize
 
 from dialogs import TuxStampDialog
+import fill
+import filters
+import layers
 
 
 def add_menu(icon_name, tooltip, tool_name, button, activate_cb):
@@ -763,6 +766,8 @@ class ImageToolbar(Gtk.Toolbar):
 
     _EFFECT_RAINBOW_NAME = 'rainbow'
     _EFFECT_KALIDOSCOPE_NAME = 'kalidoscope'
+    # the scales of the view selected with the zoom buttons
+    _ZOOM_LEVELS = (0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0)
 
     def __init__(self, activity):
         GObject.GObject.__init__(self)
@@ -821,6 +826,59 @@ class ImageToolbar(Gtk.Toolbar):
         self.insert(self._invert_colors, -1)
         self._invert_colors.set_tooltip(_('Invert Colors'))
 
+        self._effect_filters = ToolButton('effect-filters')
+        self.insert(self._effect_filters, -1)
+        self._effect_filters.set_tooltip(_('Effects'))
+        self._effect_filters.palette_invoker.props.toggle_palette = True
+        self._effect_filters.props.hide_tooltip_on_click = False
+        palette = self._effect_filters.props.palette
+        palette.set_content(self._create_filters_box())
+        palette.connect('popup', self.__filters_popup_cb)
+        palette.connect('popdown', self.__filters_popdown_cb)
+
+        # shown while a effect is applied in the background
+        self._filter_progress = Gtk.ProgressBar()
+        self._filter_progress.set_valign(Gtk.Align.CENTER)
+        self._filter_progress_item = Gtk.ToolItem()
+        self._filter_progress_item.add(self._filter_progress)
+        self.insert(self._filter_progress_item, -1)
+        self._activity.area.connect('filter-progress',
+                                    self.__filter_progress_cb)
+
+        separator = Gtk.SeparatorToolItem()
+        separator.set_draw(True)
+        self.insert(separator, -1)
+
+        self._layers_button = ToolButton('layers')
+        self.insert(self._layers_button, -1)
+        self._layers_button.set_tooltip(_('Layers'))
+        self._layers_button.palette_invoker.props.toggle_palette = True
+        self._layers_button.props.hide_tooltip_on_click = False
+        palette = self._layers_button.props.palette
+        palette.set_content(self._create_layers_box())
+        palette.connect('popup', self.__layers_popup_cb)
+        self._activity.area.connect('layers-changed',
+                                    self.__layers_changed_cb)
+
+        separator = Gtk.SeparatorToolItem()
+        separator.set_draw(True)
+        self.insert(separator, -1)
+
+        self._zoom_out = ToolButton('zoom-out')
+        self.insert(self._zoom_out, -1)
+        self._zoom_out.set_tooltip(_('Zoom out'))
+        self._zoom_out.connect('clicked', self.__zoom_out_cb)
+
+        self._zoom_in = ToolButton('zoom-in')
+        self.insert(self._zoom_in, -1)
+        self._zoom_in.set_tooltip(_('Zoom in'))
+        self._zoom_in.connect('clicked', self.__zoom_in_cb)
+
+        self._zoom_original = ToolButton('zoom-original')
+        self.insert(self._zoom_original, -1)
+        self._zoom_original.set_tooltip(_('Actual size'))
+        self._zoom_original.connect('clicked', self.__zoom_original_cb)
+
         self._object_insert.connect('clicked', self.insertImage, activity)
         self._object_rotate_left.connect('clicked', self.rotate_left,
                                          activity)
@@ -835,6 +893,239 @@ class ImageToolbar(Gtk.Toolbar):
         self._invert_colors.connect('clicked', self.invert_colors)
 
         self.show_all()
+        self._filter_progress_item.hide()
+        # the python effects are too slow for the big drawings
+        if not fill.NATIVE_FILTERS:
+            self._effect_filters.hide()
+
+    def _create_filters_box(self):
+        self._filter_name = filters.BLUR
+        self._filter_preview_pending = False
+        box = Gtk.VBox()
+        group = None
+        for name, label in ((filters.BLUR, _('Blur')),
+                            (filters.SHARPEN, _('Sharpen')),
+                            (filters.EDGES, _('Find Edges')),
+                            (filters.POSTERIZE, _('Posterize')),
+                            (filters.BRIGHTNESS_CONTRAST,
+                             _('Brightness and Contrast')),
+                            (filters.HUE, _('Shift Hue')),
+                            (filters.PIXELATE, _('Pixelate'))):
+            button = Gtk.RadioButton.new_with_label_from_widget(group, label)
+            group = group or button
+            button.connect('toggled', self.__filter_toggled_cb, name)
+            box.pack_start(button, False, False, 0)
+
+        # the parameters of the effect, the second is used only by
+        # brightness and contrast
+        self._filter_labels = []
+        self._filter_scales = []
+        for _index in range(2):
+            label = Gtk.Label()
+            label.props.halign = Gtk.Align.START
+            box.pack_start(label, False, False, 0)
+            self._filter_labels.append(label)
+            scale = Gtk.HScale()
+            scale.set_digits(0)
+            scale.set_size_request(style.zoom(200), -1)
+            scale.connect('value-changed', self.__filter_param_changed_cb)
+            box.pack_start(scale, False, False, 0)
+            self._filter_scales.append(scale)
+
+        apply_button = Gtk.Button(_('Apply'))
+        apply_button.connect('clicked', self.__filter_apply_cb)
+        box.pack_start(apply_button, False, False, style.DEFAULT_SPACING)
+        box.show_all()
+        self._set_filter(filters.BLUR)
+        return box
+
+    def _set_filter(self, name):
+        self._filter_name = name
+        labels = {filters.BLUR: (_('Radius'), None),
+                  filters.SHARPEN: (_('Amount'), None),
+                  filters.POSTERIZE: (_('Levels'), None),
+                  filters.BRIGHTNESS_CONTRAST: (_('Brightness'),
+                                                _('Contrast')),
+                  filters.HUE: (_('Angle'), None),
+                  filters.PIXELATE: (_('Size'), None)}.get(name,
+                                                            (None, None))
+        for label, scale, text, param_range, default in zip(
+                self._filter_labels, self._filter_scales, labels,
+                filters.RANGES[name], filters.DEFAULTS[name]):
+            if param_range is None:
+                label.hide()
+                scale.hide()
+                continue
+            label.set_text(text)
+            scale.set_range(*param_range)
+            scale.set_value(default)
+            label.show()
+            scale.show()
+
+    def _get_filter_chain(self):
+        params = [int(scale.get_value()) if scale.get_visible() else None
+                  for scale in self._filter_scales]
+        return filters.FilterChain().append(self._filter_name, *params)
+
+    def _update_filter_preview(self):
+        self._filter_preview_pending = False
+        self._activity.area.update_filter_preview(self._get_filter_chain())
+        return False
+
+    def __filter_toggled_cb(self, button, name):
+        if not button.get_active():
+            return
+        self._set_filter(name)
+        self.__filter_param_changed_cb(None)
+
+    def __filter_param_changed_cb(self, scale):
+        # the slider can move many times before the preview is done
+        if not self._filter_preview_pending:
+            self._filter_preview_pending = True
+            GObject.idle_add(self._update_filter_preview)
+
+    def __filters_popup_cb(self, palette):
+        self._activity.area.start_filter_preview(self._get_filter_chain())
+
+    def __filters_popdown_cb(self, palette):
+        self._activity.area.cancel_filter_preview()
+
+    def __filter_apply_cb(self, button):
+        self._activity.area.apply_filters(self._activity.area,
+                                          self._get_filter_chain())
+        self._filter_progress.set_fraction(0.0)
+        self._filter_progress_item.show()
+        self._effect_filters.props.palette.popdown(immediate=True)
+
+    def __filter_progress_cb(self, area, fraction):
+        self._filter_progress.set_fraction(fraction)
+        if fraction >= 1.0:
+            self._filter_progress_item.hide()
+
+    def _create_layers_box(self):
+        # True while the widgets are updated from the layers
+        self._updating_layers = False
+        box = Gtk.VBox()
+
+        # the layers, the top one first
+        self._layers_combo = Gtk.ComboBoxText()
+        self._layers_combo.connect('changed', self.__layer_selected_cb)
+        box.pack_start(self._layers_combo, False, False, 0)
+
+        buttons = Gtk.HBox()
+        for label, callback in ((_('Add'), self.__layer_add_cb),
+                                (_('Remove'), self.__layer_remove_cb),
+                                (_('Up'), self.__layer_up_cb),
+                                (_('Down'), self.__layer_down_cb)):
+            button = Gtk.Button(label)
+            button.connect('clicked', callback)
+            buttons.pack_start(button, True, True, 0)
+        box.pack_start(buttons, False, False, style.DEFAULT_SPACING)
+
+        self._layer_visible = Gtk.CheckButton(_('Visible'))
+        self._layer_visible.connect('toggled', self.__layer_visible_cb)
+        box.pack_start(self._layer_visible, False, False, 0)
+
+        label = Gtk.Label(_('Opacity'))
+        label.props.halign = Gtk.Align.START
+        box.pack_start(label, False, False, 0)
+        self._layer_opacity = Gtk.HScale()
+        self._layer_opacity.set_range(0, 100)
+        self._layer_opacity.set_digits(0)
+        self._layer_opacity.set_size_request(style.zoom(200), -1)
+        self._layer_opacity.connect('value-changed',
+                                    self.__layer_opacity_cb)
+        box.pack_start(self._layer_opacity, False, False, 0)
+
+        label = Gtk.Label(_('Blend Mode'))
+        label.props.halign = Gtk.Align.START
+        box.pack_start(label, False, False, 0)
+        self._layer_blend_mode = Gtk.ComboBoxText()
+        for blend_mode, text in ((layers.NORMAL, _('Normal')),
+                                 (layers.MULTIPLY, _('Multiply')),
+                                 (layers.SCREEN, _('Screen')),
+                                 (layers.OVERLAY, _('Overlay')),
+                                 (layers.DARKEN, _('Darken')),
+                                 (layers.LIGHTEN, _('Lighten')),
+                                 (layers.DIFFERENCE, _('Difference'))):
+            self._layer_blend_mode.append(blend_mode, text)
+        self._layer_blend_mode.connect('changed',
+                                       self.__layer_blend_mode_cb)
+        box.pack_start(self._layer_blend_mode, False, False, 0)
+        box.show_all()
+        return box
+
+    def _update_layers_box(self):
+        stack = self._activity.area.layers
+        if stack is None:
+            return
+        self._updating_layers = True
+        self._layers_combo.remove_all()
+        for index in reversed(range(len(stack))):
+            self._layers_combo.append(str(index), stack[index].name)
+        self._layers_combo.set_active_id(str(stack.active))
+        layer = stack.get_active()
+        self._layer_visible.set_active(layer.visible)
+        self._layer_opacity.set_value(layer.opacity * 100)
+        self._layer_blend_mode.set_active_id(layer.blend_mode)
+        self._updating_layers = False
+
+    def __layers_popup_cb(self, palette):
+        self._update_layers_box()
+
+    def __layers_changed_cb(self, area):
+        self._update_layers_box()
+
+    def __layer_selected_cb(self, combo):
+        if self._updating_layers or combo.get_active_id() is None:
+            return
+        self._activity.area.set_active_layer(int(combo.get_active_id()))
+
+    def __layer_add_cb(self, button):
+        self._activity.area.add_layer()
+
+    def __layer_remove_cb(self, button):
+        self._activity.area.remove_layer()
+
+    def __layer_up_cb(self, button):
+        index = self._activity.area.layers.active
+        self._activity.area.move_layer(index, index + 1)
+
+    def __layer_down_cb(self, button):
+        index = self._activity.area.layers.active
+        self._activity.area.move_layer(index, index - 1)
+
+    def __layer_visible_cb(self, button):
+        if not self._updating_layers:
+            area = self._activity.area
+            area.set_layer_visible(area.layers.active, button.get_active())
+
+    def __layer_opacity_cb(self, scale):
+        if not self._updating_layers:
+            area = self._activity.area
+            area.set_layer_opacity(area.layers.active,
+                                   scale.get_value() / 100.0)
+
+    def __layer_blend_mode_cb(self, combo):
+        if not self._updating_layers and combo.get_active_id() is not None:
+            area = self._activity.area
+            area.set_layer_blend_mode(area.layers.active,
+                                      combo.get_active_id())
+
+    def __zoom_out_cb(self, button):
+        zoom = self._activity.area.get_zoom()
+        smaller = [level for level in self._ZOOM_LEVELS if level < zoom]
+        if smaller:
+            self._activity.set_zoom(smaller[-1])
+
+    def __zoom_in_cb(self, button):
+        zoom = self._activity.area.get_zoom()
+        bigger = [level for level in self._ZOOM_LEVELS if level > zoom]
+        if bigger:
+            self._activity.set_zoom(bigger[0])
+
+    def __zoom_original_cb(self, button):
+        self._activity.set_zoom(1.0)
 
     def rotate_left(self, widget, activity):
         activity.area.rotate_left(activity.area)
@@ -7,6 +7,8 @@ from gi.repository import Gdk
 from gi.repository import GObject
 import math
 
+import fill
+
 from sugar3.graphics import style
 from sugar3.graphics.palette import ToolInvoker
 from sugar3.graphics.colorbutton import _ColorButton
@@ -284,6 +286,31 @@ class ButtonStrokeColor(Gtk.ToolItem):
         self.vbox_brush_options.pack_start(self.keep_aspect_checkbutton, True,
                                            True, 0)
 
+        # Bucket options
+        tolerance = self.properties.get('bucket_tolerance', 0)
+        adj_tolerance = Gtk.Adjustment(tolerance, 0.0, 100.0, 1.0)
+        self.tolerance_scale = Gtk.HScale()
+        self.tolerance_scale.set_adjustment(adj_tolerance)
+        self.tolerance_scale.set_draw_value(False)
+        self.tolerance_scale.set_size_request(style.zoom(200), -1)
+        self.tolerance_label = Gtk.Label(label=_('Tolerance'))
+        self.tolerance_label.props.halign = Gtk.Align.START
+        self.vbox_brush_options.pack_start(self.tolerance_label, True, True,
+                                           0)
+        self.vbox_brush_options.pack_start(self.tolerance_scale, True, True,
+                                           0)
+
+        self.tolerance_scale.connect('value-changed',
+                                     self._on_tolerance_changed)
+
+        self.antialias_checkbutton = Gtk.CheckButton(_('Smooth borders'))
+        self.antialias_checkbutton.set_active(
+            self.properties.get('bucket_antialias', False))
+        self.antialias_checkbutton.connect(
+            'toggled', self._antialias_checkbutton_toggled)
+        self.vbox_brush_options.pack_start(self.antialias_checkbutton, True,
+                                           True, 0)
+
         self.custom_separator = Gtk.VSeparator()
         color_palette_hbox.pack_start(self.custom_separator, True, True,
                                       padding=style.DEFAULT_SPACING)
@@ -296,6 +323,12 @@ class ButtonStrokeColor(Gtk.ToolItem):
     def _keep_aspect_checkbutton_toggled(self, checkbutton):
         self._activity.area.keep_aspect_ratio = checkbutton.get_active()
 
+    def _on_tolerance_changed(self, scale):
+        self.properties['bucket_tolerance'] = int(scale.get_value())
+
+    def _antialias_checkbutton_toggled(self, checkbutton):
+        self.properties['bucket_antialias'] = checkbutton.get_active()
+
     def _update_palette(self):
         tool_name = self._selected_tool
         show_controls = ()
@@ -314,6 +347,10 @@ class ButtonStrokeColor(Gtk.ToolItem):
             title = _('Eraser properties')
         elif tool_name == 'bucket':
             show_colors = True
+            # the python fill is too slow comparing the colors
+            if fill.NATIVE_FILL_SURFACE:
+                show_controls = (self.tolerance_label, self.tolerance_scale,
+                                 self.antialias_checkbutton)
             title = _('Bucket properties')
         elif tool_name == 'picker':
             title = _('Picker properties')